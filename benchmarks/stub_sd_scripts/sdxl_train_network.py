@@ -0,0 +1,4 @@
+from train_network import main
+
+if __name__ == "__main__":
+    main()
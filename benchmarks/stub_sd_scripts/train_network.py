@@ -0,0 +1,125 @@
+"""
+Stands in for sd-scripts' train_network.py so the queue runner can be exercised without a GPU or a model.
+
+    python -m modules.queue_runner --scripts_dir benchmarks/stub_sd_scripts configs/
+
+It reads the same --config_file and --dataset_config arguments, then prints progress the way sd-scripts does.
+Environment variables change its behaviour:
+    STUB_STEPS      number of steps to run, defaults to max_train_steps from the config or 20
+    STUB_STEP_TIME  seconds per step, defaults to 0.05
+    STUB_FAIL       "oom", "ram", "nan", "missing" or "hang" to fail the way a real run can, "stubborn" hangs
+                    and ignores SIGINT and SIGTERM
+    STUB_WORKERS    number of idle child processes to start, like dataloader workers holding the output open
+    STUB_MAX_BATCH  run out of memory when the dataset's batch_size is larger than this
+
+The loss it reports is lowest at a learning_rate of 1e-4, so sweeps have something to rank. It honours resume,
+initial_step, save_every_n_steps and save_state with stub files. Like sd-scripts, max_train_steps is the total,
+a resumed run continues from the current_step in the state's train_state.json, and fails when that already
+reached max_train_steps.
+"""
+import argparse
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import toml
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_file")
+    parser.add_argument("--dataset_config")
+    args, _ = parser.parse_known_args()
+    config = toml.load(args.config_file) if args.config_file else {}
+    dataset = toml.load(args.dataset_config) if args.dataset_config else {}
+
+    steps = int(os.environ.get("STUB_STEPS", config.get("max_train_steps", 20)))
+    step_time = float(os.environ.get("STUB_STEP_TIME", 0.05))
+    fail = os.environ.get("STUB_FAIL", "")
+    resumed_step = 0
+    print(f"stub trainer: CUDA_VISIBLE_DEVICES={os.environ.get('CUDA_VISIBLE_DEVICES', '')} "
+          f"pid={os.getpid()} steps={steps}", flush=True)
+    if fail == "missing":
+        print(f"FileNotFoundError: [Errno 2] No such file or directory: "
+              f"'{config.get('pretrained_model_name_or_path', 'model.safetensors')}'", file=sys.stderr)
+        sys.exit(1)
+    if config.get("resume"):
+        if not os.path.isdir(config["resume"]):
+            print(f"FileNotFoundError: [Errno 2] No such file or directory: '{config['resume']}'", file=sys.stderr)
+            sys.exit(1)
+        print(f"resume training from local state: {config['resume']}")
+        train_state = os.path.join(config["resume"], "train_state.json")
+        if os.path.exists(train_state):
+            with open(train_state, "r") as f:
+                resumed_step = json.load(f).get("current_step", 0)
+
+    if fail == "stubborn":
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    for _ in range(int(os.environ.get("STUB_WORKERS", 0))):
+        subprocess.Popen([sys.executable, "-c", "import time; time.sleep(3600)"])
+
+    start = time.time()
+    offset = 0.02 * abs(math.log10(float(config.get("learning_rate", 1e-4)) / 1e-4))
+    loss = 0.0
+    initial_step = int(config["initial_step"]) if config.get("initial_step") is not None else resumed_step
+    if initial_step and steps <= initial_step:
+        print(f"AssertionError: max_train_steps should be greater than initial step: {steps} <= {initial_step}",
+              file=sys.stderr)
+        sys.exit(1)
+    first = initial_step + 1
+    for step in range(first, steps + 1):
+        if fail in ("hang", "stubborn") and step > steps // 2:
+            while True:
+                time.sleep(1)
+        max_batch = int(os.environ.get("STUB_MAX_BATCH", 0))
+        too_large = max_batch and dataset.get("general", {}).get("batch_size", 1) > max_batch
+        if (fail == "oom" and step > steps // 2) or (too_large and step == 2):
+            print("torch.cuda.OutOfMemoryError: CUDA out of memory. Tried to allocate 2.00 GiB", file=sys.stderr)
+            sys.exit(1)
+        if fail == "ram" and step > steps // 2:
+            print("RuntimeError: [enforce fail at alloc_cpu.cpp:83] data. DefaultCPUAllocator: can't allocate "
+                  "memory: you tried to allocate 2147483648 bytes. Error code 12 (Cannot allocate memory)",
+                  file=sys.stderr)
+            sys.exit(1)
+        time.sleep(step_time)
+        current = float("nan") if fail == "nan" and step > steps // 2 else \
+            0.1 + offset + 0.05 * math.exp(-step / 10)
+        loss += current
+        elapsed = time.time() - start
+        print(f"\rsteps: {step / steps:4.0%}| {step}/{steps} [{elapsed:.0f}s, {step / elapsed:.2f}it/s, "
+              f"avr_loss={loss / (step - first + 1):.4f}]", end="", file=sys.stderr, flush=True)
+        every = config.get("save_every_n_steps")
+        if every and config.get("output_dir") and step % every == 0 and step < steps:
+            name = f"{config.get('output_name', 'last')}-step{step:08d}.safetensors"
+            output = os.path.join(config["output_dir"], name)
+            print(f"\nsaving checkpoint: {output}", file=sys.stderr, flush=True)
+            with open(output, "wb") as f:
+                f.write(b"stub")
+            if config.get("save_state"):
+                state = output[:-len(".safetensors")] + "-state"
+                os.makedirs(state, exist_ok=True)
+                with open(os.path.join(state, "train_state.json"), "w") as f:
+                    json.dump({"current_epoch": 0, "current_step": step}, f)
+    print(file=sys.stderr)
+    if fail == "nan":
+        print("NaN detected in loss", file=sys.stderr)
+        sys.exit(1)
+    if config.get("output_dir"):
+        output = os.path.join(config["output_dir"], f"{config.get('output_name', 'last')}.safetensors")
+        with open(output, "wb") as f:
+            f.write(b"stub")
+        if config.get("save_state"):
+            state = os.path.join(config["output_dir"], f"{config.get('output_name', 'last')}-state")
+            os.makedirs(state, exist_ok=True)
+            with open(os.path.join(state, "train_state.json"), "w") as f:
+                json.dump({"current_epoch": 0, "current_step": steps}, f)
+    print("model saved.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules import dataset_index, validator  # noqa: E402
+
+
+def make_corpus(root: Path, files: int, subsets: int, vocab: int, tags_per_file: int) -> list[dict]:
+    rng = random.Random(0)
+    words = [f"tag_{i}" for i in range(vocab)]
+    subset_args = []
+    for s in range(subsets):
+        folder = root.joinpath(f"{s}_subset")
+        folder.mkdir()
+        subset_args.append({"image_dir": str(folder), "caption_extension": ".txt", "num_repeats": 1})
+        for i in range(s, files, subsets):
+            folder.joinpath(f"{i}.txt").write_text(", ".join(rng.sample(words, tags_per_file)), encoding="utf-8")
+    return subset_args
+
+
+def serial(subsets: list[dict]) -> dict:
+    tags = {}
+    for subset in subsets:
+        for file in os.listdir(subset['image_dir']):
+            if not os.path.isfile(os.path.join(subset['image_dir'], file)):
+                continue
+            if os.path.splitext(file)[1] != subset['caption_extension']:
+                continue
+            with open(os.path.join(subset['image_dir'], file), 'r') as f:
+                for tag in f.read().replace(", ", ",").split(","):
+                    tags[tag] = tags.get(tag, 0) + 1
+    return tags
+
+
+def read_report(file: Path) -> dict:
+    tags = {}
+    with file.open("r", encoding="utf-8") as f:
+        next(f)
+        for line in f:
+            count, tag = line.rstrip("\n").split("] ", 1)
+            tags[tag] = int(count[1:])
+    return tags
+
+
+def save_tags(root: Path, subsets: list[dict], workers: int) -> tuple[dict, float]:
+    args = {"tag_occurrence": True, "output_dir": str(root), "output_name": f"bench_{workers}"}
+    start = time.perf_counter()
+    validator.validate_save_tags(args, {"subsets": subsets}, workers)
+    elapsed = time.perf_counter() - start
+    return read_report(root.joinpath(f"bench_{workers}_tags.txt")), elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the serial tag loop with validate_save_tags, which reads "
+                                                 "the captions of every subset on one process pool")
+    parser.add_argument("--files", type=int, default=500_000)
+    parser.add_argument("--subsets", type=int, default=8)
+    parser.add_argument("--vocab", type=int, default=5000)
+    parser.add_argument("--tags_per_file", type=int, default=30)
+    parser.add_argument("--workers", type=int, nargs="*", default=[2, 4, 8, os.cpu_count()])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"writing {args.files} captions across {args.subsets} subsets...")
+        subsets = make_corpus(Path(root), args.files, args.subsets, args.vocab, args.tags_per_file)
+
+        start = time.perf_counter()
+        expected = serial(subsets)
+        base = time.perf_counter() - start
+        print(f"serial loop: {base:.2f}s")
+
+        for workers in sorted(set(w for w in args.workers if w)):
+            # a new index for every worker count, the first run reads every caption, the second its cached counts
+            dataset_index._index = dataset_index.DatasetIndex(Path(root, f"index_{workers}.sqlite"))
+            for run in ("cold", "cached"):
+                result, elapsed = save_tags(Path(root), subsets, workers)
+                assert result == expected, "parallel counts differ from the serial loop"
+                print(f"{workers} workers, {run}: {elapsed:.2f}s ({base / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ from modules.CollapsibleWidget import CollapsibleWidget
 
 
 class BucketWidget(QtWidgets.QWidget):
+    suggestRequested = QtCore.Signal()
+
     def __init__(self, parent: QtWidgets.QWidget = None) -> None:
         super(BucketWidget, self).__init__(parent)
         self.setLayout(QtWidgets.QVBoxLayout())
@@ -26,6 +28,12 @@ class BucketWidget(QtWidgets.QWidget):
         self.widget.steps_input.valueChanged.connect(lambda x: self.edit_args("bucket_reso_steps", x))
         self.widget.bucket_group.clicked.connect(self.enable_disable_buckets)
 
+        self.suggest_button = QtWidgets.QPushButton("Suggest Bucket Settings")
+        self.suggest_button.setToolTip("Searches bucket settings against the aspect ratios of the current subsets,\n"
+                                       "minimizing cropping and partial batches for the current batch size")
+        self.widget.verticalLayout_2.addWidget(self.suggest_button)
+        self.suggest_button.clicked.connect(self.suggestRequested.emit)
+
     @QtCore.Slot(str, object, bool)
     def edit_args(self, name: str, value: object, optional: bool = False) -> None:
         if not optional:
@@ -41,6 +49,11 @@ class BucketWidget(QtWidgets.QWidget):
     def enable_disable_buckets(self, checked: bool) -> None:
         self.dataset_args["enable_bucket"] = checked
 
+    def apply_settings(self, settings: dict) -> None:
+        self.widget.min_input.setValue(settings['min_bucket_reso'])
+        self.widget.max_input.setValue(settings['max_bucket_reso'])
+        self.widget.steps_input.setValue(settings['bucket_reso_steps'])
+
     def get_args(self, input_args: dict):
         pass
 
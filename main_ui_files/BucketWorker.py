@@ -0,0 +1,26 @@
+from PySide6 import QtCore
+
+from modules import bucket_optimizer
+
+
+class BucketWorker(QtCore.QObject):
+    """
+    Searches bucket settings on its own QThread, probing every image of a large dataset would freeze the UI.
+    The best candidate, or None when there is nothing to search, is sent back through finished.
+    """
+    finished = QtCore.Signal(object)
+
+    def __init__(self, subsets: list[dict], general: dict) -> None:
+        super(BucketWorker, self).__init__()
+        self.subsets = subsets
+        self.general = general
+
+    @QtCore.Slot()
+    def run(self) -> None:
+        best = None
+        try:
+            best = bucket_optimizer.suggest_bucket_settings(self.subsets, self.general)
+        except Exception as e:
+            print(f"Failed to suggest bucket settings because of error:\n{e}")
+        finally:
+            self.finished.emit(best)
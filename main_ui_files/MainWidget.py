@@ -1,9 +1,5 @@
 import json
 import os.path
-import subprocess
-import sys
-import threading
-import time
 from pathlib import Path
 from typing import Union
 
@@ -21,8 +17,17 @@ from main_ui_files import (
     LoggingUI,
     SubDatasetUI,
     QueueWidget,
+    TrainingWorker,
+    BucketWorker,
+)
+from modules import (
+    TomlFunctions,
+    bucket_optimizer,
+    job_store,
+    supervisor,
+    training,
+    validator,
 )
-from modules import TomlFunctions, validator
 
 
 class MainWidget(QtWidgets.QWidget):
@@ -40,6 +45,12 @@ class MainWidget(QtWidgets.QWidget):
         self.args = {}
         self.dataset_args = {}
         self.training_thread = None
+        self.training_worker = None
+        self.training_queue = False
+        self.bucket_thread = None
+        self.bucket_worker = None
+        # no widget edits the [[depends]] of a loaded toml, it is kept as is
+        self.depends = None
 
         self.tab_widget = modules.ScrollOnSelect.TabView()
         self.tab_widget.addTab(self.args_widget, "Main Args")
@@ -62,191 +73,165 @@ class MainWidget(QtWidgets.QWidget):
             QtWidgets.QSizePolicy.Policy.Minimum, QtWidgets.QSizePolicy.Policy.Maximum
         )
 
-        self.main_layout.addWidget(self.tab_widget, 0, 0, 4, 1)
+        self.group_queue_enable = QtWidgets.QCheckBox("Group Similar Jobs")
+        self.group_queue_enable.setToolTip(
+            "Runs queue items that share image folders, resolution and base model back to back,\n"
+            "keeping their order within each group, so their data is still cached when they start"
+        )
+        self.group_queue_enable.setSizePolicy(
+            QtWidgets.QSizePolicy.Policy.Minimum, QtWidgets.QSizePolicy.Policy.Maximum
+        )
+
+        self.shortest_first_enable = QtWidgets.QCheckBox("Shortest Jobs First")
+        self.shortest_first_enable.setToolTip(
+            "Runs queue items of the same priority by their estimated cost, cheapest first,\n"
+            "from their step count, batch size and resolution"
+        )
+        self.shortest_first_enable.setSizePolicy(
+            QtWidgets.QSizePolicy.Policy.Minimum, QtWidgets.QSizePolicy.Policy.Maximum
+        )
+
+        self.training_progress = QtWidgets.QProgressBar()
+        self.training_progress.setSizePolicy(
+            QtWidgets.QSizePolicy.Policy.Minimum, QtWidgets.QSizePolicy.Policy.Maximum
+        )
+        self.training_progress.setFormat("Not Training")
+        self.training_progress.setValue(0)
+
+        self.main_layout.addWidget(self.tab_widget, 0, 0, 7, 1)
         self.main_layout.addWidget(self.queue_widget, 0, 1, 2, 1)
-        self.main_layout.addWidget(self.runtime_only_enable, 2, 1, 1, 1)
-        self.main_layout.addWidget(self.begin_training_button, 3, 1, 1, 1)
+        self.main_layout.addWidget(self.group_queue_enable, 2, 1, 1, 1)
+        self.main_layout.addWidget(self.shortest_first_enable, 3, 1, 1, 1)
+        self.main_layout.addWidget(self.runtime_only_enable, 4, 1, 1, 1)
+        self.main_layout.addWidget(self.begin_training_button, 5, 1, 1, 1)
+        self.main_layout.addWidget(self.training_progress, 6, 1, 1, 1)
 
         self.begin_training_button.clicked.connect(self.begin_train)
+        self.trainingSignal.connect(self.disable_training_button)
         self.args_widget.general_args.CacheLatentsChecked.connect(
             self.subset_widget.cache_checked
         )
         self.args_widget.general_args.SdxlChecked.connect(
             self.args_widget.network_args.toggle_sdxl
         )
+        self.args_widget.bucket_args.suggestRequested.connect(
+            self.suggest_bucket_settings
+        )
 
     @QtCore.Slot()
     def begin_train(self) -> None:
-        if self.training_thread and self.training_thread.is_alive():
+        if self.training_thread and self.training_thread.isRunning():
             return
-        self.training_thread = threading.Thread(target=self.train_thread)
-        self.training_thread.start()
+        queue_files = tuple(elem.queue_file for elem in self.queue_widget.elements)
+        single_args = None
+        if not queue_files:
+            args, dataset_args = self.args_widget.collate_args()
+            dataset_args["subsets"] = self.subset_widget.get_subset_args()
+            single_args = (args, dataset_args, self.save_args())
+        self.start_worker(queue_files, single_args)
+
+    def start_worker(
+        self, queue_files: tuple[str, ...], single_args: Union[tuple[dict, dict, dict], None]
+    ) -> None:
+        queued = QtCore.Qt.ConnectionType.QueuedConnection
+        self.training_queue = single_args is None
+        self.training_thread = QtCore.QThread()
+        self.training_worker = TrainingWorker.TrainingWorker(
+            queue_files, single_args, self.runtime_only_enable.isChecked(),
+            {elem.queue_file: elem.text() for elem in self.queue_widget.elements},
+            self.group_queue_enable.isChecked(), self.shortest_first_enable.isChecked()
+        )
+        self.training_worker.moveToThread(self.training_thread)
+        self.training_thread.started.connect(self.training_worker.run)
+        self.training_worker.queueOrdered.connect(self.queue_widget.reorder, queued)
+        self.training_worker.jobStarted.connect(
+            self.queue_widget.remove_queue_item, queued
+        )
+        self.training_worker.progress.connect(self.update_progress, queued)
+        self.training_worker.finished.connect(self.training_thread.quit)
+        self.training_worker.finished.connect(self.training_worker.deleteLater)
+        self.training_thread.finished.connect(self.training_finished)
+        self.training_thread.finished.connect(self.training_thread.deleteLater)
         self.trainingSignal.emit(True)
+        self.training_thread.start()
 
-    def validate_args(self) -> tuple[bool, str]:
-        args, dataset_args = self.args_widget.collate_args()
-        dataset_args["subsets"] = self.subset_widget.get_subset_args()
-        self.training_thread = threading.Thread(target=self.train_thread)
-        args = validator.validate_args(args, self.runtime_only_enable.isChecked())
-        dataset_args = validator.validate_dataset_args(
-            dataset_args, self.runtime_only_enable.isChecked()
-        )
-        if not args or not dataset_args:
-            print("failed validation")
-            return False, ""
-        script = validator.validate_sdxl(args)
-        validator.validate_restarts(args, dataset_args)
-        validator.validate_warmup_ratio(args, dataset_args)
-        if not self.runtime_only_enable.isChecked():
-            validator.validate_save_tags(args, dataset_args)
-            validator.validate_existing_files(args)
-            if "save_toml" in args:
-                del args["save_toml"]
-                save_toml_path = args.get("save_toml_location", "")
-                if "save_toml_location" in args:
-                    del args["save_toml_location"]
-                if not os.path.exists(save_toml_path):
-                    save_toml_path = args["output_dir"]
-                TomlFunctions.save_toml(
-                    self.save_args(),
-                    os.path.join(
-                        save_toml_path,
-                        f"auto_save_{args.get('output_name', 'last')}.toml",
-                    ),
-                    is_queue=True,
-                )
-        if self.runtime_only_enable.isChecked():
-            folder_name = Path(f"runtime_store/{time.time_ns()}")
-            if not folder_name.exists():
-                folder_name.mkdir()
-            self.create_config_args_file(args, folder_name.joinpath("config.toml"))
-            self.create_dataset_args_file(
-                dataset_args, folder_name.joinpath("dataset.toml")
+    @QtCore.Slot()
+    def training_finished(self) -> None:
+        # finished is emitted just before the thread returns, it has to be done before the next one starts
+        self.training_thread.quit()
+        self.training_thread.wait()
+        self.training_thread = None
+        self.training_worker = None
+        if self.training_queue and self.queue_widget.elements:
+            # items added while the last snapshot was training
+            self.start_worker(
+                tuple(elem.queue_file for elem in self.queue_widget.elements), None
             )
-            print(f"Validated, outputting toml files to folder {folder_name}")
-            return False, ""
-        self.create_config_args_file(args)
-        self.create_dataset_args_file(dataset_args)
-        print("validated, starting training...")
-        return True, script
-
-    def train_thread(self):
-        self.begin_training_button.setEnabled(False)
-        python = sys.executable
-        if len(self.queue_widget.elements) == 0:
-            valid, py_script = self.validate_args()
-            if not valid:
-                self.begin_training_button.setEnabled(True)
-                self.trainingSignal.emit(False)
-                return
-            try:
-                subprocess.check_call(
-                    [
-                        python,
-                        os.path.join("sd_scripts", py_script),
-                        f"--config_file={os.path.join('runtime_store', 'config.toml')}",
-                        f"--dataset_config={os.path.join('runtime_store', 'dataset.toml')}",
-                    ]
-                )
-            except subprocess.SubprocessError as e:
-                print(f"Failed to train because of error:\n{e}")
-            files = [
-                os.path.join("runtime_store", "config.toml"),
-                os.path.join("runtime_store", "dataset.toml"),
-            ]
-            for file in files:
-                try:
-                    os.remove(file)
-                except FileNotFoundError:
-                    pass
-            self.begin_training_button.setEnabled(True)
-            self.trainingSignal.emit(False)
             return
-        while len(self.queue_widget.elements) > 0:
-            try:
-                file = os.path.join(
-                    "runtime_store", f"{self.queue_widget.elements[0].queue_file}.toml"
-                )
-                self.queue_widget.remove_first_from_queue()
-                base_args = TomlFunctions.load_toml(file)
-                args, dataset_args = validator.separate_and_validate(
-                    base_args, self.runtime_only_enable.isChecked()
-                )
-                if not args or not dataset_args:
-                    print("some args are not valid, skipping.")
-                    continue
-                py_script = validator.validate_sdxl(args)
-                validator.validate_restarts(args, dataset_args)
-                validator.validate_warmup_ratio(args, dataset_args)
-                if not self.runtime_only_enable.isChecked():
-                    validator.validate_save_tags(args, dataset_args)
-                    validator.validate_existing_files(args)
-                    if "save_toml" in args:
-                        del args["save_toml"]
-                        save_toml_path = args.get("save_toml_location", "")
-                        if "save_toml_location" in args:
-                            del args["save_toml_location"]
-                        if not os.path.exists(save_toml_path):
-                            save_toml_path = args["output_dir"]
-                        TomlFunctions.save_toml(
-                            base_args,
-                            os.path.join(
-                                save_toml_path,
-                                f"auto_save_{args.get('output_name', 'last')}.toml",
-                            ),
-                            is_queue=True,
-                        )
-                if self.runtime_only_enable.isChecked():
-                    folder_name = Path(f"runtime_store/{time.time_ns()}")
-                    if not folder_name.exists():
-                        folder_name.mkdir()
-                    self.create_config_args_file(
-                        args, folder_name.joinpath("config.toml")
-                    )
-                    self.create_dataset_args_file(
-                        dataset_args, folder_name.joinpath("dataset.toml")
-                    )
-                    print(f"Validated, outputting toml files to folder {folder_name}")
-                    continue
-                self.create_config_args_file(args)
-                self.create_dataset_args_file(dataset_args)
-                print("validated, starting training...")
-                subprocess.check_call(
-                    [
-                        python,
-                        os.path.join("sd_scripts", py_script),
-                        f"--config_file={os.path.join('runtime_store', 'config.toml')}",
-                        f"--dataset_config={os.path.join('runtime_store', 'dataset.toml')}",
-                    ]
-                )
-            except BaseException as e:
-                if not isinstance(e, subprocess.SubprocessError):
-                    print(f"Failed to train because of error:\n{e}")
-        for file in os.listdir("runtime_store"):
-            if file != ".gitignore":
-                try:
-                    os.remove(os.path.join("runtime_store", file))
-                except PermissionError:
-                    pass
-        self.begin_training_button.setEnabled(True)
         self.trainingSignal.emit(False)
 
+    @QtCore.Slot()
+    def suggest_bucket_settings(self) -> None:
+        if self.bucket_thread:
+            return
+        _, dataset_args = self.args_widget.collate_args()
+        subsets = self.subset_widget.get_subset_args()
+        if not subsets:
+            return
+        general = {}
+        for section in dataset_args.values():
+            if section:
+                general.update(section)
+        self.args_widget.bucket_args.suggest_button.setEnabled(False)
+        self.bucket_thread = QtCore.QThread()
+        self.bucket_worker = BucketWorker.BucketWorker(subsets, general)
+        self.bucket_worker.moveToThread(self.bucket_thread)
+        self.bucket_thread.started.connect(self.bucket_worker.run)
+        self.bucket_worker.finished.connect(
+            self.apply_bucket_settings, QtCore.Qt.ConnectionType.QueuedConnection
+        )
+        self.bucket_worker.finished.connect(self.bucket_thread.quit)
+        self.bucket_worker.finished.connect(self.bucket_worker.deleteLater)
+        self.bucket_thread.finished.connect(self.bucket_search_finished)
+        self.bucket_thread.finished.connect(self.bucket_thread.deleteLater)
+        self.bucket_thread.start()
+
+    @QtCore.Slot(object)
+    def apply_bucket_settings(self, best: Union[bucket_optimizer.BucketCandidate, None]) -> None:
+        if not best:
+            print("No images found to suggest bucket settings from")
+            return
+        print(f"Applying suggested bucket settings: {best}")
+        self.args_widget.bucket_args.apply_settings(best.settings)
+
+    @QtCore.Slot()
+    def bucket_search_finished(self) -> None:
+        self.bucket_thread.wait()
+        self.bucket_thread = None
+        self.bucket_worker = None
+        self.args_widget.bucket_args.suggest_button.setEnabled(True)
+
     def save_args(self) -> dict:
         args = self.args_widget.save_args()
         args["subsets"] = self.subset_widget.get_subset_args(skip_check=True)
+        if self.depends:
+            args["depends"] = self.depends
         return args
 
     def load_args(self, args: dict) -> None:
         self.args_widget.load_args(args)
         self.subset_widget.load_args(args)
+        self.depends = args.get("depends")
 
     @QtCore.Slot(str)
     def save_toml(self, file_name: str = None, is_queue: bool = False) -> None:
         args = self.save_args()
         if file_name:
-            TomlFunctions.save_toml(
-                args, os.path.join("runtime_store", f"{file_name}.toml"), is_queue
-            )
+            previous = job_store.get_store().load(file_name) or {}
+            if "sweep" in previous:
+                # the widgets only edit the sweep's base args
+                args["sweep"] = previous["sweep"]
+            job_store.get_store().save(file_name, args)
         else:
             if os.path.exists("config.json"):
                 with open("config.json", "r") as f:
@@ -264,9 +249,7 @@ class MainWidget(QtWidgets.QWidget):
     @QtCore.Slot(str)
     def load_toml(self, file_name: str = None) -> None:
         if file_name:
-            args = TomlFunctions.load_toml(
-                os.path.join("runtime_store", f"{file_name}.toml")
-            )
+            args = job_store.get_store().load(file_name)
         else:
             if os.path.exists("config.json"):
                 with open("config.json", "r") as f:
@@ -307,42 +290,26 @@ class MainWidget(QtWidgets.QWidget):
         )
 
     @staticmethod
-    def create_config_args_file(args: dict, path: Union[str, Path] = None) -> None:
-        if not path:
-            path = Path("runtime_store/config.toml")
-        if isinstance(path, str):
-            path = Path(path)
-        with path.open(mode="w", encoding="utf-8") as f:
-            for key, value in args.items():
-                if isinstance(value, str):
-                    value = f'"{value}"'
-                if isinstance(value, bool):
-                    value = f"{value}".lower()
-                f.write(f"{key} = {value}\n")
+    def create_config_args_file(args: dict, path: Union[str, Path]) -> None:
+        training.create_config_args_file(args, path)
 
     @staticmethod
-    def create_dataset_args_file(args: dict, path: Union[str, Path] = None) -> None:
-        if not path:
-            path = Path("runtime_store/dataset.toml")
-        if isinstance(path, str):
-            path = Path(path)
-        with path.open(mode="w", encoding="utf-8") as f:
-            f.write("[general]\n")
-            for key, value in args["general"].items():
-                if isinstance(value, str):
-                    value = f"'{value}'"
-                if isinstance(value, bool):
-                    value = f"{value}".lower()
-                f.write(f"{key} = {value}\n")
-            f.write("\n[[datasets]]\n")
-            for subset in args["subsets"]:
-                f.write("\n\t[[datasets.subsets]]\n")
-                for key, value in subset.items():
-                    if isinstance(value, str):
-                        value = f"'{value}'"
-                    if isinstance(value, bool):
-                        value = f"{value}".lower()
-                    f.write(f"\t{key} = {value}\n")
+    def create_dataset_args_file(args: dict, path: Union[str, Path]) -> None:
+        training.create_dataset_args_file(args, path)
+
+    @QtCore.Slot(object)
+    def update_progress(self, event: supervisor.ProgressEvent) -> None:
+        if event.kind == "step":
+            self.training_progress.setMaximum(event.total)
+            self.training_progress.setValue(event.step)
+            self.training_progress.setFormat(str(event))
+        elif event.kind == "start":
+            self.training_progress.setValue(0)
+            self.training_progress.setFormat("Starting...")
+        elif event.kind == "exit":
+            self.training_progress.setFormat(
+                "Finished" if event.code == 0 else f"Failed, {event}"
+            )
 
     @QtCore.Slot(bool)
     def disable_training_button(self, training: bool) -> None:
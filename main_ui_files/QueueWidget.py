@@ -1,6 +1,8 @@
 import os
 from PySide6 import QtWidgets, QtCore, QtGui
+from modules import job_store, sweep, TomlFunctions
 from modules.QueueItem import QueueItem
+from modules.ScrollOnSelect import SpinBox
 # from ui_files.QueueUI import Ui_queue_ui
 from ui_files.QueueUIVertical import Ui_queue_ui
 import time
@@ -18,37 +20,80 @@ class QueueWidget(QtWidgets.QWidget):
         self.widget.setupUi(self)
         self.widget.add_to_queue_button.clicked.connect(self.add_to_queue)
         self.widget.remove_from_queue_button.clicked.connect(self.remove_from_queue)
+        self.add_sweep_button = QtWidgets.QPushButton("Add Sweep", self)
+        self.add_sweep_button.setToolTip("Add a saved toml with a [sweep] table, its points are only created as "
+                                         "they are trained")
+        self.add_sweep_button.clicked.connect(self.add_sweep)
+        self.widget.gridLayout.addWidget(self.add_sweep_button, 6, 0, 1, 1)
+        self.priority_input = SpinBox(self)
+        self.priority_input.setRange(-100, 100)
+        self.priority_input.setPrefix("Priority: ")
+        self.priority_input.setToolTip("Items with a higher priority run first, the selected item is changed")
+        self.priority_input.valueChanged.connect(self.change_priority)
+        self.widget.gridLayout.addWidget(self.priority_input, 7, 0, 1, 1)
         self.widget.queue_scroll_widget.layout().setAlignment(QtCore.Qt.AlignmentFlag.AlignTop)
 
         self.widget.top_arrow.setIcon(QtGui.QIcon(os.path.join("icons", "chevron-up.svg")))
         self.widget.top_arrow.clicked.connect(lambda: self.change_position(True))
         self.widget.bottom_arrow.setIcon(QtGui.QIcon(os.path.join("icons", "chevron-down.svg")))
         self.widget.bottom_arrow.clicked.connect(lambda: self.change_position(False))
+        self.restore_queue()
 
-    def add_to_queue(self) -> None:
+    def restore_queue(self) -> None:
+        store = job_store.get_store()
+        recovered = store.recover()
+        if recovered:
+            print(f"{recovered} queued jobs were interrupted, they will be run again")
+        for queue_file, name in store.unfinished():
+            self.add_item(queue_file, name)
+
+    def add_item(self, queue_file: str, name: str) -> QueueItem:
         new_item = QueueItem()
-        new_item.queue_file = f"{time.time_ns()}"
+        new_item.queue_file = queue_file
         new_item.QueueSelected.connect(self.update_selected)
-        new_item.setText("Unnamed" if not self.widget.queue_name.text() else self.widget.queue_name.text())
+        new_item.setText(name)
         self.elements.append(new_item)
+        self.widget.queue_scroll_widget.layout().addWidget(new_item)
+        return new_item
+
+    def add_to_queue(self) -> None:
+        name = "Unnamed" if not self.widget.queue_name.text() else self.widget.queue_name.text()
+        new_item = self.add_item(f"{time.time_ns()}", name)
+        job_store.get_store().add(new_item.queue_file, name)
         self.selected = None
         self.uncheck_elements(True)
-        self.widget.queue_scroll_widget.layout().addWidget(new_item)
         self.saveQueue.emit(new_item.queue_file)
 
+    def add_sweep(self) -> None:
+        args = TomlFunctions.load_toml()
+        if not args:
+            return
+        try:
+            expander = sweep.Sweep(args)
+        except sweep.SweepError as e:
+            print(f"Failed to load the sweep: {e}")
+            return
+        name = f"{self.widget.queue_name.text() or expander.output_name} ({len(expander)} points)"
+        new_item = self.add_item(f"{time.time_ns()}", name)
+        priority = args.pop("priority", 0)
+        job_store.get_store().add(new_item.queue_file, name, args)
+        job_store.get_store().set_priority(new_item.queue_file, priority)
+
     def remove_from_queue(self) -> None:
         if not self.selected:
             return
-        if os.path.exists(os.path.join("runtime_store", f"{self.selected.queue_file}.toml")):
-            os.remove(os.path.join("runtime_store", f"{self.selected.queue_file}.toml"))
+        job_store.get_store().remove(self.selected.queue_file)
         self.widget.queue_scroll_widget.layout().removeWidget(self.selected)
         self.elements.remove(self.selected)
         self.selected.deleteLater()
         self.widget.queue_scroll_widget.layout().update()
         self.selected = None
 
-    def remove_first_from_queue(self) -> None:
-        elem = self.elements[0]
+    @QtCore.Slot(str)
+    def remove_queue_item(self, queue_file: str) -> None:
+        elem = next((elem for elem in self.elements if elem.queue_file == queue_file), None)
+        if elem is None:
+            return
         if elem == self.selected:
             self.selected = None
             self.uncheck_elements()
@@ -69,8 +114,16 @@ class QueueWidget(QtWidgets.QWidget):
         self.selected = widget
         self.uncheck_elements()
         self.selected.setChecked(True)
+        self.priority_input.blockSignals(True)
+        self.priority_input.setValue(job_store.get_store().priorities([widget.queue_file]).get(widget.queue_file, 0))
+        self.priority_input.blockSignals(False)
         self.loadQueue.emit(widget.queue_file)
 
+    @QtCore.Slot(int)
+    def change_priority(self, priority: int) -> None:
+        if self.selected:
+            job_store.get_store().set_priority(self.selected.queue_file, priority)
+
     @QtCore.Slot(bool)
     def change_position(self, left: bool) -> None:
         if not self.selected:
@@ -86,8 +139,14 @@ class QueueWidget(QtWidgets.QWidget):
             self.elements[index + 1], self.elements[index] = self.elements[index], self.elements[index + 1]
         self.update_layout()
 
+    def reorder(self, queue_files: list[str]) -> None:
+        positions = {name: i for i, name in enumerate(queue_files)}
+        self.elements.sort(key=lambda elem: positions.get(elem.queue_file, len(positions)))
+        self.update_layout()
+
     def update_layout(self) -> None:
         for elem in self.elements:
             self.widget.queue_scroll_widget.layout().removeWidget(elem)
         for elem in self.elements:
             self.widget.queue_scroll_widget.layout().addWidget(elem)
+        job_store.get_store().reorder([elem.queue_file for elem in self.elements])
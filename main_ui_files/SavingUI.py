@@ -5,6 +5,7 @@ from PySide6 import QtWidgets, QtCore, QtGui
 
 import modules.DragDropLineEdit
 from modules.CollapsibleWidget import CollapsibleWidget
+from modules.ScrollOnSelect import DoubleSpinBox, SpinBox
 from ui_files.SavingUI import Ui_saving_ui
 
 
@@ -20,6 +21,8 @@ class SavingWidget(QtWidgets.QWidget):
         self.widget = Ui_saving_ui()
         self.widget.setupUi(self.content)
         self.colap.add_widget(self.content, "main_widget")
+        self.early_stop = self.create_early_stop()
+        self.colap.add_widget(self.early_stop, "early_stop")
         self.layout().addWidget(self.colap)
         self.layout().setContentsMargins(9, 0, 9, 0)
 
@@ -98,6 +101,50 @@ class SavingWidget(QtWidgets.QWidget):
         self.widget.save_toml_selector.clicked.connect(lambda: self.set_from_dialog(self.widget.save_toml_input,
                                                                                     "Select the output Directory"))
 
+    def create_early_stop(self) -> QtWidgets.QGroupBox:
+        group = QtWidgets.QGroupBox("Early Stop")
+        group.setCheckable(True)
+        group.setChecked(False)
+        group.setToolTip("Stops the job after its next save once the loss stops improving, or stays too high.\n"
+                         "Needs a save frequency to stop before the end.")
+        group.setLayout(QtWidgets.QFormLayout())
+        self.early_stop_patience = SpinBox(group)
+        self.early_stop_patience.setRange(0, 1000000)
+        self.early_stop_patience.setToolTip("Steps avr_loss may go without improving, 0 turns it off")
+        self.early_stop_min_delta = DoubleSpinBox(group)
+        self.early_stop_min_delta.setDecimals(4)
+        self.early_stop_min_delta.setSingleStep(0.001)
+        self.early_stop_min_delta.setToolTip("How much avr_loss has to drop to count as an improvement")
+        self.early_stop_ceiling = DoubleSpinBox(group)
+        self.early_stop_ceiling.setDecimals(4)
+        self.early_stop_ceiling.setSingleStep(0.01)
+        self.early_stop_ceiling.setToolTip("Stop when avr_loss is above this after warmup, 0 turns it off")
+        self.early_stop_warmup = SpinBox(group)
+        self.early_stop_warmup.setRange(0, 1000000)
+        self.early_stop_warmup.setToolTip("Steps before either check starts")
+        group.layout().addRow("Patience Steps", self.early_stop_patience)
+        group.layout().addRow("Min Improvement", self.early_stop_min_delta)
+        group.layout().addRow("Loss Ceiling", self.early_stop_ceiling)
+        group.layout().addRow("Warmup Steps", self.early_stop_warmup)
+        group.toggled.connect(self.edit_early_stop)
+        for elem in (self.early_stop_patience, self.early_stop_min_delta, self.early_stop_ceiling,
+                     self.early_stop_warmup):
+            elem.valueChanged.connect(self.edit_early_stop)
+        return group
+
+    @QtCore.Slot()
+    def edit_early_stop(self) -> None:
+        if not self.early_stop.isChecked():
+            if "early_stop" in self.args:
+                del self.args['early_stop']
+            return
+        self.args['early_stop'] = {
+            "patience": self.early_stop_patience.value(),
+            "min_delta": self.early_stop_min_delta.value(),
+            "ceiling": self.early_stop_ceiling.value(),
+            "warmup_steps": self.early_stop_warmup.value()
+        }
+
     @QtCore.Slot(str, object, bool, QtWidgets.QWidget)
     def edit_args(self, name: str, value: object, optional: bool = False, elem: QtWidgets.QWidget = None) -> None:
         if elem:
@@ -343,6 +390,16 @@ class SavingWidget(QtWidgets.QWidget):
         self.enable_disable_toml_file(checked)
         self.widget.save_toml_input.setText(args.get('save_toml_location', ""))
 
+        policy = args.get("early_stop", {})
+        self.early_stop.blockSignals(True)
+        self.early_stop.setChecked(bool(policy))
+        self.early_stop.blockSignals(False)
+        self.early_stop_patience.setValue(policy.get("patience", 0))
+        self.early_stop_min_delta.setValue(policy.get("min_delta", 0.0))
+        self.early_stop_ceiling.setValue(policy.get("ceiling", 0.0))
+        self.early_stop_warmup.setValue(policy.get("warmup_steps", 0))
+        self.edit_early_stop()
+
     def save_args(self) -> Union[dict, None]:
         return self.args
 
@@ -0,0 +1,216 @@
+import subprocess
+from typing import Union
+
+from PySide6 import QtCore
+
+from modules import dataset_stager, job_graph, job_store, preflight, queue_order, run_history, sweep, training, \
+    validator, warm_worker
+
+
+class TrainingWorker(QtCore.QObject):
+    """
+    Validates and trains either a single job or a snapshot of the queue on its own QThread. It never touches
+    widgets, everything the UI needs to know is sent through signals, which Qt queues onto the UI thread.
+    """
+    jobStarted = QtCore.Signal(str)
+    queueOrdered = QtCore.Signal(object)
+    progress = QtCore.Signal(object)
+    finished = QtCore.Signal()
+
+    def __init__(self, queue_files: tuple[str, ...], single_args: Union[tuple[dict, dict, dict], None] = None,
+                 runtime_only: bool = False, names: dict[str, str] = None, group: bool = False,
+                 shortest_first: bool = False) -> None:
+        super(TrainingWorker, self).__init__()
+        self.queue_files = queue_files
+        self.single_args = single_args
+        self.runtime_only = runtime_only
+        self.names = names or {}
+        self.group = group
+        self.shortest_first = shortest_first
+        self.warm = None
+
+    @QtCore.Slot()
+    def run(self) -> None:
+        if not self.single_args and not self.runtime_only:
+            self.warm = warm_worker.from_config()
+        try:
+            if self.single_args:
+                self.run_single()
+            else:
+                self.run_queue()
+        except Exception as e:
+            print(f"Failed to train because of error:\n{e}")
+        finally:
+            if self.warm:
+                self.warm.stop()
+            self.finished.emit()
+
+    def validate_single(self) -> Union[training.Job, None]:
+        args, dataset_args, base_args = self.single_args
+        args = validator.validate_args(args, self.runtime_only)
+        dataset_args = validator.validate_dataset_args(dataset_args, self.runtime_only)
+        if not args or not dataset_args:
+            print("failed validation")
+            return None
+        job = training.finalize_job(args, dataset_args, base_args, self.runtime_only)
+        if self.runtime_only:
+            training.save_runtime_files(job)
+            return None
+        return job
+
+    def run_single(self) -> None:
+        job = self.validate_single()
+        if not job:
+            return
+        try:
+            training.launch(job, on_event=self.progress.emit, warm=self.warm)
+        except subprocess.SubprocessError as e:
+            print(f"Failed to train because of error:\n{e}")
+        training.cleanup_runtime_store()
+
+    def order_queue(self, store: job_store.JobStore) -> None:
+        """
+        Orders the snapshot by priority and, with shortest_first, by estimated cost, after grouping items that
+        share their data when group is set. Both read every image folder of the queue, which is why it is done
+        here and the list widget is only reordered once it is done.
+        """
+        if self.group:
+            items = {key: store.load(key) or {} for key in self.queue_files}
+            grouped = queue_order.group_by_affinity([(key, items[key]) for key in self.queue_files])
+            print(queue_order.report(list(self.queue_files), grouped, items))
+            self.queue_files = tuple(grouped)
+        names = {key: self.names.get(key, key) for key in self.queue_files}
+        priorities = store.priorities(list(self.queue_files))
+        order, estimates = queue_order.plan(
+            [(key, names[key], store.load(key) or {}) for key in self.queue_files], priorities, self.shortest_first
+        )
+        print(queue_order.plan_report(order, names, priorities, estimates))
+        self.queue_files = tuple(order)
+        self.queueOrdered.emit(order)
+
+    def run_queue(self) -> None:
+        stager = dataset_stager.from_config()
+        store = job_store.get_store()
+        duplicates = {}
+        if len(self.queue_files) > 1:
+            self.order_queue(store)
+            results = preflight.run(
+                [(queue_file, store.load(queue_file)) for queue_file in self.queue_files
+                 if not sweep.is_sweep(store.load(queue_file))], self.runtime_only
+            )
+            print(preflight.report(results))
+            if not self.runtime_only and run_history.skip_duplicates():
+                # jobs with parents only look alike until their parents' outputs are set
+                duplicates = {key: original for key, original in preflight.duplicates(results).items()
+                              if not job_graph.parents(store.load(key))
+                              and not job_graph.parents(store.load(original))}
+        for i, queue_file in enumerate(self.queue_files):
+            self.jobStarted.emit(queue_file)
+            base_args = store.load(queue_file)
+            if base_args is None:
+                print("queue item was removed before it started, skipping.")
+                continue
+            if queue_file in duplicates:
+                print("identical to an earlier queue item, skipping.")
+                store.finish(queue_file, True, f"skipped, duplicate of {duplicates[queue_file]}")
+                continue
+            if sweep.is_sweep(base_args):
+                self.run_sweep(queue_file, base_args, stager, store)
+                continue
+            if job_graph.parents(base_args):
+                # trained in order, a parent that has not finished by now is below this item, or failed to load
+                ready, reason = job_graph.check(store, "ui", base_args)
+                if not ready:
+                    reason = reason or "cancelled, it depends on a job below it in the queue"
+                    print(reason)
+                    store.finish(queue_file, False, reason)
+                    continue
+                base_args = ready
+            try:
+                store.start(queue_file)
+                if stager:
+                    stager.prefetch(base_args.get("subsets", []))
+                if stager and i + 1 < len(self.queue_files):
+                    next_args = store.load(self.queue_files[i + 1])
+                    stager.prefetch((next_args or {}).get("subsets", []))
+                job = training.prepare_job(base_args, self.runtime_only)
+                if not job:
+                    store.finish(queue_file, False, "validation failed")
+                    continue
+                if job.duplicate_of:
+                    store.finish(queue_file, True, f"skipped, already trained as {job.duplicate_of}", job.loss,
+                                 job.output)
+                    continue
+                training.resume_interrupted(job, store.config(queue_file))
+                store.record_config(queue_file, job.args, job.dataset_args)
+                if self.runtime_only:
+                    training.save_runtime_files(job)
+                    store.finish(queue_file, True)
+                    continue
+                training.launch(job, stager, on_event=self.progress.emit, warm=self.warm)
+                store.finish(queue_file, True, job.note(), job.loss, job.output)
+            except BaseException as e:
+                store.finish(queue_file, False, str(e))
+                if not isinstance(e, subprocess.SubprocessError):
+                    print(f"Failed to train because of error:\n{e}")
+        training.cleanup_runtime_store()
+
+    def run_sweep(self, queue_file: str, base_args: dict, stager, store: job_store.JobStore) -> None:
+        """
+        Trains a sweep queue item one point at a time, each point is only built and stored when it starts. A
+        halving sweep trains its rounds one after the other, each with the best points of the round before.
+        """
+        try:
+            expander = sweep.Sweep(base_args)
+            halving = sweep.Halving(expander) if sweep.is_halving(base_args) else None
+        except sweep.SweepError as e:
+            print(f"Failed to load the sweep: {e}")
+            store.finish(queue_file, False, str(e))
+            return
+        store.start(queue_file)
+        # points interrupted by a crash run again, the finished and failed ones are skipped
+        store.recover("sweep")
+        store.clear_pending("sweep", [f"{queue_file}-{name}" for name in (halving or expander).names()])
+        print(f"{expander.mode} sweep over {len(expander.parameters)} args, {len(expander)} points")
+        if halving:
+            print(halving.describe())
+        failed = 0
+        while True:
+            losses = {}
+            for i, (name, point_args) in enumerate((halving or expander).jobs()):
+                key = f"{queue_file}-{name}"
+                if store.add_many([(key, name, point_args)], "sweep", replace=False):
+                    print(f"[{name}] sweep job {i + 1}")
+                    if not self.run_point(key, name, point_args, stager, store):
+                        failed += 1
+                else:
+                    print(f"[{name}] already ran as part of this sweep, skipping.")
+                state, loss = store.results([key]).get(key, (job_store.FAILED, None))
+                losses[name] = loss if state == job_store.DONE else None
+            if not halving or not halving.advance(losses):
+                break
+        store.finish(queue_file, not failed, f"{failed} sweep jobs failed" if failed else None)
+
+    def run_point(self, key: str, name: str, point_args: dict, stager, store: job_store.JobStore) -> bool:
+        store.start(key)
+        try:
+            job = training.prepare_job(point_args, self.runtime_only, name)
+            if not job:
+                store.finish(key, False, "validation failed")
+                return False
+            if job.duplicate_of:
+                store.finish(key, True, f"skipped, already trained as {job.duplicate_of}", job.loss, job.output)
+                return True
+            training.resume_interrupted(job, store.config(key))
+            store.record_config(key, job.args, job.dataset_args)
+            if self.runtime_only:
+                training.save_runtime_files(job)
+            else:
+                training.launch(job, stager, on_event=self.progress.emit, warm=self.warm)
+            store.finish(key, True, job.note(), job.loss, job.output)
+            return True
+        except BaseException as e:
+            store.finish(key, False, str(e))
+            if not isinstance(e, subprocess.SubprocessError):
+                print(f"Failed to train because of error:\n{e}")
+            return False
@@ -0,0 +1,124 @@
+import itertools
+import math
+from typing import Union
+
+import numpy as np
+
+from modules import bucket_simulator
+
+
+class BucketCandidate:
+    def __init__(self, settings: dict, crop_fraction: float, partial_fraction: float,
+                 batches_per_epoch: int, ideal_batches: int, score: float) -> None:
+        self.settings = settings
+        self.crop_fraction = crop_fraction
+        self.partial_fraction = partial_fraction
+        self.batches_per_epoch = batches_per_epoch
+        self.ideal_batches = ideal_batches
+        self.score = score
+
+    def __str__(self) -> str:
+        return (f"min {self.settings['min_bucket_reso']}, max {self.settings['max_bucket_reso']}, "
+                f"steps {self.settings['bucket_reso_steps']}: {self.crop_fraction:.1%} cropped, "
+                f"{self.partial_fraction:.1%} empty batch slots, "
+                f"{self.batches_per_epoch} batches per epoch (best possible {self.ideal_batches})")
+
+
+class BucketOptimizer:
+    """
+    Searches min_bucket_reso, max_bucket_reso and bucket_reso_steps for the configured subsets.
+
+    Aspect ratios are binned once up front (0.1% steps in log space), weighted by each image's effective
+    repeats, so a candidate costs a few vectorized operations over the bins rather than over the dataset.
+    With bucket_no_upscale only the reso steps matter, and those candidates run over the unique image sizes.
+    """
+
+    def __init__(self, widths: np.ndarray, heights: np.ndarray, repeats: np.ndarray, is_reg: np.ndarray) -> None:
+        repeats = repeats.copy()
+        repeats[is_reg] = bucket_simulator.balance_regularization(repeats[~is_reg], repeats[is_reg])
+        keep = repeats > 0
+        widths, heights, repeats = widths[keep], heights[keep], repeats[keep]
+        self.total = float(repeats.sum())
+
+        bins, inverse = np.unique(np.round(np.log(widths / heights) * 1000).astype(np.int64), return_inverse=True)
+        self.aspects = np.exp(bins / 1000)
+        self.aspect_weights = np.bincount(inverse.reshape(-1), weights=repeats, minlength=len(bins))
+
+        sizes, inverse = np.unique(widths * 100000 + heights, return_inverse=True)
+        self.widths = sizes // 100000
+        self.heights = sizes % 100000
+        self.size_weights = np.bincount(inverse.reshape(-1), weights=repeats, minlength=len(sizes))
+
+    @classmethod
+    def from_subsets(cls, subsets: list[dict], general: dict, workers: int = None) -> "BucketOptimizer":
+        return cls(*bucket_simulator.collect_images(subsets, general, workers))
+
+    def _predefined(self, general: dict) -> tuple[np.ndarray, np.ndarray]:
+        predefined = np.array(bucket_simulator.make_bucket_resolutions(
+            bucket_simulator._resolution(general), general["min_bucket_reso"], general["max_bucket_reso"],
+            general["bucket_reso_steps"]), dtype=np.int64)
+        bucket_aspects = predefined[:, 0] / predefined[:, 1]
+        index = bucket_simulator._nearest_aspect(bucket_aspects, self.aspects)
+        chosen = bucket_aspects[index]
+        crop = 1 - np.minimum(chosen / self.aspects, self.aspects / chosen)
+        images = np.bincount(index, weights=self.aspect_weights, minlength=len(predefined))
+        return np.dot(crop, self.aspect_weights), images
+
+    def _no_upscale(self, general: dict) -> tuple[np.ndarray, np.ndarray]:
+        buckets, resized = bucket_simulator.assign_buckets(self.widths, self.heights, general)
+        crop = 1 - (buckets[:, 0] * buckets[:, 1]) / np.maximum(resized[:, 0] * resized[:, 1], 1)
+        _, inverse = np.unique(buckets[:, 0] * 100000 + buckets[:, 1], return_inverse=True)
+        images = np.bincount(inverse.reshape(-1), weights=self.size_weights)
+        return np.dot(np.clip(crop, 0, 1), self.size_weights), images
+
+    def evaluate(self, general: dict, batch_size: int, crop_weight: float = 1.0, partial_weight: float = 1.0,
+                 steps_weight: float = 1.0) -> BucketCandidate:
+        if general.get("bucket_no_upscale", False):
+            cropped, images = self._no_upscale(general)
+        else:
+            cropped, images = self._predefined(general)
+        images = np.round(images).astype(np.int64)
+        batches = int((-(-images // batch_size)).sum())
+        ideal = math.ceil(self.total / batch_size) if self.total else 0
+        crop_fraction = float(cropped / self.total) if self.total else 0.0
+        partial_fraction = 1 - self.total / (batches * batch_size) if batches else 0.0
+        overhead = batches / ideal - 1 if ideal else 0.0
+        score = crop_weight * crop_fraction + partial_weight * partial_fraction + steps_weight * overhead
+        return BucketCandidate({key: general[key] for key in ("min_bucket_reso", "max_bucket_reso",
+                                                             "bucket_reso_steps")},
+                               crop_fraction, partial_fraction, batches, ideal, score)
+
+    def search(self, general: dict, batch_size: int, steps_options: tuple = (32, 64, 128),
+               max_reso_limit: int = 2048, top: int = 5, **weights) -> list[BucketCandidate]:
+        resolution = bucket_simulator._resolution(general)
+        candidates = []
+        for steps in steps_options:
+            if general.get("bucket_no_upscale", False):
+                options = [(general.get("min_bucket_reso", 256), general.get("max_bucket_reso", 1024))]
+            else:
+                min_options = range(steps * max(1, 128 // steps), min(resolution) + 1, max(steps, 64))
+                max_options = range(math.ceil(max(resolution) / steps) * steps, max_reso_limit + 1, max(steps, 128))
+                options = itertools.product(min_options, max_options)
+            for min_reso, max_reso in options:
+                settings = {**general, "enable_bucket": True, "min_bucket_reso": min_reso,
+                            "max_bucket_reso": max_reso, "bucket_reso_steps": steps}
+                candidates.append(self.evaluate(settings, batch_size, **weights))
+        candidates.sort(key=lambda x: x.score)
+        return candidates[:top]
+
+
+def suggest_bucket_settings(subsets: list[dict], general: dict, batch_size: int = None,
+                            workers: int = None) -> Union[BucketCandidate, None]:
+    batch_size = batch_size or general.get("batch_size", 1)
+    optimizer = BucketOptimizer.from_subsets(subsets, general, workers)
+    if optimizer.total == 0:
+        return None
+    best = optimizer.search(general, batch_size)
+    current = optimizer.evaluate({**general, "enable_bucket": True,
+                                  "min_bucket_reso": general.get("min_bucket_reso", 256),
+                                  "max_bucket_reso": general.get("max_bucket_reso", 1024),
+                                  "bucket_reso_steps": general.get("bucket_reso_steps", 64)}, batch_size)
+    print(f"current bucket settings: {current}")
+    for candidate in best:
+        print(f"candidate: {candidate}")
+    return best[0] if best else None
@@ -0,0 +1,185 @@
+import math
+import os
+from typing import Union
+
+import numpy as np
+
+from modules import dataset_index
+
+
+class BucketSimulation:
+    def __init__(self, resolutions: list[tuple[int, int]], images: np.ndarray, batch_size: int,
+                 epochs: int, gradient_accumulation_steps: int = 1) -> None:
+        self.resolutions = resolutions
+        self.images = images
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.batches = -(-images // batch_size)
+        self.padded = self.batches * batch_size - images
+        self.batches_per_epoch = int(self.batches.sum())
+        self.partial_batches = int(np.count_nonzero(self.padded))
+        self.padded_slots = int(self.padded.sum())
+        self.steps_per_epoch = math.ceil(self.batches_per_epoch / gradient_accumulation_steps)
+        self.total_steps = self.steps_per_epoch * epochs
+
+    def summary(self) -> str:
+        lines = []
+        for (width, height), images, batches in zip(self.resolutions, self.images, self.batches):
+            lines.append(f"bucket {width}x{height}: {images} images, {batches} batches")
+        lines.append(f"{self.batches_per_epoch} batches per epoch, {self.partial_batches} partial "
+                     f"({self.padded_slots} empty slots), {self.total_steps} optimizer steps total")
+        return "\n".join(lines)
+
+
+def _resolution(general: dict) -> tuple[int, int]:
+    resolution = general.get("resolution", 512)
+    if isinstance(resolution, (list, tuple)):
+        return int(resolution[0]), int(resolution[-1])
+    return int(resolution), int(resolution)
+
+
+def make_bucket_resolutions(max_reso: tuple[int, int], min_size: int = 256, max_size: int = 1024,
+                            divisible: int = 64) -> list[tuple[int, int]]:
+    # same bucket list sd-scripts builds in library.model_util
+    max_width, max_height = max_reso
+    max_area = max_width * max_height
+    resos = set()
+    width = int(math.sqrt(max_area) // divisible) * divisible
+    resos.add((width, width))
+    width = min_size
+    while width <= max_size:
+        height = min(max_size, int((max_area // width) // divisible) * divisible)
+        if height >= min_size:
+            resos.add((width, height))
+            resos.add((height, width))
+        width += divisible
+    return sorted(resos)
+
+
+def _nearest_aspect(predefined: np.ndarray, aspect: np.ndarray) -> np.ndarray:
+    """
+    Vectorized equivalent of np.abs(predefined_aspects - aspect).argmin() per image, in O(n log b)
+    instead of building an n by b error matrix. Ties resolve to the lowest bucket index like argmin does.
+    """
+    values, first = np.unique(predefined, return_index=True)
+    pos = np.searchsorted(values, aspect)
+    left = np.clip(pos - 1, 0, len(values) - 1)
+    right = np.clip(pos, 0, len(values) - 1)
+    left_error = np.abs(values[left] - aspect)
+    right_error = np.abs(values[right] - aspect)
+    pick_right = (right_error < left_error) | ((right_error == left_error) & (first[right] < first[left]))
+    return np.where(pick_right, first[right], first[left])
+
+
+def _round_to_steps(x: np.ndarray, steps: int) -> np.ndarray:
+    x = np.floor(x + 0.5).astype(np.int64)
+    return x - x % steps
+
+
+def assign_buckets(widths: np.ndarray, heights: np.ndarray, general: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reproduces sd-scripts' BucketManager.select_bucket for every image at once, returning the
+    bucket (width, height) and the size each image is resized to before it is cropped into the bucket.
+    """
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    max_reso = _resolution(general)
+    count = len(widths)
+    if not general.get("enable_bucket", False):
+        buckets = np.tile(np.array(max_reso, dtype=np.int64), (count, 1))
+        scale = np.maximum(max_reso[0] / widths, max_reso[1] / heights)
+        resized = np.stack([np.floor(widths * scale + 0.5), np.floor(heights * scale + 0.5)], axis=1)
+        return buckets, resized.astype(np.int64)
+    steps = general.get("bucket_reso_steps", 64)
+    aspect = widths / heights
+
+    if general.get("bucket_no_upscale", False):
+        max_area = max_reso[0] * max_reso[1]
+        large = widths * heights > max_area
+        with np.errstate(divide="ignore", invalid="ignore"):
+            resized_width = np.sqrt(max_area * aspect)
+            resized_height = max_area / resized_width
+            width_rounded = _round_to_steps(resized_width, steps)
+            height_in_wr = _round_to_steps(width_rounded / aspect, steps)
+            ar_width_rounded = width_rounded / height_in_wr
+            height_rounded = _round_to_steps(resized_height, steps)
+            width_in_hr = _round_to_steps(height_rounded * aspect, steps)
+            ar_height_rounded = width_in_hr / height_rounded
+            use_width = np.abs(ar_width_rounded - aspect) < np.abs(ar_height_rounded - aspect)
+            large_width = np.where(use_width, width_rounded, np.floor(height_rounded * aspect + 0.5))
+            large_height = np.where(use_width, np.floor(width_rounded / aspect + 0.5), height_rounded)
+        resized = np.stack([np.where(large, large_width, widths), np.where(large, large_height, heights)], axis=1)
+        resized = resized.astype(np.int64)
+        return resized - resized % steps, resized
+
+    predefined = np.array(make_bucket_resolutions(max_reso, general.get("min_bucket_reso", 256),
+                                                  general.get("max_bucket_reso", 1024), steps), dtype=np.int64)
+    buckets = predefined[_nearest_aspect(predefined[:, 0] / predefined[:, 1], aspect)]
+    exact = np.isin(widths * 100000 + heights, predefined[:, 0] * 100000 + predefined[:, 1])
+    buckets[exact] = np.stack([widths[exact], heights[exact]], axis=1)
+    scale = np.where(aspect > buckets[:, 0] / buckets[:, 1], buckets[:, 1] / heights, buckets[:, 0] / widths)
+    resized = np.stack([np.floor(widths * scale + 0.5), np.floor(heights * scale + 0.5)], axis=1)
+    return buckets, resized.astype(np.int64)
+
+
+def balance_regularization(train_repeats: np.ndarray, reg_repeats: np.ndarray) -> np.ndarray:
+    """
+    sd-scripts registers regularization images until they match the number of training images,
+    first with their own num_repeats in order, then adding one repeat at a time round robin.
+    """
+    target = int(train_repeats.sum())
+    reg_repeats = reg_repeats.astype(np.int64).copy()
+    if target == 0 or len(reg_repeats) == 0:
+        return np.zeros_like(reg_repeats)
+    total = np.cumsum(reg_repeats)
+    if total[-1] >= target:
+        cutoff = int(np.argmax(total >= target))
+        reg_repeats[cutoff + 1:] = 0
+        return reg_repeats
+    remaining = target - int(total[-1])
+    reg_repeats += remaining // len(reg_repeats)
+    reg_repeats[:remaining % len(reg_repeats)] += 1
+    return reg_repeats
+
+
+def collect_images(subsets: list[dict], general: dict, workers: int = None) -> tuple[np.ndarray, ...]:
+    index = dataset_index.get_index()
+    default = _resolution(general)
+    widths, heights, repeats, is_reg = [], [], [], []
+    for subset in subsets:
+        if not os.path.isdir(subset.get('image_dir', "")):
+            print(f"skipping subset '{subset.get('image_dir', '')}', the folder does not exist")
+            continue
+        sizes = index.dimensions(subset['image_dir'], workers)
+        for name in index.image_files(subset['image_dir']):
+            width, height = sizes.get(name, default)
+            widths.append(width)
+            heights.append(height)
+            repeats.append(subset.get('num_repeats', 1))
+            is_reg.append(bool(subset.get('is_reg', False)))
+    return (np.array(widths, dtype=np.int64), np.array(heights, dtype=np.int64),
+            np.array(repeats, dtype=np.int64), np.array(is_reg, dtype=bool))
+
+
+def simulate(subsets: list[dict], general: dict, epochs: int = 1, gradient_accumulation_steps: int = 1,
+             workers: int = None) -> BucketSimulation:
+    widths, heights, repeats, is_reg = collect_images(subsets, general, workers)
+    return simulate_arrays(widths, heights, repeats, is_reg, general, epochs, gradient_accumulation_steps)
+
+
+def simulate_arrays(widths: np.ndarray, heights: np.ndarray, repeats: np.ndarray, is_reg: np.ndarray,
+                    general: dict, epochs: int = 1, gradient_accumulation_steps: int = 1,
+                    buckets: Union[np.ndarray, None] = None) -> BucketSimulation:
+    repeats = repeats.copy()
+    repeats[is_reg] = balance_regularization(repeats[~is_reg], repeats[is_reg])
+    if buckets is None:
+        buckets, _ = assign_buckets(widths, heights, general)
+    if len(buckets) == 0:
+        return BucketSimulation([], np.zeros(0, dtype=np.int64), general.get("batch_size", 1), epochs,
+                                gradient_accumulation_steps)
+    resolutions, inverse = np.unique(buckets, axis=0, return_inverse=True)
+    images = np.bincount(inverse.reshape(-1), weights=repeats, minlength=len(resolutions)).astype(np.int64)
+    keep = images > 0
+    return BucketSimulation([tuple(int(x) for x in reso) for reso in resolutions[keep]], images[keep],
+                            general.get("batch_size", 1), epochs, gradient_accumulation_steps)
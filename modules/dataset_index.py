@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union
+
+from modules import image_probe, tag_counter
+
+IMAGE_EXTENSIONS = {"png", "bmp", "gif", "jpeg", "jpg", "webp"}
+INDEX_PATH = Path("runtime_store/cache/dataset_index.sqlite")
+
+
+def is_image_file(name: str) -> bool:
+    return name.split(".")[-1].lower() in IMAGE_EXTENSIONS
+
+
+def hash_file(file: str) -> str:
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetIndex:
+    """
+    On-disk index of subset directories, stored in sqlite.
+
+    A directory is only listed again when its mtime changes, which makes image counting for unchanged
+    subsets a single stat call. Per-file tag counts are stored alongside the listing, and are only
+    re-read for caption files whose mtime or size changed since they were last read.
+    """
+
+    def __init__(self, path: Union[str, Path] = INDEX_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS directories ("
+                         "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "directory TEXT NOT NULL, name TEXT NOT NULL, mtime_ns INTEGER NOT NULL, "
+                         "size INTEGER NOT NULL, is_image INTEGER NOT NULL, tags TEXT, "
+                         "PRIMARY KEY (directory, name))")
+            conn.execute("CREATE TABLE IF NOT EXISTS tag_summaries ("
+                         "directory TEXT NOT NULL, extension TEXT NOT NULL, tags TEXT NOT NULL, "
+                         "PRIMARY KEY (directory, extension))")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+            for column, kind in (("width", "INTEGER"), ("height", "INTEGER"), ("content_hash", "TEXT")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE files ADD COLUMN {column} {kind}")
+
+    @contextmanager
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def normalize(directory: str) -> str:
+        return os.path.normcase(os.path.abspath(directory))
+
+    def refresh(self, directory: str, verify: bool = False) -> str:
+        """
+        Brings the index for a directory up to date, returning the key it is stored under.
+        When verify is set, every file is stat'd even if the directory mtime has not changed,
+        so captions edited in place are picked up.
+        """
+        key = self.normalize(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        with self.lock, self.connect() as conn:
+            row = conn.execute("SELECT mtime_ns FROM directories WHERE path = ?", (key,)).fetchone()
+            if row and row[0] == mtime and not verify:
+                return key
+            known = {name: (file_mtime, size) for name, file_mtime, size in conn.execute(
+                "SELECT name, mtime_ns, size FROM files WHERE directory = ?", (key,))}
+            seen = set()
+            changed = False
+            for entry in os.scandir(directory):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                seen.add(entry.name)
+                if known.get(entry.name) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                changed = True
+                conn.execute("INSERT OR REPLACE INTO files (directory, name, mtime_ns, size, is_image, tags, width, height, "
+                             "content_hash) VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL, NULL)",
+                             (key, entry.name, stat.st_mtime_ns, stat.st_size, is_image_file(entry.name)))
+            removed = [(key, name) for name in known if name not in seen]
+            if removed:
+                changed = True
+                conn.executemany("DELETE FROM files WHERE directory = ? AND name = ?", removed)
+            if changed:
+                conn.execute("DELETE FROM tag_summaries WHERE directory = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO directories (path, mtime_ns) VALUES (?, ?)", (key, mtime))
+        return key
+
+    def image_count(self, directory: str) -> int:
+        key = self.refresh(directory)
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM files WHERE directory = ? AND is_image = 1",
+                                (key,)).fetchone()[0]
+
+    def image_files(self, directory: str) -> list[str]:
+        key = self.refresh(directory)
+        with self.connect() as conn:
+            return [row[0] for row in conn.execute(
+                "SELECT name FROM files WHERE directory = ? AND is_image = 1 ORDER BY name", (key,))]
+
+    def dimensions(self, directory: str, workers: int = None) -> dict[str, tuple[int, int]]:
+        key = self.refresh(directory)
+        with self.connect() as conn:
+            rows = conn.execute("SELECT name, width, height FROM files WHERE directory = ? AND is_image = 1",
+                                (key,)).fetchall()
+        sizes = {name: (width, height) for name, width, height in rows if width is not None}
+        missing = [os.path.join(directory, name) for name, width, _ in rows if width is None]
+        updates = []
+        for file, size in image_probe.probe_files(missing, workers):
+            if size is None:
+                continue
+            sizes[os.path.basename(file)] = size
+            updates.append((size[0], size[1], key, os.path.basename(file)))
+        if updates:
+            with self.lock, self.connect() as conn:
+                conn.executemany("UPDATE files SET width = ?, height = ? WHERE directory = ? AND name = ?", updates)
+        return sizes
+
+    def content_hashes(self, directory: str, names: list[str] = None, workers: int = None) -> dict[str, str]:
+        """
+        Returns the sha1 of each file's contents, hashing only files that are new or changed since they were
+        last hashed. Defaults to every image in the directory.
+        """
+        key = self.refresh(directory, verify=True)
+        with self.connect() as conn:
+            rows = conn.execute("SELECT name, content_hash, is_image FROM files WHERE directory = ?",
+                                (key,)).fetchall()
+        wanted = set(names) if names is not None else {name for name, _, is_image in rows if is_image}
+        hashes = {name: content_hash for name, content_hash, _ in rows if name in wanted and content_hash}
+        missing = [name for name, content_hash, _ in rows if name in wanted and not content_hash]
+        if not missing:
+            return hashes
+        with ThreadPoolExecutor(max_workers=workers or min(16, (os.cpu_count() or 1) * 2)) as pool:
+            for name, content_hash in zip(missing, pool.map(hash_file, [os.path.join(directory, name)
+                                                                        for name in missing])):
+                hashes[name] = content_hash
+        with self.lock, self.connect() as conn:
+            conn.executemany("UPDATE files SET content_hash = ? WHERE directory = ? AND name = ?",
+                             [(hashes[name], key, name) for name in missing])
+        return hashes
+
+    def manifest(self, directory: str, caption_extension: str = ".txt") -> str:
+        """
+        Returns a hash of the name, size and mtime of every image and caption, which changes whenever one is
+        added, removed or edited. The .npz caches sd-scripts writes next to the images are left out, a job
+        caching to disk would change it just by running. It does not depend on where the directory is.
+        """
+        key = self.refresh(directory, verify=True)
+        with self.connect() as conn:
+            rows = conn.execute("SELECT name, size, mtime_ns, is_image FROM files WHERE directory = ? ORDER BY name",
+                                (key,)).fetchall()
+        rows = [[name, size, mtime] for name, size, mtime, is_image in rows
+                if is_image or os.path.splitext(name)[1] == caption_extension]
+        return hashlib.sha1(json.dumps(rows).encode("utf-8")).hexdigest()
+
+    def tag_counts(self, directory: str, caption_extension: str, workers: int = None) -> Counter:
+        return self.folder_tag_counts([(directory, caption_extension)], workers)[0]
+
+    def folder_tag_counts(self, folders: list[tuple[str, str]], workers: int = None) -> list[Counter]:
+        """
+        Returns the tag counts of each (directory, caption extension). The captions changed since they were last
+        read, in every folder, are read together so they share one pool.
+        """
+        totals = []
+        # the folders without a summary, and the captions to read, with the position of each folder they are in
+        summaries = {}
+        stale = {}
+        for position, (directory, caption_extension) in enumerate(folders):
+            key = self.refresh(directory, verify=True)
+            total = Counter()
+            totals.append(total)
+            with self.connect() as conn:
+                row = conn.execute("SELECT tags FROM tag_summaries WHERE directory = ? AND extension = ?",
+                                   (key, caption_extension)).fetchone()
+                if row:
+                    total.update(json.loads(row[0]))
+                    continue
+                rows = conn.execute("SELECT name, tags FROM files WHERE directory = ?", (key,)).fetchall()
+            summaries[(key, caption_extension)] = position
+            for name, tags in rows:
+                if os.path.splitext(name)[1] != caption_extension:
+                    continue
+                if tags is None:
+                    stale.setdefault(os.path.join(directory, name), []).append(position)
+                    continue
+                total.update(json.loads(tags))
+        if not summaries:
+            return totals
+        updates = []
+        for file, file_tags in tag_counter.read_tag_files(list(stale), workers):
+            if file_tags is None:
+                continue
+            for position in stale[file]:
+                totals[position].update(file_tags)
+            updates.append((json.dumps(file_tags), self.normalize(os.path.dirname(file)), os.path.basename(file)))
+        with self.lock, self.connect() as conn:
+            conn.executemany("UPDATE files SET tags = ? WHERE directory = ? AND name = ?", updates)
+            conn.executemany("INSERT OR REPLACE INTO tag_summaries (directory, extension, tags) VALUES (?, ?, ?)",
+                             [(key, extension, json.dumps(totals[position]))
+                              for (key, extension), position in summaries.items()])
+        return totals
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> DatasetIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = DatasetIndex()
+        return _index
+
+
+def subset_tag_counts(subsets: list[dict], workers: int = None) -> Counter:
+    folders = [(subset['image_dir'], subset['caption_extension']) for subset in subsets
+               if os.path.isdir(subset['image_dir'])]
+    tags = Counter()
+    for counts in get_index().folder_tag_counts(folders, workers):
+        tags.update(counts)
+    return tags
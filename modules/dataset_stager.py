@@ -0,0 +1,171 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Union
+
+META_FILE = ".stage.json"
+
+
+class DatasetStager:
+    """
+    Copies the subsets of the job about to start and of the next queue item onto a fast local path, the next
+    one in the background while the current job trains, then points the job's image_dir at the staged copy.
+    Subsets on the same drive as the stage location are read in place, a copy there would be no faster.
+
+    Stages are kept between jobs and refreshed file by file, and the least recently used ones are evicted to
+    stay within the disk budget. Stages in use by a running job, or prefetched for one that has not started
+    yet, are never evicted.
+    """
+
+    def __init__(self, root: Union[str, Path], budget_bytes: int) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.budget = budget_bytes
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.futures: dict[str, Future] = {}
+        # how many running jobs use each stage
+        self.pinned: Counter = Counter()
+
+    @staticmethod
+    def key(directory: str) -> str:
+        return hashlib.sha1(os.path.normcase(os.path.abspath(directory)).encode("utf-8")).hexdigest()[:16]
+
+    def stage_path(self, directory: str) -> Path:
+        return self.root.joinpath(self.key(directory))
+
+    def prefetch(self, subsets: list[dict]) -> None:
+        """
+        Starts staging the subsets in the background, after the ones already asked for.
+        """
+        with self.lock:
+            for subset in subsets:
+                directory = subset.get('image_dir', "")
+                if not os.path.isdir(directory) or directory in self.futures:
+                    continue
+                self.futures[directory] = self.pool.submit(self._stage, directory)
+
+    def rewrite(self, dataset_args: dict) -> dict:
+        """
+        Returns a copy of the validated dataset args with every subset pointed at its staged copy, waiting for
+        the ones still being staged, and staging the ones that were never prefetched.
+        """
+        dataset_args = copy.deepcopy(dataset_args)
+        self.prefetch(dataset_args['subsets'])
+        for subset in dataset_args['subsets']:
+            directory = subset['image_dir']
+            with self.lock:
+                future = self.futures.pop(directory, None)
+                if future is None:
+                    continue
+                # pinned before it stops being a prefetch, so the stage after it can't evict it
+                name = self.key(directory)
+                self.pinned[name] += 1
+            try:
+                staged = future.result()
+            except OSError as e:
+                print(f"Failed to stage {directory}, reading it in place: {e}")
+                staged = None
+            if staged is None:
+                self._unpin(name)
+                continue
+            self._touch(staged)
+            print(f"using staged copy of {subset['image_dir']} at {staged}")
+            subset['image_dir'] = str(staged)
+        return dataset_args
+
+    def release(self, dataset_args: dict = None) -> None:
+        if dataset_args is None:
+            with self.lock:
+                self.pinned.clear()
+            return
+        for subset in dataset_args['subsets']:
+            staged = Path(subset['image_dir'])
+            if staged.parent == self.root:
+                self._unpin(staged.name)
+
+    def _unpin(self, name: str) -> None:
+        with self.lock:
+            self.pinned[name] -= 1
+            if self.pinned[name] <= 0:
+                del self.pinned[name]
+
+    def _touch(self, staged: Path) -> None:
+        meta_file = staged.joinpath(META_FILE)
+        meta = json.loads(meta_file.read_text(encoding="utf-8"))
+        meta['last_used'] = time.time()
+        meta_file.write_text(json.dumps(meta), encoding="utf-8")
+
+    def _stage(self, directory: str) -> Union[Path, None]:
+        if os.stat(directory).st_dev == os.stat(self.root).st_dev:
+            print(f"{directory} is on the same drive as the stage location, it will be read in place")
+            return None
+        files = [entry for entry in os.scandir(directory) if entry.is_file()]
+        size = sum(entry.stat().st_size for entry in files)
+        if size > self.budget:
+            print(f"{directory} is larger than the staging budget, it will be read in place")
+            return None
+        staged = self.stage_path(directory)
+        self._evict(size, staged.name)
+        staged.mkdir(exist_ok=True)
+        existing = {entry.name: entry.stat() for entry in os.scandir(staged)
+                    if entry.is_file() and entry.name != META_FILE}
+        names = set()
+        for entry in files:
+            names.add(entry.name)
+            stat = entry.stat()
+            current = existing.get(entry.name)
+            if current and current.st_size == stat.st_size and current.st_mtime_ns == stat.st_mtime_ns:
+                continue
+            target = staged.joinpath(entry.name)
+            if target.exists():
+                target.unlink()
+            shutil.copy2(entry.path, target)
+        for name in existing:
+            if name not in names:
+                staged.joinpath(name).unlink()
+        staged.joinpath(META_FILE).write_text(json.dumps({
+            "source": os.path.abspath(directory), "size": size, "last_used": time.time()
+        }), encoding="utf-8")
+        return staged
+
+    def _evict(self, needed: int, keep: str) -> None:
+        """
+        Removes the least recently used stages until needed fits in the budget, keeping keep, the ones pinned by
+        a running job and the ones prefetched for a job that has not started.
+        """
+        stages = []
+        for entry in os.scandir(self.root):
+            meta_file = Path(entry.path, META_FILE)
+            if not entry.is_dir() or not meta_file.exists():
+                continue
+            meta = json.loads(meta_file.read_text(encoding="utf-8"))
+            stages.append((meta.get('last_used', 0), meta.get('size', 0), entry.name))
+        used = sum(stage[1] for stage in stages if stage[2] != keep)
+        for _, size, name in sorted(stages):
+            if used + needed <= self.budget:
+                break
+            with self.lock:
+                if name == keep or name in self.pinned or name in {self.key(source) for source in self.futures}:
+                    continue
+            print(f"evicting staged dataset {name} to stay within the staging budget")
+            shutil.rmtree(self.root.joinpath(name), ignore_errors=True)
+            used -= size
+
+
+def from_config(config_file: str = "config.json") -> Union[DatasetStager, None]:
+    if not os.path.exists(config_file):
+        return None
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    location = config.get("stage_location", "")
+    if not location:
+        return None
+    return DatasetStager(location, int(float(config.get("stage_budget_gb", 50)) * (1 << 30)))
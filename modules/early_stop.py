@@ -0,0 +1,96 @@
+"""
+Stops a training run once its loss stops improving, configured per job in the saving args:
+
+    [saving_args.args.early_stop]
+    patience = 500          # stop when avr_loss has not improved by min_delta for this many steps, 0 is off
+    min_delta = 0.001
+    ceiling = 0.15          # stop when avr_loss is still above this once warmup_steps have passed, 0 is off
+    warmup_steps = 300
+
+sd-scripts' avr_loss is already a running mean of the step losses, so it is compared as is. A run is never killed
+in the middle of writing a model: once the policy triggers, the trainer is interrupted at the first step after its
+next save, and that save is the job's result. Jobs without save_every_n_epochs or save_every_n_steps have no save
+to stop after, they are left to finish and only the reason is reported.
+"""
+import math
+import os
+import signal
+from typing import Union
+
+from modules import supervisor
+
+
+class EarlyStop:
+    def __init__(self, patience: int = 0, min_delta: float = 0.0, ceiling: float = 0.0, warmup_steps: int = 0,
+                 saves: bool = True) -> None:
+        self.patience = patience
+        self.min_delta = min_delta
+        self.ceiling = ceiling
+        self.warmup_steps = warmup_steps
+        self.saves = saves
+        self.best = math.inf
+        self.best_step = 0
+        self.reason: Union[str, None] = None
+        self.saved: Union[str, None] = None
+        self.pid: Union[int, None] = None
+        self.stopped = False
+
+    def check(self, step: int, loss: float) -> Union[str, None]:
+        if not math.isfinite(loss):
+            return None
+        if loss < self.best - self.min_delta:
+            self.best = loss
+            self.best_step = step
+        if step < self.warmup_steps:
+            return None
+        if self.ceiling and loss > self.ceiling:
+            return f"avr_loss {loss:.4f} is above the ceiling of {self.ceiling} after {step} steps"
+        if self.patience and step - self.best_step >= self.patience:
+            return f"avr_loss has not improved by {self.min_delta} in {step - self.best_step} steps " \
+                   f"(best {self.best:.4f} at step {self.best_step})"
+        return None
+
+    def observe(self, event: supervisor.ProgressEvent) -> bool:
+        """
+        Feeds one trainer event through the policy, returns True when the trainer should be stopped now.
+        """
+        if self.stopped:
+            return False
+        if event.kind == "save" and self.reason:
+            self.saved = event.path
+            return False
+        if event.kind != "step":
+            return False
+        if self.reason:
+            # the step after a save means the save finished writing
+            return self.saved is not None
+        if event.loss is None:
+            return False
+        self.reason = self.check(event.step, event.loss)
+        if self.reason:
+            if self.saves:
+                print(f"\nearly stop: {self.reason}, stopping after the next save")
+            else:
+                print(f"\nearly stop: {self.reason}, but the job has no periodic saves, letting it finish")
+        return False
+
+    def on_event(self, event: supervisor.ProgressEvent) -> None:
+        if self.observe(event) and self.pid:
+            print(f"\nearly stop: stopping the trainer, {self.saved} is the result")
+            self.stopped = True
+            os.kill(self.pid, signal.SIGINT if os.name != "nt" else signal.SIGTERM)
+
+    def summary(self) -> str:
+        return f"stopped early, {self.reason}, result saved as {self.saved}"
+
+
+def from_args(base_args: dict, args: dict) -> Union[EarlyStop, None]:
+    """
+    Builds the policy from the job's saved args, args being its validated sd-scripts args.
+    """
+    policy = (base_args or {}).get("saving_args", {}).get("args", {}).get("early_stop")
+    if not policy or not (policy.get("patience") or policy.get("ceiling")):
+        return None
+    saves = bool(args.get("save_every_n_epochs") or args.get("save_every_n_steps"))
+    return EarlyStop(int(policy.get("patience", 0)), float(policy.get("min_delta", 0.0)),
+                     float(policy.get("ceiling", 0.0)), int(policy.get("warmup_steps", 0)), saves)
@@ -0,0 +1,108 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, Union
+
+# SOF markers carry the frame size, DHT (C4), JPG (C8) and DAC (CC) share the range but do not
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_JPEG_NO_LENGTH = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def _png(head: bytes) -> Union[tuple[int, int], None]:
+    if len(head) < 24 or head[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", head[16:24])
+
+
+def _gif(head: bytes) -> Union[tuple[int, int], None]:
+    if len(head) < 10:
+        return None
+    return struct.unpack("<HH", head[6:10])
+
+
+def _bmp(head: bytes) -> Union[tuple[int, int], None]:
+    if len(head) < 26:
+        return None
+    header_size = struct.unpack("<I", head[14:18])[0]
+    if header_size == 12:
+        return struct.unpack("<HH", head[18:22])
+    width, height = struct.unpack("<ii", head[18:26])
+    return abs(width), abs(height)
+
+
+def _webp(head: bytes) -> Union[tuple[int, int], None]:
+    chunk = head[12:16]
+    if chunk == b"VP8 " and len(head) >= 30 and head[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(head) >= 25 and head[20] == 0x2F:
+        bits = struct.unpack("<I", head[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(head) >= 30:
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def _jpeg(f: BinaryIO) -> Union[tuple[int, int], None]:
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in _JPEG_NO_LENGTH:
+            continue
+        if marker == 0xD9:
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack(">H", length)[0]
+        if marker in _JPEG_SOF:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack(">HH", data[1:5])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def probe_image(file: str) -> Union[tuple[int, int], None]:
+    """
+    Returns the (width, height) of an image by reading only its header,
+    or None if the format is not recognised or the header is truncated.
+    """
+    try:
+        with open(file, "rb") as f:
+            head = f.read(32)
+            if head.startswith(b"\x89PNG\r\n\x1a\n"):
+                return _png(head)
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                return _gif(head)
+            if head.startswith(b"BM"):
+                return _bmp(head)
+            if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+                return _webp(head)
+            if head.startswith(b"\xff\xd8"):
+                return _jpeg(f)
+    except OSError as e:
+        print(f"Failed to read image header of {file}: {e}")
+    return None
+
+
+def probe_files(files: Iterable[str], workers: int = None) -> Iterator[tuple[str, Union[tuple[int, int], None]]]:
+    # header reads are io bound, so threads overlap the latency of network storage well
+    files = list(files)
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        yield from zip(files, pool.map(probe_image, files))
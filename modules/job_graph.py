@@ -0,0 +1,113 @@
+"""
+Queue items can wait for other jobs and train on what they produced, declared in the item's toml:
+
+    [[depends]]
+    job = "lowres"          # the parent, by its queue name, the file name for the headless runner
+    use = "resume"          # continue from the parent's saved state, needs save_state on the parent
+    # use = "network_weights"  start from the parent's model, leave use out to only wait for it
+
+A job is claimed once every parent finished, with each parent's output set as its resume or network_weights.
+Jobs that don't depend on each other run in parallel when there are free slots. When a parent fails, or is not
+in the queue at all, its children are cancelled, and theirs after them. Jobs that only wait on each other are
+cancelled as well.
+
+The UI trains its queue in order, a parent has to be above its children there.
+"""
+import copy
+import os
+from typing import Union
+
+from modules import job_store
+
+# where each use is set in the saved args
+USES = {"resume": "saving_args", "network_weights": "network_args"}
+
+
+def parents(base_args: Union[dict, None]) -> list[dict]:
+    depends = (base_args or {}).get("depends", [])
+    return [depends] if isinstance(depends, dict) else depends
+
+
+def state_dir(output: str) -> str:
+    """
+    The state sd-scripts saves next to a model with save_state on.
+    """
+    return f"{os.path.splitext(output)[0]}-state"
+
+
+def substitute(base_args: dict, outputs: list[tuple[dict, str]]) -> tuple[Union[dict, None], Union[str, None]]:
+    """
+    Returns a copy of the args with the parents' outputs set, or the reason one can't be used.
+    """
+    base_args = copy.deepcopy(base_args)
+    base_args.pop("depends", None)
+    for parent, output in outputs:
+        use = parent.get("use")
+        if not use:
+            continue
+        if use not in USES:
+            return None, f"cancelled, {parent['job']} can't be used as {use}, only as {' or '.join(USES)}"
+        path = state_dir(output) if use == "resume" else output
+        if not os.path.exists(path):
+            return None, f"cancelled, {path} from {parent['job']} does not exist"
+        base_args.setdefault(USES[use], {}).setdefault("args", {})[use] = path
+    return base_args, None
+
+
+def check(store: job_store.JobStore, queue: str,
+          base_args: Union[dict, None]) -> tuple[Union[dict, None], Union[str, None]]:
+    """
+    Returns the args to train with once every parent finished, None while one is still queued or training, and
+    the reason to cancel the job when one failed or can't be found.
+    """
+    needs = parents(base_args)
+    if not needs:
+        return base_args, None
+    if any(not isinstance(parent, dict) or not parent.get("job") for parent in needs):
+        return None, "cancelled, every [[depends]] needs the job it waits for"
+    states = store.latest([parent["job"] for parent in needs], queue)
+    outputs = []
+    waiting = False
+    for parent in needs:
+        state, output = states.get(parent["job"], (None, None))
+        if state is None:
+            return None, f"cancelled, it depends on {parent['job']} which is not in the queue"
+        if state == job_store.FAILED:
+            return None, f"cancelled, {parent['job']} failed"
+        if state in (job_store.PENDING, job_store.RUNNING):
+            waiting = True
+        elif parent.get("use") and not output:
+            return None, f"cancelled, {parent['job']} finished without a model to use"
+        outputs.append((parent, output))
+    if waiting:
+        return None, None
+    return substitute(base_args, outputs)
+
+
+def claim(store: job_store.JobStore, queue: str) -> tuple[Union[tuple[str, str, dict], None], bool]:
+    """
+    Claims the first pending job whose parents all finished, and returns its key, name and args to train with,
+    and whether there are jobs still waiting for a parent that is training.
+    """
+    while True:
+        waiting = []
+        for key, name, base_args in store.pending(queue):
+            ready, reason = check(store, queue, base_args)
+            if reason:
+                print(f"[{name}] {reason}")
+                store.finish(key, False, reason)
+                # its own children can be cancelled now, start over
+                break
+            if ready is None and parents(base_args):
+                waiting.append((key, name))
+            elif store.claim(key):
+                return (key, name, ready), bool(waiting)
+        else:
+            if waiting and not store.counts(queue).get(job_store.RUNNING):
+                # nothing is training that could finish their parents, they wait on each other
+                reason = "cancelled, its dependencies wait on each other"
+                for key, name in waiting:
+                    print(f"[{name}] {reason}")
+                    store.finish(key, False, reason)
+                continue
+            return None, bool(waiting)
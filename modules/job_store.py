@@ -0,0 +1,223 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Union
+
+STORE_PATH = Path("runtime_store/queue/jobs.sqlite")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobStore:
+    """
+    Durable training queue, stored in sqlite.
+
+    Every queue item is a row holding its saved args, its priority, its state, how many times it was started,
+    when it was queued, started and finished, the validated config it was trained with, its final loss and the
+    model it produced. Jobs left running by a crash are put back to pending by recover(), so a restarted queue
+    picks up from the first unfinished job.
+
+    The UI and the headless runner keep separate queues in the same store.
+    """
+
+    def __init__(self, path: Union[str, Path] = STORE_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "key TEXT PRIMARY KEY, queue TEXT NOT NULL, name TEXT NOT NULL, position INTEGER NOT NULL, "
+                         "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, base_args TEXT, config TEXT, "
+                         "error TEXT, created REAL NOT NULL, started REAL, finished REAL, loss REAL, output TEXT, "
+                         "priority INTEGER NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column, kind in (("loss", "REAL"), ("output", "TEXT"), ("priority", "INTEGER NOT NULL DEFAULT 0")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_order ON jobs (queue, state, position)")
+
+    @contextmanager
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, key: str, name: str, base_args: dict = None, queue: str = "ui") -> None:
+        self.add_many([(key, name, base_args)], queue)
+
+    def add_many(self, entries: Iterable[tuple[str, str, dict]], queue: str = "ui", replace: bool = True) -> int:
+        """
+        Adds jobs to the end of the queue and returns how many were added. With replace off, keys that are
+        already in the store, in any state, are left alone.
+        """
+        with self.lock, self.connect() as conn:
+            position = conn.execute("SELECT COALESCE(MAX(position), -1) FROM jobs WHERE queue = ?",
+                                    (queue,)).fetchone()[0]
+            rows = []
+            for key, name, base_args in entries:
+                position += 1
+                rows.append((key, queue, name, position, PENDING,
+                             json.dumps(base_args) if base_args is not None else None, time.time()))
+            before = conn.total_changes
+            conn.executemany(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO jobs "
+                             "(key, queue, name, position, state, base_args, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             rows)
+            return conn.total_changes - before
+
+    def save(self, key: str, base_args: dict) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("UPDATE jobs SET base_args = ? WHERE key = ?", (json.dumps(base_args), key))
+
+    def load(self, key: str) -> Union[dict, None]:
+        with self.connect() as conn:
+            row = conn.execute("SELECT base_args FROM jobs WHERE key = ?", (key,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def set_priority(self, key: str, priority: int) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("UPDATE jobs SET priority = ? WHERE key = ?", (priority, key))
+
+    def priorities(self, keys: list[str]) -> dict[str, int]:
+        priorities = {}
+        with self.connect() as conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                priorities.update(conn.execute(f"SELECT key, priority FROM jobs WHERE key IN "
+                                               f"({', '.join('?' * len(chunk))})", chunk))
+        return priorities
+
+    def remove(self, key: str) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE key = ?", (key,))
+
+    def reorder(self, keys: list[str]) -> None:
+        with self.lock, self.connect() as conn:
+            conn.executemany("UPDATE jobs SET position = ? WHERE key = ?",
+                             [(position, key) for position, key in enumerate(keys)])
+
+    def recover(self, queue: str = "ui") -> int:
+        """
+        Puts jobs that were left running, because the process running them died, back to pending.
+        """
+        with self.lock, self.connect() as conn:
+            return conn.execute("UPDATE jobs SET state = ?, started = NULL WHERE queue = ? AND state = ?",
+                                (PENDING, queue, RUNNING)).rowcount
+
+    def unfinished(self, queue: str = "ui") -> list[tuple[str, str]]:
+        with self.connect() as conn:
+            return conn.execute("SELECT key, name FROM jobs WHERE queue = ? AND state IN (?, ?) "
+                                "ORDER BY position", (queue, PENDING, RUNNING)).fetchall()
+
+    def pending(self, queue: str = "ui") -> list[tuple[str, str, Union[dict, None]]]:
+        with self.connect() as conn:
+            rows = conn.execute("SELECT key, name, base_args FROM jobs WHERE queue = ? AND state = ? ORDER BY position",
+                                (queue, PENDING)).fetchall()
+        return [(key, name, json.loads(base_args) if base_args else None) for key, name, base_args in rows]
+
+    def claim(self, key: str) -> bool:
+        """
+        Marks the job as running if it is still pending, returns False when something else claimed it first.
+        """
+        with self.lock, self.connect() as conn:
+            return conn.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ?, finished = NULL, "
+                                "error = NULL WHERE key = ? AND state = ?",
+                                (RUNNING, time.time(), key, PENDING)).rowcount == 1
+
+    def start(self, key: str) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ?, finished = NULL, "
+                         "error = NULL WHERE key = ?", (RUNNING, time.time(), key))
+
+    def config(self, key: str) -> Union[dict, None]:
+        """
+        The validated config the job was last launched with, if it was launched before.
+        """
+        with self.connect() as conn:
+            row = conn.execute("SELECT config FROM jobs WHERE key = ?", (key,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def record_config(self, key: str, args: dict, dataset_args: dict) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("UPDATE jobs SET config = ? WHERE key = ?",
+                         (json.dumps({"args": args, "dataset_args": dataset_args}, default=str), key))
+
+    def finish(self, key: str, success: bool, error: str = None, loss: float = None, output: str = None) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("UPDATE jobs SET state = ?, finished = ?, error = ?, loss = ?, output = ? WHERE key = ?",
+                         (DONE if success else FAILED, time.time(), error, loss, output, key))
+
+    def results(self, keys: list[str]) -> dict[str, tuple[str, Union[float, None]]]:
+        """
+        Returns the state and final loss of each of these keys that is in the store.
+        """
+        results = {}
+        with self.connect() as conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(f"SELECT key, state, loss FROM jobs WHERE key IN ({', '.join('?' * len(chunk))})",
+                                    chunk)
+                results.update((key, (state, loss)) for key, state, loss in rows)
+        return results
+
+    def latest(self, names: list[str], queue: str = "ui") -> dict[str, tuple[str, Union[str, None]]]:
+        """
+        Returns the state and output of the last queued job of each of these names.
+        """
+        latest = {}
+        with self.connect() as conn:
+            for name in names:
+                # positions are reused by reordering, the queue time tells runs of the same name apart
+                row = conn.execute("SELECT state, output FROM jobs WHERE queue = ? AND name = ? "
+                                   "ORDER BY created DESC, position DESC LIMIT 1", (queue, name)).fetchone()
+                if row:
+                    latest[name] = (row[0], row[1])
+        return latest
+
+    def clear_pending(self, queue: str = "ui", keys: list[str] = None) -> int:
+        """
+        Removes the pending jobs of the queue, only the ones in keys when given.
+        """
+        with self.lock, self.connect() as conn:
+            if keys is None:
+                return conn.execute("DELETE FROM jobs WHERE queue = ? AND state = ?", (queue, PENDING)).rowcount
+            removed = 0
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                removed += conn.execute(f"DELETE FROM jobs WHERE queue = ? AND state = ? AND key IN "
+                                        f"({', '.join('?' * len(chunk))})", [queue, PENDING, *chunk]).rowcount
+            return removed
+
+    def retry_failed(self, queue: str = "ui") -> int:
+        with self.lock, self.connect() as conn:
+            return conn.execute("UPDATE jobs SET state = ? WHERE queue = ? AND state = ?",
+                                (PENDING, queue, FAILED)).rowcount
+
+    def counts(self, queue: str = "ui") -> dict[str, int]:
+        with self.connect() as conn:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state", (queue,)))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> JobStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = JobStore()
+        return _store
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union
+
+from modules import bucket_simulator, dataset_index
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_DIR = Path("runtime_store/cache/latents")
+TE_OUTPUTS_SUFFIX = "_te_outputs.npz"
+# linux ioctl cloning a whole file
+FICLONE = 0x40049409
+
+
+def _file_identity(path: str) -> list:
+    # hashing multi-gigabyte checkpoints before every job would cost more than the encoding it saves,
+    # so local files are identified by path, size and mtime, and hub ids by name
+    if not path:
+        return []
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    return [path]
+
+
+def _clone(source: Path, target: Path) -> bool:
+    """
+    Makes target a copy-on-write clone of source on file systems that support it, btrfs and xfs, which costs no
+    space or I/O until one of them is written.
+    """
+    if fcntl is None:
+        return False
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+        return False
+    shutil.copystat(source, target)
+    return True
+
+
+def _make_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LatentCache:
+    """
+    Content addressed store for the latent and text encoder output .npz files sd-scripts writes next to images.
+
+    Before a job launches, entries whose key matches an image are copied into place so sd-scripts finds a
+    valid cache and skips encoding them. After the job, every .npz it wrote is copied back to the store. Files
+    are never shared with the store, sd-scripts rewrites a cache it finds invalid in place, which would change
+    the entry of every other job using it. Placements are tracked so a copy left behind by a job with other
+    settings is removed before the next job is given its own.
+    """
+
+    def __init__(self, root: Union[str, Path] = CACHE_DIR) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.db = self.root.joinpath("latent_cache.sqlite")
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS placements ("
+                         "path TEXT PRIMARY KEY, key TEXT NOT NULL, mtime_ns INTEGER NOT NULL)")
+
+    @contextmanager
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def entry(self, key: str) -> Path:
+        return self.root.joinpath(key[:2], f"{key}.npz")
+
+    @staticmethod
+    def _copy(source: Path, target: Path) -> None:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+        if not _clone(source, temp):
+            shutil.copy2(source, temp)
+        os.replace(temp, target)
+
+    def plan(self, args: dict, dataset_args: dict, script: str) -> list[tuple[Path, str]]:
+        if not args.get("cache_latents_to_disk") and not args.get("cache_text_encoder_outputs_to_disk"):
+            return []
+        index = dataset_index.get_index()
+        general = dataset_args['general']
+        model = _file_identity(args.get("pretrained_model_name_or_path", ""))
+        vae = _file_identity(args.get("vae", "")) or model
+        output = []
+        for subset in dataset_args['subsets']:
+            directory = subset['image_dir']
+            sizes = index.dimensions(directory)
+            names = [name for name in index.image_files(directory) if name in sizes]
+            if not names:
+                continue
+            if args.get("cache_latents_to_disk"):
+                hashes = index.content_hashes(directory, names)
+                buckets, resized = bucket_simulator.assign_buckets([sizes[n][0] for n in names],
+                                                                   [sizes[n][1] for n in names], general)
+                for name, bucket, size in zip(names, buckets.tolist(), resized.tolist()):
+                    key = _make_key("latents", script, hashes[name], bucket, size, vae,
+                                    bool(subset.get("flip_aug", False)))
+                    output.append((Path(directory, f"{os.path.splitext(name)[0]}.npz"), key))
+            if args.get("cache_text_encoder_outputs_to_disk"):
+                extension = subset.get("caption_extension", ".txt")
+                captions = {name: f"{os.path.splitext(name)[0]}{extension}" for name in names}
+                caption_hashes = index.content_hashes(directory, list(captions.values()))
+                for name in names:
+                    key = _make_key("text_encoder_outputs", script, caption_hashes.get(captions[name], ""), model,
+                                    args.get("max_token_length", 75), args.get("clip_skip"))
+                    output.append((Path(directory, f"{os.path.splitext(name)[0]}{TE_OUTPUTS_SUFFIX}"), key))
+        return output
+
+    def link_into_place(self, plan: list[tuple[Path, str]]) -> tuple[int, int]:
+        with self.connect() as conn:
+            placements = {path: (key, mtime) for path, key, mtime in
+                          conn.execute("SELECT path, key, mtime_ns FROM placements")}
+        hits = 0
+        updates = []
+        for target, key in plan:
+            placed = placements.get(str(target))
+            if target.exists():
+                if placed and placed == (key, target.stat().st_mtime_ns):
+                    hits += 1
+                    continue
+                if placed and placed[0] != key:
+                    target.unlink()
+            entry = self.entry(key)
+            if not entry.exists():
+                continue
+            self._copy(entry, target)
+            updates.append((str(target), key, target.stat().st_mtime_ns))
+            hits += 1
+        with self.lock, self.connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO placements (path, key, mtime_ns) VALUES (?, ?, ?)", updates)
+        return hits, len(plan) - hits
+
+    def collect(self, plan: list[tuple[Path, str]], started_ns: int) -> int:
+        with self.connect() as conn:
+            placements = {path: (key, mtime) for path, key, mtime in
+                          conn.execute("SELECT path, key, mtime_ns FROM placements")}
+        stored = 0
+        updates = []
+        for target, key in plan:
+            if not target.exists():
+                continue
+            mtime = target.stat().st_mtime_ns
+            if placements.get(str(target)) == (key, mtime):
+                continue
+            # only files written by this job are known to match its key
+            if mtime < started_ns:
+                continue
+            # replaces the entry as well, sd-scripts only rewrites a placed copy it found invalid
+            self._copy(target, self.entry(key))
+            stored += 1
+            updates.append((str(target), key, target.stat().st_mtime_ns))
+        with self.lock, self.connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO placements (path, key, mtime_ns) VALUES (?, ?, ?)", updates)
+        return stored
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> LatentCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LatentCache()
+        return _cache
+
+
+def prepare(args: dict, dataset_args: dict, script: str) -> list[tuple[Path, str]]:
+    cache = get_cache()
+    plan = cache.plan(args, dataset_args, script)
+    if plan:
+        hits, misses = cache.link_into_place(plan)
+        print(f"latent cache: reusing {hits} cached files, {misses} left to encode")
+    return plan
+
+
+def collect(plan: list[tuple[Path, str]], started_ns: int) -> None:
+    if not plan:
+        return
+    stored = get_cache().collect(plan, started_ns)
+    if stored:
+        print(f"latent cache: stored {stored} new files")
@@ -0,0 +1,48 @@
+"""
+When a trainer runs out of GPU memory, the job is started again with settings that need less of it, one step of
+the ladder at a time, until it fits or nothing is left to try:
+
+    1. halve batch_size and double gradient_accumulation_steps, repeated while batch_size is even, which keeps
+       the effective batch the same
+    2. gradient_checkpointing
+    3. cache_latents, unless a subset uses color_aug or random_crop, which sd-scripts can't cache
+    4. full_bf16, with bf16 mixed precision
+
+Add "oom_fallback": false to config.json to fail such jobs instead.
+"""
+import json
+import os
+from typing import Union
+
+
+def enabled(config_file: str = "config.json") -> bool:
+    if not os.path.exists(config_file):
+        return True
+    with open(config_file, 'r') as f:
+        return json.load(f).get("oom_fallback", True)
+
+
+def next_step(args: dict, dataset_args: dict) -> Union[str, None]:
+    """
+    Applies the next step of the ladder to the job's validated args, and returns what it changed, or None when
+    every step has been taken.
+    """
+    general = dataset_args["general"]
+    batch_size = general.get("batch_size", 1)
+    if batch_size > 1 and batch_size % 2 == 0:
+        general["batch_size"] = batch_size // 2
+        args["gradient_accumulation_steps"] = args.get("gradient_accumulation_steps", 1) * 2
+        return f"batch_size {general['batch_size']} and gradient_accumulation_steps " \
+               f"{args['gradient_accumulation_steps']}"
+    if not args.get("gradient_checkpointing"):
+        args["gradient_checkpointing"] = True
+        return "gradient_checkpointing"
+    augmented = any(subset.get("color_aug") or subset.get("random_crop") for subset in dataset_args["subsets"])
+    if not args.get("cache_latents") and not args.get("cache_latents_to_disk") and not augmented:
+        args["cache_latents"] = True
+        return "cache_latents"
+    if not args.get("full_bf16") and not args.get("full_fp16"):
+        args["full_bf16"] = True
+        args["mixed_precision"] = "bf16"
+        return "full_bf16"
+    return None
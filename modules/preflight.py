@@ -0,0 +1,144 @@
+import copy
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Union
+
+from modules import dataset_index, run_history, training, validator
+
+
+class PreflightResult:
+    def __init__(self, key: str, valid: bool, output: str, steps: int = None, script: str = None,
+                 error: str = None, fingerprint: str = None) -> None:
+        self.key = key
+        self.valid = valid
+        self.output = output
+        self.steps = steps
+        self.script = script
+        self.error = error
+        self.fingerprint = fingerprint
+
+    def __str__(self) -> str:
+        if self.valid:
+            steps = f"{self.steps} steps" if self.steps is not None else "unknown steps"
+            return f"OK      {self.key}: {self.script}, {steps}"
+        lines = [f"FAILED  {self.key}: {self.error or 'invalid args'}"]
+        lines.extend(f"            {line}" for line in self.output.splitlines()
+                     if line and not line.startswith("starting validation"))
+        return "\n".join(lines)
+
+
+class _ThreadOutput(io.TextIOBase):
+    """
+    Stands in for sys.stdout while the preflight runs, so each worker thread's validation messages end up in
+    that item's report instead of interleaved on the console.
+    """
+
+    def __init__(self, target) -> None:
+        super(_ThreadOutput, self).__init__()
+        self.target = target
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.target.write(text)
+        return buffer.write(text)
+
+    def flush(self) -> None:
+        self.target.flush()
+
+
+_cache: dict[str, tuple[dict, dict, str, str]] = {}
+_cache_lock = threading.Lock()
+
+
+def cache_key(base_args: dict, runtime_only: bool) -> str:
+    text = json.dumps(base_args, sort_keys=True, default=str) + str(runtime_only)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def lookup(base_args: dict, runtime_only: bool = False, name: str = "") -> Union["training.Job", None]:
+    """
+    Returns the job a preflight already validated for exactly these args, or None. Files that only exist at
+    launch time (existing outputs, tag reports, auto saved tomls) are still handled by training.finish_job.
+    """
+    with _cache_lock:
+        cached = _cache.pop(cache_key(base_args, runtime_only), None)
+    if cached is None:
+        return None
+    args, dataset_args, script, job_fingerprint = cached
+    job = training.Job(args, dataset_args, script, base_args, name)
+    job.fingerprint = job_fingerprint
+    return job
+
+
+def _check(key: str, base_args: dict, runtime_only: bool, output: _ThreadOutput) -> PreflightResult:
+    buffer = io.StringIO()
+    output.local.buffer = buffer
+    try:
+        if not base_args:
+            return PreflightResult(key, False, "", error="could not be loaded")
+        memo_key = cache_key(base_args, runtime_only)
+        args, dataset_args = validator.separate_and_validate(copy.deepcopy(base_args), runtime_only)
+        if not args or not dataset_args:
+            return PreflightResult(key, False, buffer.getvalue())
+        if 'max_train_steps' in args:
+            steps = args['max_train_steps']
+        else:
+            steps = validator.calculate_steps(dataset_args['subsets'], args['max_train_epochs'],
+                                              dataset_args['general']['batch_size'], dataset_args['general'],
+                                              args.get('gradient_accumulation_steps', 1))
+        job = training.resolve_job(args, dataset_args, base_args)
+        if "tag_occurrence" in args:
+            index = dataset_index.get_index()
+            for subset in dataset_args['subsets']:
+                if os.path.isdir(subset['image_dir']):
+                    index.tag_counts(subset['image_dir'], subset['caption_extension'])
+        job_fingerprint = None
+        if not runtime_only:
+            job_fingerprint = run_history.fingerprint(job.args, job.dataset_args, job.script)
+        with _cache_lock:
+            _cache[memo_key] = (copy.deepcopy(job.args), copy.deepcopy(job.dataset_args), job.script,
+                                job_fingerprint)
+        return PreflightResult(key, True, buffer.getvalue(), steps, job.script, fingerprint=job_fingerprint)
+    except Exception as e:
+        return PreflightResult(key, False, buffer.getvalue(), error=f"{type(e).__name__}: {e}")
+    finally:
+        output.local.buffer = None
+
+
+def run(entries: Iterable[tuple[str, dict]], runtime_only: bool = False,
+        workers: int = None) -> list[PreflightResult]:
+    """
+    Validates every queue entry at once, counting images, steps and tags on a thread pool. Valid results are
+    memoized until the next pass, so the launch of an unchanged item skips straight to the launch time checks.
+    """
+    # entries of jobs that were removed or never launched would otherwise stay for the whole session
+    with _cache_lock:
+        _cache.clear()
+    output = _ThreadOutput(sys.stdout)
+    previous, sys.stdout = sys.stdout, output
+    try:
+        with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) + 4)) as pool:
+            futures = [pool.submit(_check, key, base_args, runtime_only, output) for key, base_args in entries]
+            return [future.result() for future in futures]
+    finally:
+        sys.stdout = previous
+
+
+def duplicates(results: list[PreflightResult]) -> dict[str, str]:
+    return run_history.collapse([(result.key, result.fingerprint) for result in results if result.valid])
+
+
+def report(results: list[PreflightResult]) -> str:
+    failed = [result for result in results if not result.valid]
+    lines = [f"Preflight: {len(results) - len(failed)} of {len(results)} queued jobs are valid"]
+    lines.extend(str(result) for result in results)
+    for key, original in duplicates(results).items():
+        lines.append(f"DUPLICATE {key} is identical to {original}")
+    return "\n".join(lines)
@@ -0,0 +1,137 @@
+import os
+from collections import Counter
+from typing import Union
+
+from modules import dataset_index, job_graph, sweep, validator
+
+
+def affinity_key(base_args: dict) -> tuple:
+    general = base_args.get("general_args", {})
+    resolution = general.get("dataset_args", {}).get("resolution", 512)
+    if isinstance(resolution, list):
+        resolution = tuple(resolution)
+    image_dirs = frozenset(os.path.normcase(os.path.abspath(subset['image_dir']))
+                           for subset in base_args.get("subsets", []) if subset.get('image_dir'))
+    return image_dirs, resolution, general.get("args", {}).get("pretrained_model_name_or_path", "")
+
+
+def group_by_affinity(items: list[tuple[str, dict]]) -> list[str]:
+    """
+    Groups queue items that share the same image directories, resolution and base model so they run back
+    to back. Groups run in the order their first item was queued, and items keep their order within a group.
+    """
+    groups = {}
+    for name, base_args in items:
+        groups.setdefault(affinity_key(base_args), []).append(name)
+    return [name for group in groups.values() for name in group]
+
+
+def cold_reads(order: list[str], items: dict[str, dict]) -> tuple[int, int]:
+    """
+    Estimates the images read from cold storage and the base models loaded cold when running the queue in
+    the given order, assuming only the previous job's data is still cached.
+    """
+    index = dataset_index.get_index()
+    counts = {}
+    images = 0
+    models = 0
+    previous_dirs, previous_model = frozenset(), None
+    for name in order:
+        image_dirs, _, model = affinity_key(items[name])
+        for directory in image_dirs - previous_dirs:
+            if directory not in counts:
+                counts[directory] = index.image_count(directory) if os.path.isdir(directory) else 0
+            images += counts[directory]
+        if model != previous_model:
+            models += 1
+        previous_dirs, previous_model = image_dirs, model
+    return images, models
+
+
+def report(before: list[str], after: list[str], items: dict[str, dict]) -> str:
+    images_before, models_before = cold_reads(before, items)
+    images_after, models_after = cold_reads(after, items)
+    saved = images_before - images_after
+    percent = f" ({saved / images_before:.0%})" if images_before else ""
+    return (f"Grouped queue: cold image reads {images_before} -> {images_after}{percent}, "
+            f"cold model loads {models_before} -> {models_after}")
+
+
+def _merged(base_args: dict, kind: str) -> dict:
+    merged = {}
+    for values in base_args.values():
+        if isinstance(values, dict) and isinstance(values.get(kind), dict):
+            merged.update(values[kind])
+    return merged
+
+
+def estimate(base_args: dict) -> Union[tuple[int, float], None]:
+    """
+    Estimates the optimizer steps of a queue item, its max_train_steps or validator.calculate_steps, and its cost:
+    the images it trains on, steps times batch size and gradient accumulation, each weighed by its pixels against
+    a 512x512 image. A sweep costs that for every point. Returns None when its image folders can't be read.
+    """
+    args = _merged(base_args, "args")
+    general = _merged(base_args, "dataset_args")
+    subsets = base_args.get("subsets", [])
+    batch_size = general.get("batch_size", 1)
+    accumulation = args.get("gradient_accumulation_steps", 1)
+    if "max_train_steps" in args:
+        steps = args["max_train_steps"]
+    else:
+        if not subsets or not all(os.path.isdir(subset.get("image_dir", "")) for subset in subsets):
+            return None
+        steps = validator.calculate_steps(subsets, args.get("max_train_epochs", 1), batch_size, general,
+                                          accumulation)
+    resolution = general.get("resolution", 512)
+    width, height = (resolution[0], resolution[-1]) if isinstance(resolution, (list, tuple)) else \
+        (resolution, resolution)
+    cost = steps * batch_size * accumulation * int(width) * int(height) / (512 * 512)
+    if sweep.is_sweep(base_args):
+        try:
+            cost *= len(sweep.Sweep(dict(base_args)))
+        except sweep.SweepError:
+            pass
+    return steps, cost
+
+
+def plan(items: list[tuple[str, str, dict]], priorities: dict[str, int],
+         shortest_first: bool = False) -> tuple[list[str], dict[str, Union[tuple[int, float], None]]]:
+    """
+    Orders queue items, given as (key, name, base_args), by priority, highest first, and with shortest_first by
+    their estimated cost, cheapest first and the ones without an estimate last. Items keep their queue order
+    otherwise, and never move ahead of a parent they depend on. Returns the keys in order and the estimates.
+    """
+    estimates = {key: estimate(base_args) for key, _, base_args in items} if shortest_first else {}
+
+    def rank(entry: tuple[int, tuple[str, str, dict]]) -> tuple:
+        index, (key, _, _) = entry
+        cost = estimates.get(key)
+        return -priorities.get(key, 0), cost is None and shortest_first, cost[1] if cost else 0, index
+
+    ranked = [item for _, item in sorted(enumerate(items), key=rank)]
+    unplaced = Counter(name for _, name, _ in items)
+    order = []
+    while ranked:
+        # the first item whose parents in the queue are all placed, or the first one when they wait on each other
+        ready = next((i for i, (_, _, base_args) in enumerate(ranked)
+                      if not any(unplaced.get(parent.get("job")) for parent in job_graph.parents(base_args)
+                                 if isinstance(parent, dict))), 0)
+        key, name, _ = ranked.pop(ready)
+        unplaced[name] -= 1
+        order.append(key)
+    return order, estimates
+
+
+def plan_report(order: list[str], names: dict[str, str], priorities: dict[str, int],
+                estimates: dict[str, Union[tuple[int, float], None]]) -> str:
+    lines = ["Queue order:"]
+    for position, key in enumerate(order, 1):
+        details = []
+        if priorities.get(key):
+            details.append(f"priority {priorities[key]}")
+        if key in estimates:
+            cost = estimates[key]
+            details.append(f"~{cost[0]} steps, {cost[1]:.0f} 512px images" if cost else "no estimate")
+        lines.append(f"  {position}. {names[key]}" + (f" ({', '.join(details)})" if details else ""))
+    return "\n".join(lines)
@@ -0,0 +1,381 @@
+"""
+Runs saved queue TOML files without the UI.
+
+    python -m modules.queue_runner job_1.toml job_2.toml folder_of_tomls/
+
+Each file uses the same format the UI saves (general_args, network_args, ..., subsets), is validated the same
+way and trained in order. Nothing here imports Qt, so it can run on headless training machines.
+
+The files are added to the job store first, so if the runner is killed, running it again (with or without new
+files) carries on from the first job that did not finish.
+
+A file with a [sweep] table (see modules/sweep.py) is not queued itself, its points are added to the store a few
+at a time, whenever the queued jobs run out. Every point has a fixed key, so passing the same sweep file again
+after an interruption skips the points that already ran. A halving sweep adds its next round once every job of
+the round before it has finished.
+
+A file can depend on other files' jobs and train on their output (see modules/job_graph.py), it starts as soon as
+they finished, on any free slot.
+
+A top level "priority = 10" in a file runs it before the files with a lower one, 0 by default. With
+--shortest_first, files of the same priority run cheapest first, by their estimated steps and resolution. The
+order is printed before the queue starts.
+
+The runner prints how many jobs trained, were skipped as duplicates and failed, and exits with 1 when any failed.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, Union
+
+import toml
+
+from modules import (dataset_stager, job_graph, job_store, preflight, queue_order, run_history, scheduler,
+                     supervisor, sweep, training, warm_worker)
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+QUEUE = "headless"
+# how often a runner with nothing else to do checks on the parents its jobs wait for
+POLL_SECONDS = 5
+
+
+def collect_files(paths: list[str]) -> list[Path]:
+    files = []
+    for path in paths:
+        path = Path(path).resolve()
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.toml")))
+        elif path.is_file():
+            files.append(path)
+        else:
+            print(f"Queue file '{path}' does not exist, skipping")
+    return files
+
+
+def load_file(file: Path) -> Union[dict, None]:
+    try:
+        with file.open("r", encoding="utf-8") as f:
+            return toml.load(f)
+    except (OSError, toml.TomlDecodeError) as e:
+        print(f"Failed to load {file}: {e}")
+        return None
+
+
+class SweepSource:
+    """
+    One sweep file, or the current round of a halving sweep, as (key, name, base_args) entries for the store.
+    """
+
+    def __init__(self, stem: str, expander: sweep.Sweep, halving: sweep.Halving = None) -> None:
+        self.stem = stem
+        self.expander = expander
+        self.halving = halving
+        self.keys: dict[str, str] = {}
+        self.entries = self.round_entries()
+
+    def round_entries(self) -> Iterator[tuple[str, str, dict]]:
+        self.keys = {}
+        for name, base_args in (self.halving or self.expander).jobs():
+            key = f"{self.stem}-{name}"
+            self.keys[key] = name
+            yield key, name, base_args
+
+    def next_round(self, store: job_store.JobStore) -> Union[bool, None]:
+        """
+        Returns None while jobs of the round are still queued or training, otherwise whether there is another
+        round to add.
+        """
+        if not self.halving:
+            return False
+        results = store.results(list(self.keys))
+        if any(state in (job_store.PENDING, job_store.RUNNING) for state, _ in results.values()):
+            return None
+        losses = {self.keys[key]: loss if state == job_store.DONE else None
+                  for key, (state, loss) in results.items()}
+        if not self.halving.advance(losses):
+            return False
+        self.entries = self.round_entries()
+        return True
+
+
+class SweepFeed:
+    """
+    Expands sweep files lazily, adding their next points to the store only when nothing else is pending, so a
+    sweep of thousands of points never exists as thousands of rows before they are about to run.
+    """
+
+    def __init__(self, batch: int = 1) -> None:
+        self.batch = max(batch, 1)
+        self.sources: list[SweepSource] = []
+
+    def add(self, file: Path, base_args: dict) -> bool:
+        try:
+            expander = sweep.Sweep(base_args)
+            halving = sweep.Halving(expander) if sweep.is_halving(base_args) else None
+        except sweep.SweepError as e:
+            print(f"Failed to load the sweep in {file}: {e}")
+            return False
+        print(f"{file.stem}: {expander.mode} sweep over {len(expander.parameters)} args, {len(expander)} points")
+        if halving:
+            print(f"{file.stem}: {halving.describe()}")
+        self.sources.append(SweepSource(file.stem, expander, halving))
+        return True
+
+    def refill(self, store: job_store.JobStore) -> int:
+        """
+        Adds the next batch of points that are not in the store yet, skipping the ones an earlier run added.
+        Sweeps waiting for a halving round to finish are passed over.
+        """
+        for source in list(self.sources):
+            while True:
+                while batch := list(itertools.islice(source.entries, self.batch)):
+                    added = store.add_many(batch, QUEUE, replace=False)
+                    if added:
+                        return added
+                more = source.next_round(store)
+                if more is None:
+                    break
+                if not more:
+                    self.sources.remove(source)
+                    break
+        return 0
+
+
+def enqueue(files: list[Path], store: job_store.JobStore, feed: SweepFeed = None) -> None:
+    entries = []
+    for file in files:
+        base_args = load_file(file)
+        if not base_args:
+            continue
+        # the store keeps it, sd-scripts has no such arg
+        priority = base_args.pop("priority", 0)
+        if sweep.is_sweep(base_args):
+            if feed:
+                feed.add(file, base_args)
+            else:
+                print(f"{file} is a sweep, it can only be run, skipping")
+            continue
+        entries.append((f"{file.stem}-{time.time_ns()}", file.stem, base_args, priority))
+    store.add_many([entry[:3] for entry in entries], QUEUE)
+    for key, _, _, priority in entries:
+        if priority:
+            store.set_priority(key, priority)
+
+
+def order_queue(store: job_store.JobStore, shortest_first: bool = False) -> None:
+    """
+    Reorders the pending jobs by priority, and with shortest_first by estimated cost, and prints the order.
+    """
+    pending = store.pending(QUEUE)
+    if len(pending) < 2:
+        return
+    keys = [key for key, _, _ in pending]
+    priorities = store.priorities(keys)
+    order, estimates = queue_order.plan([(key, name, base_args or {}) for key, name, base_args in pending],
+                                        priorities, shortest_first)
+    if order != keys:
+        store.reorder(order)
+    print(queue_order.plan_report(order, {key: name for key, name, _ in pending}, priorities, estimates))
+
+
+def claim_jobs(store: job_store.JobStore, feed: SweepFeed = None,
+               poll: bool = False) -> Iterator[Union[tuple[str, dict], None]]:
+    """
+    Claims the jobs that can start, in queue order. When the rest wait for parents that are training, it yields
+    None with poll, for a scheduler that comes back once a slot frees up, and otherwise waits for them.
+    """
+    while True:
+        if feed and not store.counts(QUEUE).get(job_store.PENDING):
+            feed.refill(store)
+        claimed, waiting = job_graph.claim(store, QUEUE)
+        if not claimed:
+            if not waiting:
+                return
+            if poll:
+                yield None
+            else:
+                time.sleep(POLL_SECONDS)
+            continue
+        key, name, base_args = claimed
+        print(f"[{name}] {store.counts(QUEUE).get(job_store.PENDING, 0)} jobs left after this one")
+        yield key, base_args
+
+
+class EventLog:
+    """
+    Appends every progress event as a json line, so other tools can follow the queue by tailing the file.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def __call__(self, key: str, event: supervisor.ProgressEvent) -> None:
+        with self.lock:
+            self.file.write(json.dumps({"job": key, "time": time.time(), **event.to_dict()}) + "\n")
+            self.file.flush()
+
+
+def run_queue(store: job_store.JobStore, runtime_only: bool = False, python: str = None,
+              scripts_dir: Union[str, Path] = training.SCRIPTS_DIR,
+              slots: list[scheduler.Slot] = None,
+              on_event: Callable[[str, supervisor.ProgressEvent], None] = None,
+              warm: warm_worker.WarmWorker = None, feed: SweepFeed = None) -> tuple[int, int, int]:
+    stager = dataset_stager.from_config() if not runtime_only else None
+    finished = 0
+    skipped = 0
+    failed = 0
+    while True:
+        if slots and len(slots) > 1 and not runtime_only:
+            done, duplicates, errors = scheduler.SlotScheduler(slots, python, scripts_dir, stager, store=store,
+                                                   on_event=on_event, warm=warm).run(claim_jobs(store, feed, True))
+        else:
+            done, duplicates, errors = run_serial(store, runtime_only, python, scripts_dir, stager, on_event, warm, feed)
+        finished += done
+        skipped += duplicates
+        failed += errors
+        # a halving sweep only adds its next round once the whole round before it finished
+        if not feed or not feed.refill(store):
+            break
+    if not runtime_only:
+        training.cleanup_runtime_store()
+    return finished, skipped, failed
+
+
+def run_serial(store: job_store.JobStore, runtime_only: bool, python: str, scripts_dir: Union[str, Path],
+               stager: dataset_stager.DatasetStager = None,
+               on_event: Callable[[str, supervisor.ProgressEvent], None] = None,
+               warm: warm_worker.WarmWorker = None, feed: SweepFeed = None) -> tuple[int, int, int]:
+    finished = 0
+    skipped = 0
+    failed = 0
+    for key, base_args in claim_jobs(store, feed):
+        if stager:
+            # the job about to start first, then the next one while it trains
+            stager.prefetch((base_args or {}).get("subsets", []))
+            pending = store.unfinished(QUEUE)
+            next_key = next((queued for queued, _ in pending if queued != key), None)
+            if next_key:
+                stager.prefetch((store.load(next_key) or {}).get("subsets", []))
+        try:
+            job = training.prepare_job(base_args, runtime_only, key)
+            if not job:
+                store.finish(key, False, "validation failed")
+                failed += 1
+                continue
+            if job.duplicate_of:
+                store.finish(key, True, f"skipped, already trained as {job.duplicate_of}", job.loss, job.output)
+                skipped += 1
+                continue
+            training.resume_interrupted(job, store.config(key))
+            store.record_config(key, job.args, job.dataset_args)
+            if not runtime_only:
+                training.launch(job, stager, python, scripts_dir,
+                                on_event=(lambda event: on_event(key, event)) if on_event else None, warm=warm)
+            else:
+                training.save_runtime_files(job)
+            store.finish(key, True, job.note(), job.loss, job.output)
+            finished += 1
+        except Exception as e:
+            print(f"Failed to train because of error:\n{e}")
+            store.finish(key, False, str(e))
+            failed += 1
+    return finished, skipped, failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run saved queue TOML files without the UI")
+    parser.add_argument("files", nargs="*", help="TOML files, or folders of TOML files, to run in order")
+    parser.add_argument("--fresh", action="store_true",
+                        help="drop the jobs left unfinished by a previous run instead of running them first")
+    parser.add_argument("--retry_failed", action="store_true", help="queue the jobs that failed in earlier runs again")
+    parser.add_argument("--runtime_only", action="store_true",
+                        help="only validate, writing the sd-scripts config files to runtime_store/jobs")
+    parser.add_argument("--python", default=None, help="python executable used to run sd-scripts")
+    parser.add_argument("--scripts_dir", default=str(training.SCRIPTS_DIR),
+                        help="folder containing train_network.py and sdxl_train_network.py")
+    parser.add_argument("--slots", type=int, default=1, help="number of jobs to train at the same time")
+    parser.add_argument("--devices", nargs="+", default=None,
+                        help="CUDA_VISIBLE_DEVICES for each slot, e.g. --devices 0 1 or --devices 0,1 2,3. "
+                             "Sets the number of slots")
+    parser.add_argument("--cpus_per_slot", type=int, default=0,
+                        help="pin each slot's trainer to its own set of this many cpus")
+    parser.add_argument("--events", default=None,
+                        help="append the trainer's progress (steps, loss, speed, epochs, saves) as json lines to this file")
+    parser.add_argument("--warm", action="store_true",
+                        help="import torch and sd-scripts once and fork every job from that process (not on Windows)")
+    parser.add_argument("--check", action="store_true",
+                        help="only run the preflight validation of every queued job and print its report")
+    parser.add_argument("--shortest_first", action="store_true",
+                        help="run jobs of the same priority by their estimated cost, cheapest first")
+    args = parser.parse_args()
+
+    files = collect_files(args.files)
+    scripts_dir = Path(args.scripts_dir).resolve()
+    events = EventLog(Path(args.events).resolve()) if args.events else None
+    os.chdir(ROOT_DIR)
+    store = job_store.get_store()
+    recovered = store.recover(QUEUE)
+    if args.fresh:
+        store.clear_pending(QUEUE)
+    elif recovered:
+        print(f"{recovered} jobs were interrupted, they will be run again")
+    if args.retry_failed:
+        store.retry_failed(QUEUE)
+    if args.check:
+        entries = [(key, store.load(key)) for key, _ in store.unfinished(QUEUE)]
+        for file in files:
+            base_args = load_file(file)
+            if base_args:
+                base_args.pop("priority", None)
+            if sweep.is_sweep(base_args):
+                # checks the sweep itself and its first point, the rest only differ in the swept args
+                try:
+                    name, base_args = next(sweep.Sweep(base_args).jobs())
+                    entries.append((f"{file.stem}-{name}", base_args))
+                except sweep.SweepError as e:
+                    print(f"Failed to load the sweep in {file}: {e}")
+                continue
+            entries.append((file.stem, base_args))
+        print(preflight.report(preflight.run(entries, args.runtime_only)))
+        return
+    slots = scheduler.make_slots(args.slots, args.devices, args.cpus_per_slot)
+    feed = SweepFeed(len(slots))
+    enqueue(files, store, feed)
+    feed.refill(store)
+    if not store.counts(QUEUE).get(job_store.PENDING):
+        print("No queue files to run")
+        return
+    order_queue(store, args.shortest_first)
+    results = preflight.run([(key, store.load(key)) for key, _ in store.unfinished(QUEUE)], args.runtime_only)
+    print(preflight.report(results))
+    skipped = 0
+    if not args.runtime_only and run_history.skip_duplicates():
+        for key, original in preflight.duplicates(results).items():
+            # jobs with parents only look alike until their parents' outputs are set
+            if not job_graph.parents(store.load(key)) and not job_graph.parents(store.load(original)):
+                store.finish(key, True, f"skipped, duplicate of {original}")
+                skipped += 1
+    warm = None
+    if args.warm and not args.runtime_only:
+        if warm_worker.supported():
+            warm = warm_worker.WarmWorker(args.python, scripts_dir)
+        else:
+            print("warm workers need fork, jobs will be started cold")
+    try:
+        finished, duplicates, failed = run_queue(store, args.runtime_only, args.python, scripts_dir, slots, events, warm, feed)
+    finally:
+        if warm:
+            warm.stop()
+    print(f"Queue finished: {finished} trained, {skipped + duplicates} skipped, {failed} failed")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
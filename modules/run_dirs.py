@@ -0,0 +1,172 @@
+"""
+Every launch renders its files into a folder of its own under runtime_store/jobs, named after the job and a hash
+of what it trains, so jobs running at the same time, in one process or in several, never share a file:
+
+    runtime_store/jobs/{job}-{hash}/
+        config.toml     the resolved sd-scripts args
+        dataset.toml    the resolved dataset config
+        output.log      everything the trainer printed, every attempt
+        meta.json       the job, its script and command, when it started and finished and how it ended
+        lease           the host and pid of the process using the folder, removed once it is done with it
+
+A folder is only ever used by the process holding its lease, a second launch of the same job gets a folder of
+its own. cleanup() takes the lease of a released folder before removing it, and removes folders whose owner on
+this host died, once they finished or started more than "keep_run_dirs_days" ago, set in config.json and 7 by
+default. Folders leased by a process on another host are never touched.
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Union
+
+from modules import watchdog
+
+ROOT = Path("runtime_store/jobs")
+KEEP_DAYS = 7
+
+
+def keep_days(config_file: str = "config.json") -> float:
+    if not os.path.exists(config_file):
+        return KEEP_DAYS
+    with open(config_file, 'r') as f:
+        return json.load(f).get("keep_run_dirs_days", KEEP_DAYS)
+
+
+class Tee:
+    """
+    Echoes the trainer's output as before and copies it to the log.
+    """
+
+    def __init__(self, log, echo=sys.stdout) -> None:
+        self.log = log
+        self.echo = echo
+
+    def write(self, text: str) -> None:
+        if self.echo:
+            self.echo.write(text)
+        self.log.write(text)
+
+    def flush(self) -> None:
+        if self.echo:
+            self.echo.flush()
+        self.log.flush()
+
+
+class RunDir:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.config_file = path.joinpath("config.toml")
+        self.dataset_file = path.joinpath("dataset.toml")
+        self.log_file = path.joinpath("output.log")
+        self.meta_file = path.joinpath("meta.json")
+        self.lease_file = path.joinpath("lease")
+        self.meta = {}
+
+    def write_meta(self, **values) -> None:
+        self.meta.update(values)
+        temp = self.meta_file.with_suffix(".tmp")
+        with temp.open("w", encoding="utf-8") as f:
+            json.dump(self.meta, f, indent=2, default=str)
+        os.replace(temp, self.meta_file)
+
+    @contextmanager
+    def log(self, header: str = None) -> Iterator[Tee]:
+        with self.log_file.open("a", encoding="utf-8", errors="replace") as f:
+            if header:
+                f.write(f"===== {header} =====\n")
+            yield Tee(f)
+
+    def release(self, state: str, note: str = None) -> None:
+        self.write_meta(state=state, note=note, finished=time.time())
+        try:
+            os.remove(self.lease_file)
+        except FileNotFoundError:
+            pass
+
+
+def _take_lease(path: Path) -> bool:
+    try:
+        fd = os.open(path.joinpath("lease"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump({"host": socket.gethostname(), "pid": os.getpid(), "taken": time.time()}, f)
+    return True
+
+
+def _owner_died(path: Path) -> bool:
+    """
+    Whether the folder is leased by a process on this host that is no longer running.
+    """
+    try:
+        with path.joinpath("lease").open("r") as f:
+            lease = json.load(f)
+    except (OSError, ValueError):
+        # missing, or still being written by its new owner
+        return False
+    pid = lease.get("pid")
+    return lease.get("host") == socket.gethostname() and bool(pid) and not watchdog.alive(pid)
+
+
+def acquire(name: str, contents: dict, root: Union[str, Path] = ROOT) -> RunDir:
+    """
+    Leases a folder for one launch of the job, named after it and the hash of contents, which is what it trains.
+    """
+    text = json.dumps(contents, sort_keys=True, default=str)
+    safe_name = re.sub(r"[^\w.-]+", "_", name)[:80]
+    base = f"{safe_name}-{hashlib.sha1(text.encode('utf-8')).hexdigest()[:10]}"
+    root = Path(root)
+    for n in itertools.count():
+        path = root.joinpath(base if not n else f"{base}-{n}")
+        path.mkdir(parents=True, exist_ok=True)
+        if _take_lease(path):
+            run_dir = RunDir(path)
+            run_dir.log_file.write_text("", encoding="utf-8")
+            run_dir.write_meta(job=name, host=socket.gethostname(), pid=os.getpid(), started=time.time(),
+                               state="running")
+            return run_dir
+
+
+def cleanup(root: Union[str, Path] = ROOT, days: float = None) -> int:
+    """
+    Removes the released folders, and the ones left behind by a dead process, older than days. Returns how many
+    were removed.
+    """
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+    cutoff = time.time() - 86400 * (keep_days() if days is None else days)
+    removed = 0
+    for path in root.iterdir():
+        if not path.is_dir():
+            continue
+        try:
+            with path.joinpath("meta.json").open("r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        try:
+            age = meta.get("finished") or meta.get("started") or path.stat().st_mtime
+        except OSError:
+            continue
+        if age > cutoff:
+            continue
+        # a dead owner will never release its lease, and nobody else takes a leased folder
+        if _owner_died(path) or _take_lease(path):
+            # moved aside first, a launch of the same job may create the folder again while it is being removed
+            doomed = path.with_name(f"{path.name}.removing{os.getpid()}")
+            try:
+                os.rename(path, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            removed += 1
+    return removed
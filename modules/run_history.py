@@ -0,0 +1,119 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union
+
+from modules import dataset_index
+
+HISTORY_PATH = Path("runtime_store/cache/run_history.sqlite")
+# where the results go and what they are called, not what gets trained
+IGNORED_ARGS = {"output_name", "output_dir", "logging_dir", "log_prefix", "save_toml", "save_toml_location",
+                "tag_occurrence", "tag_file_location"}
+
+
+def fingerprint(args: dict, dataset_args: dict, script: str) -> str:
+    """
+    Canonical hash of a resolved job: its config.toml args minus naming and locations, its dataset.toml args
+    with every image_dir replaced by the manifest of its images and captions, and the script that trains it.
+    """
+    dataset = copy.deepcopy(dataset_args)
+    index = dataset_index.get_index()
+    for subset in dataset.get('subsets', []):
+        directory = subset.pop('image_dir', "")
+        subset['manifest'] = (index.manifest(directory, subset.get('caption_extension', ".txt"))
+                              if os.path.isdir(directory) else directory)
+    config = {key: value for key, value in args.items() if key not in IGNORED_ARGS}
+    text = json.dumps({"script": script, "args": config, "dataset": dataset}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def output_file(args: dict) -> str:
+    extension = args.get("save_model_as", "safetensors")
+    return os.path.join(args.get("output_dir", ""), f"{args.get('output_name', 'last')}.{extension}")
+
+
+class RunHistory:
+    """
+    Every job that finished training, stored in sqlite by fingerprint along with the model it produced. A queued
+    job with the same fingerprint as a finished one, whose model still exists, would train the same thing again.
+    """
+
+    def __init__(self, path: Union[str, Path] = HISTORY_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                         "fingerprint TEXT PRIMARY KEY, name TEXT NOT NULL, output TEXT NOT NULL, "
+                         "finished REAL NOT NULL, loss REAL)")
+            if "loss" not in [row[1] for row in conn.execute("PRAGMA table_info(runs)")]:
+                conn.execute("ALTER TABLE runs ADD COLUMN loss REAL")
+
+    @contextmanager
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def find(self, job_fingerprint: str) -> Union[tuple[str, str, Union[float, None]], None]:
+        """
+        Returns the name, output file and final loss of the finished run with this fingerprint, if its output
+        still exists.
+        """
+        with self.connect() as conn:
+            row = conn.execute("SELECT name, output, loss FROM runs WHERE fingerprint = ?",
+                               (job_fingerprint,)).fetchone()
+        if not row or not os.path.exists(row[1]):
+            return None
+        return row[0], row[1], row[2]
+
+    def record(self, job_fingerprint: str, name: str, args: dict, loss: float = None) -> None:
+        with self.lock, self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO runs (fingerprint, name, output, finished, loss) "
+                         "VALUES (?, ?, ?, ?, ?)", (job_fingerprint, name, output_file(args), time.time(), loss))
+
+
+def collapse(fingerprints: list[tuple[str, str]]) -> dict[str, str]:
+    """
+    Takes (key, fingerprint) pairs in queue order, and returns every key that is an exact duplicate of an earlier
+    one, mapped to the key it duplicates.
+    """
+    first = {}
+    duplicates = {}
+    for key, job_fingerprint in fingerprints:
+        if job_fingerprint is None:
+            continue
+        if job_fingerprint in first:
+            duplicates[key] = first[job_fingerprint]
+        else:
+            first[job_fingerprint] = key
+    return duplicates
+
+
+def skip_duplicates(config_file: str = "config.json") -> bool:
+    if not os.path.exists(config_file):
+        return True
+    with open(config_file, 'r') as f:
+        return json.load(f).get("skip_trained_duplicates", True)
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history() -> RunHistory:
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = RunHistory()
+        return _history
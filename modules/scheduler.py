@@ -0,0 +1,181 @@
+import itertools
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Union
+
+from modules import queue_order, run_dirs, supervisor, training
+from modules.dataset_stager import DatasetStager
+from modules.job_store import JobStore
+from modules.warm_worker import WarmWorker
+
+
+class Slot:
+    def __init__(self, index: int, devices: str = None, cpus: set[int] = None) -> None:
+        self.index = index
+        self.devices = devices
+        self.cpus = cpus
+        self.job_name = None
+        self.started = 0.0
+        self.busy_time = 0.0
+        self.jobs_run = 0
+
+    def env(self) -> Union[dict, None]:
+        if self.devices is None:
+            return None
+        return {"CUDA_VISIBLE_DEVICES": self.devices}
+
+
+def make_slots(count: int, devices: list[str] = None, cpus_per_slot: int = 0) -> list[Slot]:
+    """
+    Builds one slot per device group, or count slots sharing every device. With cpus_per_slot the cpus this
+    process may use are split into contiguous, non overlapping sets, one per slot.
+    """
+    if devices:
+        count = len(devices)
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else \
+        list(range(os.cpu_count() or 1))
+    slots = []
+    for i in range(count):
+        cpus = None
+        if cpus_per_slot:
+            cpus = set(available[i * cpus_per_slot:(i + 1) * cpus_per_slot]) or None
+        slots.append(Slot(i, devices[i] if devices else None, cpus))
+    return slots
+
+
+def _uses_disk_cache(base_args: dict) -> bool:
+    args = base_args.get("general_args", {}).get("args", {})
+    return bool(args.get("cache_latents_to_disk") or args.get("cache_text_encoder_outputs_to_disk"))
+
+
+class SlotScheduler:
+    """
+    Runs queue entries on several slots at once. Every job gets its own leased runtime folder for its config
+    files and log, and the devices and cpus of the slot it runs on.
+
+    Jobs that write latent caches next to their images never run at the same time as another job using the
+    same image folders, since both would write the same .npz files.
+    """
+
+    def __init__(self, slots: list[Slot], python: str = None,
+                 scripts_dir: Union[str, Path] = training.SCRIPTS_DIR, stager: DatasetStager = None,
+                 runtime_root: Union[str, Path] = run_dirs.ROOT,
+                 store: JobStore = None,
+                 on_event: Callable[[str, supervisor.ProgressEvent], None] = None,
+                 warm: WarmWorker = None) -> None:
+        self.slots = slots
+        self.python = python
+        self.scripts_dir = scripts_dir
+        self.stager = stager
+        self.runtime_root = Path(runtime_root)
+        self.store = store
+        self.on_event = on_event
+        self.warm = warm
+        self.condition = threading.Condition()
+        self.prepare_lock = threading.Lock()
+        self.running: dict[int, tuple[str, dict]] = {}
+        self.finished = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def _conflicts(self, base_args: dict) -> bool:
+        dirs = queue_order.affinity_key(base_args)[0]
+        for _, running_args in self.running.values():
+            if not (_uses_disk_cache(base_args) or _uses_disk_cache(running_args)):
+                continue
+            if dirs & queue_order.affinity_key(running_args)[0]:
+                return True
+        return False
+
+    def _next_entry(self, pending: list, entries: Iterator) -> Union[tuple[str, dict], None]:
+        for i, entry in enumerate(pending):
+            if not self._conflicts(entry[1]):
+                return pending.pop(i)
+        for entry in entries:
+            if entry is None:
+                return None
+            if not self._conflicts(entry[1]):
+                return entry
+            pending.append(entry)
+        return None
+
+    def run(self, entries: Iterable[tuple[str, dict]]) -> tuple[int, int, int]:
+        """
+        Runs every entry, pulling them from the iterable only as slots free up, and returns the number of jobs
+        that finished, that were skipped as duplicates and that failed. An entry of None means the next job waits for one that is
+        running, it is pulled again once a slot frees up.
+        """
+        entries = iter(entries)
+        pending = []
+        threads = []
+        with self.condition:
+            while True:
+                free = [slot for slot in self.slots if slot.index not in self.running]
+                entry = self._next_entry(pending, entries) if free else None
+                if entry is not None:
+                    slot = free[0]
+                    self.running[slot.index] = entry
+                    slot.job_name, slot.started = entry[0], time.time()
+                    if self.stager:
+                        self.stager.prefetch((entry[1] or {}).get("subsets", []))
+                    thread = threading.Thread(target=self._run_slot, args=(slot, entry), daemon=True)
+                    threads.append(thread)
+                    thread.start()
+                    if self.stager:
+                        if not pending:
+                            pending.extend(entry for entry in itertools.islice(entries, 1) if entry)
+                        if pending:
+                            self.stager.prefetch(pending[0][1].get("subsets", []))
+                    continue
+                if not pending and not self.running:
+                    break
+                self.condition.wait()
+        for thread in threads:
+            thread.join()
+        for slot in self.slots:
+            print(f"slot {slot.index}: {slot.jobs_run} jobs, busy {slot.busy_time:.0f}s")
+        return self.finished, self.skipped, self.failed
+
+    def _run_slot(self, slot: Slot, entry: tuple[str, dict]) -> None:
+        name, base_args = entry
+        success = False
+        error = None
+        job = None
+        try:
+            with self.prepare_lock:
+                job = training.prepare_job(base_args, name=name)
+            if not job:
+                error = "validation failed"
+            elif job.duplicate_of:
+                success = True
+                error = f"skipped, already trained as {job.duplicate_of}"
+            else:
+                if self.store:
+                    training.resume_interrupted(job, self.store.config(name))
+                    self.store.record_config(name, job.args, job.dataset_args)
+                print(f"slot {slot.index}: starting {name}")
+                on_event = (lambda event: self.on_event(name, event)) if self.on_event else None
+                training.launch(job, self.stager, self.python, self.scripts_dir, self.runtime_root, slot.env(),
+                                slot.cpus, on_event, self.warm)
+                success = True
+                error = job.note()
+        except Exception as e:
+            error = str(e)
+            print(f"slot {slot.index}: failed to train {name} because of error:\n{e}")
+        finally:
+            if self.store:
+                self.store.finish(name, success, error, job.loss if job else None, job.output if job else None)
+            with self.condition:
+                slot.busy_time += time.time() - slot.started
+                slot.jobs_run += 1
+                slot.job_name = None
+                del self.running[slot.index]
+                if success and job and job.duplicate_of:
+                    self.skipped += 1
+                elif success:
+                    self.finished += 1
+                else:
+                    self.failed += 1
+                self.condition.notify_all()
@@ -0,0 +1,217 @@
+import asyncio
+import math
+import os
+import re
+import sys
+from collections import deque
+from typing import Awaitable, Callable, Iterable, Union
+
+from modules.watchdog import Watchdog
+
+STEP_PATTERN = re.compile(r"(\d+)/(\d+) \[[^,\]]*(?:, *([\d.]+)(it/s|s/it))?"
+                          r"(?:, *avr_loss=([\d.]+(?:[eE][-+]?\d+)?|nan|inf))?")
+EPOCH_PATTERN = re.compile(r"^epoch (\d+)/(\d+)")
+SAVE_PATTERN = re.compile(r"^saving (?:checkpoint|state): (.+)")
+TAIL_LINES = 200
+
+OUT_OF_MEMORY = "out of memory"
+# the host ran out of RAM, settings that save GPU memory won't help
+OUT_OF_HOST_MEMORY = "out of system memory"
+MISSING_FILE = "missing file"
+NAN_LOSS = "nan loss"
+UNKNOWN = "error"
+# checked in this order, an out of memory error often ends in other errors while the trainer unwinds
+CAUSES = [
+    (OUT_OF_HOST_MEMORY, re.compile(r"DefaultCPUAllocator|can't allocate memory")),
+    (OUT_OF_MEMORY, re.compile(r"out of memory|OutOfMemoryError|CUBLAS_STATUS_ALLOC_FAILED", re.IGNORECASE)),
+    (MISSING_FILE, re.compile(r"FileNotFoundError|No such file or directory")),
+    (NAN_LOSS, re.compile(r"avr_loss=nan|\bnan\b.*\bloss\b|\bloss\b.*\bnan\b|NaN detected", re.IGNORECASE)),
+]
+
+
+class ProgressEvent:
+    """
+    One thing the trainer reported. kind is "step", "epoch", "save", "start" or "exit", only the fields that
+    kind carries are set.
+    """
+
+    def __init__(self, kind: str, step: int = None, total: int = None, loss: float = None,
+                 speed: float = None, epoch: int = None, epochs: int = None, path: str = None,
+                 code: int = None, pid: int = None) -> None:
+        self.kind = kind
+        self.step = step
+        self.total = total
+        self.loss = loss
+        self.speed = speed
+        self.epoch = epoch
+        self.epochs = epochs
+        self.path = path
+        self.code = code
+        self.pid = pid
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in vars(self).items() if value is not None}
+
+    def __str__(self) -> str:
+        if self.kind == "step":
+            text = f"step {self.step}/{self.total}"
+            if self.speed is not None:
+                text += f", {self.speed:.2f} it/s"
+            if self.loss is not None:
+                text += f", loss {self.loss:.4f}"
+            return text
+        if self.kind == "epoch":
+            return f"epoch {self.epoch}/{self.epochs}"
+        if self.kind == "save":
+            return f"saved {self.path}"
+        if self.kind == "exit":
+            return f"exited with code {self.code}"
+        return f"started pid {self.pid}"
+
+
+def classify(lines: Iterable[str]) -> str:
+    """
+    Names the cause of a failed run from the last lines it printed.
+    """
+    lines = list(lines)
+    for cause, pattern in CAUSES:
+        if any(pattern.search(line) for line in lines):
+            return cause
+    return UNKNOWN
+
+
+def parse_line(line: str) -> Union[ProgressEvent, None]:
+    line = line.strip()
+    if not line:
+        return None
+    match = EPOCH_PATTERN.match(line)
+    if match:
+        return ProgressEvent("epoch", epoch=int(match.group(1)), epochs=int(match.group(2)))
+    match = SAVE_PATTERN.match(line)
+    if match:
+        return ProgressEvent("save", path=match.group(1).strip())
+    if not line.startswith("steps:"):
+        return None
+    match = STEP_PATTERN.search(line)
+    if not match:
+        return None
+    speed = None
+    if match.group(3):
+        speed = float(match.group(3))
+        if match.group(4) == "s/it" and speed:
+            speed = 1 / speed
+    loss = float(match.group(5)) if match.group(5) else None
+    return ProgressEvent("step", step=int(match.group(1)), total=int(match.group(2)), loss=loss, speed=speed)
+
+
+class Supervision:
+    """
+    The outcome of a supervised run: its exit code, the last lines it printed, the last step it reported, and
+    when it failed, the cause of it.
+    """
+
+    def __init__(self) -> None:
+        self.code = None
+        self.tail: deque[str] = deque(maxlen=TAIL_LINES)
+        self.last_step: Union[ProgressEvent, None] = None
+        self.saves: list[str] = []
+        self.stopped: Union[str, None] = None
+        self.cause: Union[str, None] = None
+
+
+async def _pump(read: Callable[[], Awaitable[bytes]], result: Supervision,
+                on_event: Callable[[ProgressEvent], None], echo, guard: Watchdog = None) -> None:
+    """
+    Reads the output in chunks as they arrive instead of by line, tqdm redraws with carriage returns and a single
+    "line" can be the whole run. Complete lines are parsed, a partial line is kept for the next chunk.
+    """
+    pending = ""
+    while True:
+        chunk = await read()
+        if not chunk:
+            break
+        if guard:
+            guard.activity()
+        text = chunk.decode("utf-8", errors="replace")
+        if echo:
+            echo.write(text)
+            echo.flush()
+        parts = re.split(r"[\r\n]", pending + text)
+        pending = parts.pop()
+        for part in parts:
+            _handle(part, result, on_event)
+        if guard and result.last_step:
+            guard.observe_step(result.last_step.step)
+    _handle(pending, result, on_event)
+
+
+def _handle(line: str, result: Supervision, on_event: Callable[[ProgressEvent], None]) -> None:
+    if not line.strip():
+        return
+    event = parse_line(line)
+    if event is None or event.kind != "step":
+        result.tail.append(line)
+    else:
+        # an error printed right after a progress bar lands on the same line
+        close = line.find("]", STEP_PATTERN.search(line).end())
+        if close >= 0 and line[close + 1:].strip():
+            result.tail.append(line[close + 1:].strip())
+    if event is None:
+        return
+    if event.kind == "step":
+        if result.last_step and result.last_step.step == event.step and result.last_step.loss == event.loss:
+            return
+        result.last_step = event
+    elif event.kind == "save":
+        result.saves.append(event.path)
+    if on_event:
+        on_event(event)
+
+
+async def watch(pid: int, read: Callable[[], Awaitable[bytes]], wait: Callable[[], Awaitable[int]],
+                on_event: Callable[[ProgressEvent], None] = None, on_start: Callable[[int], None] = None,
+                echo=sys.stdout, guard: Watchdog = None) -> Supervision:
+    """
+    Follows a started trainer, given its pid, a coroutine returning its next chunk of output (empty once it
+    closes) and one returning its exit code. With a watchdog, its reason for ending the trainer is in stopped.
+    """
+    result = Supervision()
+    if on_start:
+        on_start(pid)
+    if on_event:
+        on_event(ProgressEvent("start", pid=pid))
+    task = asyncio.create_task(guard.guard(pid)) if guard and guard.active() else None
+    try:
+        await _pump(read, result, on_event, echo, guard)
+        result.code = await wait()
+        if result.code:
+            result.cause = classify(result.tail)
+            if result.cause == UNKNOWN and result.last_step and result.last_step.loss is not None and \
+                    math.isnan(result.last_step.loss):
+                result.cause = NAN_LOSS
+    finally:
+        if task:
+            if not task.done():
+                task.cancel()
+            result.stopped = guard.reason
+    if on_event:
+        on_event(ProgressEvent("exit", code=result.code))
+    return result
+
+
+async def supervise(command: list[str], env: dict = None, on_event: Callable[[ProgressEvent], None] = None,
+                    on_start: Callable[[int], None] = None, echo=sys.stdout, guard: Watchdog = None) -> Supervision:
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        env={**os.environ, "PYTHONUNBUFFERED": "1", **(env or {})}
+    )
+    return await watch(process.pid, lambda: process.stdout.read(1 << 16), process.wait, on_event, on_start, echo,
+                       guard)
+
+
+def run(command: list[str], env: dict = None, on_event: Callable[[ProgressEvent], None] = None,
+        on_start: Callable[[int], None] = None, echo=sys.stdout, guard: Watchdog = None) -> Supervision:
+    """
+    Runs the command to completion on a private event loop, so it can be called from any thread.
+    """
+    return asyncio.run(supervise(command, env, on_event, on_start, echo, guard))
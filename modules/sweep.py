@@ -0,0 +1,279 @@
+"""
+Expands a sweep attached to a saved queue TOML into one job per point, without ever building the whole list.
+
+    [sweep]
+    mode = "grid"           # grid, random or lhs (latin hypercube)
+    samples = 20            # random and lhs only
+    seed = 0
+
+    [sweep.parameters]
+    network_dim = [8, 16, 32]
+    "optimizer_args.args.learning_rate" = { min = 1e-5, max = 1e-3, log = true, steps = 3 }
+    "network_args.args.network_args.down_lr_weight" = [["1", "1", "0.5"], ["0.5", "1", "1"]]
+
+Parameters are either a full dotted path into the TOML, or a bare arg name, which is looked up in every
+section's args and dataset_args. A list is a set of choices, a table with min and max is a range, sampled
+uniformly (or log-uniformly) by random and lhs, and split into steps values by grid.
+
+Every point gets output_name "<base output_name>-<hash of the point>", so the same point always trains under
+the same name, whichever mode or order produced it.
+
+With a [sweep.halving] table the points race by successive halving instead of each training in full:
+
+    [sweep.halving]
+    min_steps = 100         # steps every point trains in the first round
+    eta = 3                 # each round keeps the best third, and trains them three times as long
+    max_steps = 900         # steps the winners have trained in total, defaults to the config's max_train_steps
+
+Every round trains the points up to its budget with save_state on, ranks them by the last avr_loss they
+printed, and the best continue in the next round by resuming from the state they saved. max_train_steps is the
+total, the step a resumed point starts from comes back from the state's train_state.json. Round r of a point is
+saved as "<point's output_name>-r<r>".
+"""
+import copy
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+from typing import Iterator, Union
+
+MODES = {"grid", "random", "lhs"}
+
+
+class SweepError(Exception):
+    pass
+
+
+def resolve_path(base_args: dict, key: str) -> list[str]:
+    if "." in key:
+        return key.split(".")
+    matches = []
+    for section, values in base_args.items():
+        if not isinstance(values, dict):
+            continue
+        for group in ("args", "dataset_args"):
+            if key in values.get(group, {}):
+                matches.append([section, group, key])
+    if not matches:
+        raise SweepError(f"sweep parameter '{key}' is not set in the config, use its full dotted path")
+    if len(matches) > 1:
+        raise SweepError(f"sweep parameter '{key}' is set in {len(matches)} sections, use its full dotted path")
+    return matches[0]
+
+
+def set_path(base_args: dict, path: list[str], value) -> None:
+    target = base_args
+    for part in path[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(path[-1])] = value
+    else:
+        target[path[-1]] = value
+
+
+class Parameter:
+    def __init__(self, key: str, path: list[str], spec: Union[list, dict]) -> None:
+        self.key = key
+        self.path = path
+        self.choices = None
+        if isinstance(spec, list):
+            if not spec:
+                raise SweepError(f"sweep parameter '{key}' has no choices")
+            self.choices = spec
+            return
+        if not isinstance(spec, dict) or "min" not in spec or "max" not in spec:
+            raise SweepError(f"sweep parameter '{key}' must be a list of choices or a table with min and max")
+        self.low = spec["min"]
+        self.high = spec["max"]
+        self.log = spec.get("log", False)
+        self.steps = spec.get("steps", 0)
+        self.integer = isinstance(self.low, int) and isinstance(self.high, int) and not self.log
+        if self.log and (self.low <= 0 or self.high <= 0):
+            raise SweepError(f"sweep parameter '{key}' needs a positive range to be log scaled")
+
+    def at(self, fraction: float):
+        """
+        Maps a fraction in [0, 1) onto the parameter, a choice for lists and a value for ranges.
+        """
+        if self.choices is not None:
+            return self.choices[min(int(fraction * len(self.choices)), len(self.choices) - 1)]
+        if self.log:
+            value = math.exp(math.log(self.low) + fraction * (math.log(self.high) - math.log(self.low)))
+        else:
+            value = self.low + fraction * (self.high - self.low)
+        if self.integer:
+            return min(int(round(value)), self.high)
+        return float(f"{value:.6g}")
+
+    def grid_values(self) -> list:
+        if self.choices is not None:
+            return self.choices
+        if self.steps < 2:
+            raise SweepError(f"sweep parameter '{self.key}' needs steps of at least 2 to be used in a grid")
+        values = [self.at(i / (self.steps - 1)) for i in range(self.steps)]
+        values[-1] = self.high
+        return list(dict.fromkeys(values))
+
+
+class Sweep:
+    def __init__(self, base_args: dict) -> None:
+        base_args = copy.deepcopy(base_args)
+        spec = base_args.pop("sweep", None)
+        if not spec:
+            raise SweepError("config has no [sweep] table")
+        self.base_args = base_args
+        self.spec = spec
+        self.mode = spec.get("mode", "grid")
+        if self.mode not in MODES:
+            raise SweepError(f"unknown sweep mode '{self.mode}', use one of {', '.join(sorted(MODES))}")
+        self.samples = int(spec.get("samples", 0))
+        if self.mode != "grid" and self.samples < 1:
+            raise SweepError(f"{self.mode} sweeps need samples")
+        self.seed = spec.get("seed", 0)
+        self.parameters = [Parameter(key, resolve_path(base_args, key), value)
+                           for key, value in spec.get("parameters", {}).items()]
+        if not self.parameters:
+            raise SweepError("sweep has no parameters")
+        self.output_name = base_args.get("saving_args", {}).get("args", {}).get("output_name", "last")
+
+    def __len__(self) -> int:
+        if self.mode == "grid":
+            return math.prod(len(parameter.grid_values()) for parameter in self.parameters)
+        return self.samples
+
+    def points(self) -> Iterator[dict]:
+        if self.mode == "grid":
+            for values in itertools.product(*(parameter.grid_values() for parameter in self.parameters)):
+                yield dict(zip((parameter.key for parameter in self.parameters), values))
+            return
+        rng = random.Random(self.seed)
+        if self.mode == "random":
+            for _ in range(self.samples):
+                yield {parameter.key: parameter.at(rng.random()) for parameter in self.parameters}
+            return
+        # latin hypercube: every parameter's range is cut into samples strata and each stratum is used once
+        strata = []
+        for _ in self.parameters:
+            order = list(range(self.samples))
+            rng.shuffle(order)
+            strata.append(order)
+        for i in range(self.samples):
+            yield {parameter.key: parameter.at((strata[j][i] + rng.random()) / self.samples)
+                   for j, parameter in enumerate(self.parameters)}
+
+    def name(self, point: dict) -> str:
+        digest = hashlib.sha1(json.dumps(point, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return f"{self.output_name}-{digest[:8]}"
+
+    def build(self, point: dict) -> tuple[str, dict]:
+        base_args = copy.deepcopy(self.base_args)
+        for parameter in self.parameters:
+            set_path(base_args, parameter.path, point[parameter.key])
+        name = self.name(point)
+        base_args.setdefault("saving_args", {}).setdefault("args", {})["output_name"] = name
+        return name, base_args
+
+    def jobs(self) -> Iterator[tuple[str, dict]]:
+        """
+        Yields (output_name, base_args) for each point, building each job's args only when it is asked for.
+        """
+        for point in self.points():
+            yield self.build(point)
+
+    def names(self) -> list[str]:
+        return [self.name(point) for point in self.points()]
+
+
+class Halving:
+    """
+    Runs a sweep as successive halving. jobs() yields the current round's jobs, and once they have all finished,
+    advance() takes their losses and moves on to the next round with the best of them.
+    """
+
+    def __init__(self, expander: Sweep) -> None:
+        spec = expander.spec.get("halving", {})
+        self.expander = expander
+        self.eta = spec.get("eta", 3)
+        if self.eta < 2:
+            raise SweepError("halving needs an eta of at least 2")
+        general = expander.base_args.get("general_args", {}).get("args", {})
+        max_steps = spec.get("max_steps", general.get("max_train_steps", 0))
+        min_steps = spec.get("min_steps", 0)
+        if min_steps < 1 or max_steps < min_steps:
+            raise SweepError("halving needs min_steps, and max_steps (or max_train_steps) of at least min_steps")
+        self.budgets = []
+        budget = min_steps
+        while budget < max_steps:
+            self.budgets.append(budget)
+            budget *= self.eta
+        self.budgets.append(max_steps)
+        self.output_dir = expander.base_args.get("saving_args", {}).get("args", {}).get("output_dir", "")
+        self.round = 0
+        self.survivors: Union[list[dict], None] = None
+        self.current: dict[str, dict] = {}
+        self.winner = None
+
+    def describe(self) -> str:
+        return (f"successive halving of {len(self.expander)} points, keeping 1 in {self.eta} after rounds of "
+                f"{', '.join(str(budget) for budget in self.budgets)} steps")
+
+    def job(self, point: dict) -> tuple[str, dict]:
+        name, base_args = self.expander.build(point)
+        general = base_args.setdefault("general_args", {}).setdefault("args", {})
+        general.pop("max_train_epochs", None)
+        general["max_train_steps"] = self.budgets[self.round]
+        saving = base_args["saving_args"]["args"]
+        saving["output_name"] = f"{name}-r{self.round}"
+        saving["save_state"] = True
+        saving.pop("resume", None)
+        if self.round:
+            saving["resume"] = os.path.join(self.output_dir, f"{name}-r{self.round - 1}-state")
+        return saving["output_name"], base_args
+
+    def names(self) -> list[str]:
+        """
+        The name of every job any round can run, survivors are only known once the round before finished.
+        """
+        return [f"{name}-r{r}" for name in self.expander.names() for r in range(len(self.budgets))]
+
+    def jobs(self) -> Iterator[tuple[str, dict]]:
+        points = self.expander.points() if self.survivors is None else iter(self.survivors)
+        for point in points:
+            name, base_args = self.job(point)
+            self.current[name] = point
+            yield name, base_args
+
+    def advance(self, losses: dict[str, Union[float, None]]) -> bool:
+        """
+        Takes the final loss of every job of the round, None for the ones that failed, and keeps the best. Returns
+        False when there is no next round, winner is then the name of the best job of the last round.
+        """
+        ranked = sorted((loss, name) for name, loss in losses.items()
+                        if name in self.current and loss is not None and math.isfinite(loss))
+        if not ranked:
+            print(f"halving round {self.round}: no job finished with a loss, stopping")
+            return False
+        if self.round + 1 >= len(self.budgets):
+            self.winner = ranked[0][1]
+            print(f"halving finished, best is {self.winner} with loss {ranked[0][0]:.4f}")
+            return False
+        keep = ranked[:max(1, len(self.current) // self.eta)]
+        print(f"halving round {self.round}: kept {len(keep)} of {len(self.current)}, "
+              f"loss {keep[0][0]:.4f} to {keep[-1][0]:.4f}")
+        self.survivors = [self.current[name] for _, name in keep]
+        self.current = {}
+        self.round += 1
+        return True
+
+
+def is_sweep(base_args: dict) -> bool:
+    return bool(base_args and base_args.get("sweep"))
+
+
+def is_halving(base_args: dict) -> bool:
+    return is_sweep(base_args) and "halving" in base_args["sweep"]
@@ -0,0 +1,53 @@
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+
+PARALLEL_THRESHOLD = 2000
+CHUNK_SIZE = 1024
+
+
+def read_tags(file: str) -> dict:
+    tags = {}
+    with open(file, 'r', encoding='utf-8') as f:
+        for tag in f.read().replace(", ", ",").split(","):
+            tags[tag] = tags.get(tag, 0) + 1
+    return tags
+
+
+def _read_chunk(files: list[str]) -> list[tuple[str, Union[dict, None]]]:
+    results = []
+    for file in files:
+        try:
+            results.append((file, read_tags(file)))
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Failed to read tags from {file}: {e}")
+            results.append((file, None))
+    return results
+
+
+def _chunks(files: list[str], chunk_size: int) -> list[list[str]]:
+    return [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+
+
+def _use_pool(files: list[str], workers: Union[int, None]) -> bool:
+    workers = workers or os.cpu_count() or 1
+    return workers > 1 and len(files) >= PARALLEL_THRESHOLD
+
+
+def read_tag_files(files: list[str], workers: int = None,
+                   chunk_size: int = CHUNK_SIZE) -> list[tuple[str, Union[dict, None]]]:
+    if not _use_pool(files, workers):
+        return _read_chunk(files)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_read_chunk, _chunks(files, chunk_size)):
+            results.extend(result)
+    return results
+
+
+def write_tag_report(tags: Counter, file: str) -> None:
+    with open(file, "w", encoding='utf-8') as f:
+        f.write("Below is a list of keywords used during the training of this model:\n")
+        for k, v in tags.most_common():
+            f.write(f"[{v}] {k}\n")
@@ -0,0 +1,373 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Union
+
+import toml
+
+from modules import early_stop, latent_cache, oom_fallback, preflight, run_dirs, run_history, supervisor, validator, \
+    watchdog
+from modules.dataset_stager import DatasetStager
+from modules.warm_worker import StaleWorker, WarmWorker
+
+SCRIPTS_DIR = Path("sd_scripts")
+
+
+class Job:
+    def __init__(self, args: dict, dataset_args: dict, script: str, base_args: dict, name: str = "") -> None:
+        self.args = args
+        self.dataset_args = dataset_args
+        self.script = script
+        self.base_args = base_args
+        self.name = name or args.get("output_name", "last")
+        self.fingerprint = None
+        self.duplicate_of = None
+        self.loss = None
+        self.output = None
+        self.stop_reason = None
+        self.retries: list[str] = []
+        self.resumed = None
+
+    def note(self) -> Union[str, None]:
+        """
+        What to record with the finished job, where it resumed from, its retries and why it stopped early.
+        """
+        notes = ([self.resumed] if self.resumed else []) + self.retries
+        return "; ".join(notes + ([self.stop_reason] if self.stop_reason else [])) or None
+
+
+def prepare_job(base_args: dict, runtime_only: bool = False, name: str = "") -> Union[Job, None]:
+    job = preflight.lookup(base_args, runtime_only, name)
+    if job:
+        print("using validated args from preflight")
+    else:
+        args, dataset_args = validator.separate_and_validate(base_args, runtime_only)
+        if not args or not dataset_args:
+            print("some args are not valid, skipping.")
+            return None
+        job = resolve_job(args, dataset_args, base_args, name)
+    if not runtime_only and check_duplicate(job):
+        return job
+    return finish_job(job, runtime_only)
+
+
+def check_duplicate(job: Job) -> bool:
+    """
+    Fingerprints the job and looks for a finished run of the same config on the same data. Returns True when
+    the job should be skipped, which can be turned off with "skip_trained_duplicates" in config.json.
+    """
+    if job.fingerprint is None:
+        job.fingerprint = run_history.fingerprint(job.args, job.dataset_args, job.script)
+    previous = run_history.get_history().find(job.fingerprint)
+    if not previous:
+        return False
+    print(f"{job.name} was already trained on the same data as {previous[0]} ({previous[1]})")
+    if not run_history.skip_duplicates():
+        return False
+    job.duplicate_of = previous[0]
+    job.output = previous[1]
+    job.loss = previous[2]
+    return True
+
+
+def resolve_job(args: dict, dataset_args: dict, base_args: dict, name: str = "") -> Job:
+    script = validator.validate_sdxl(args)
+    validator.validate_restarts(args, dataset_args)
+    validator.validate_warmup_ratio(args, dataset_args)
+    return Job(args, dataset_args, script, base_args, name)
+
+
+def finish_job(job: Job, runtime_only: bool = False) -> Job:
+    """
+    The part of validation that depends on what exists on disk at launch time, or writes files.
+    """
+    args = job.args
+    named = job.name != args.get("output_name", "last")
+    if not runtime_only:
+        validator.validate_save_tags(args, job.dataset_args)
+        validator.validate_existing_files(args)
+        if "save_toml" in args:
+            del args["save_toml"]
+            save_toml_path = args.get("save_toml_location", "")
+            if "save_toml_location" in args:
+                del args["save_toml_location"]
+            if not os.path.exists(save_toml_path):
+                save_toml_path = args["output_dir"]
+            with open(os.path.join(save_toml_path, f"auto_save_{args.get('output_name', 'last')}.toml"), "w",
+                      encoding="utf-8") as f:
+                toml.dump(job.base_args, f)
+    if not named:
+        job.name = args.get("output_name", "last")
+    return job
+
+
+def finalize_job(args: dict, dataset_args: dict, base_args: dict, runtime_only: bool = False,
+                 name: str = "") -> Job:
+    return finish_job(resolve_job(args, dataset_args, base_args, name), runtime_only)
+
+
+def find_state(output_dir: Union[str, Path], output_name: str) -> Union[tuple[Path, int, int], None]:
+    """
+    The newest state sd-scripts saved every n steps or epochs for this output name, with the step or the epoch
+    from its folder name, the other one is 0.
+    """
+    directory = Path(output_dir)
+    if not directory.is_dir():
+        return None
+    pattern = re.compile(re.escape(output_name) + r"-(?:step(\d{8})|(\d{6}))-state")
+    states = []
+    for path in directory.iterdir():
+        match = pattern.fullmatch(path.name)
+        if match and path.is_dir():
+            states.append((path.stat().st_mtime, path, int(match.group(1) or 0), int(match.group(2) or 0)))
+    if not states:
+        return None
+    _, path, step, epoch = max(states)
+    return path, step, epoch
+
+
+def total_steps(args: dict, dataset_args: dict) -> int:
+    if 'max_train_steps' in args:
+        return args['max_train_steps']
+    return validator.calculate_steps(dataset_args['subsets'], args['max_train_epochs'],
+                                     dataset_args['general']['batch_size'], dataset_args['general'],
+                                     args.get('gradient_accumulation_steps', 1))
+
+
+def resume_interrupted(job: Job, previous: Union[dict, None]) -> None:
+    """
+    Continues a job that was launched before and never finished from the newest state it saved, given the config
+    its earlier launch recorded. Only jobs with save_state on and no resume of their own are resumed, and only
+    from a state of the same output name in the same folder whose final model doesn't exist.
+    """
+    args = job.args
+    if not previous or not args.get("save_state") or args.get("resume"):
+        return
+    previous_args = previous.get("args", {})
+    output_name = args.get("output_name", "last")
+    if previous_args.get("output_name", "last") != output_name or \
+            previous_args.get("output_dir") != args.get("output_dir"):
+        return
+    if os.path.exists(run_history.output_file(args)):
+        return
+    state = find_state(args["output_dir"], output_name)
+    if not state:
+        return
+    path, step, epoch = state
+    total = total_steps(args, job.dataset_args)
+    done = step
+    train_state = path.joinpath("train_state.json")
+    if train_state.exists():
+        with train_state.open("r", encoding="utf-8") as f:
+            done = json.load(f).get("current_step", done)
+    elif epoch and args.get("max_train_epochs"):
+        done = total * epoch // args["max_train_epochs"]
+    if not 0 < done < total:
+        return
+    args["resume"] = str(path)
+    args["initial_step"] = done
+    args["skip_until_initial_step"] = True
+    job.resumed = f"resumed from {path.name} at step {done} of {total}, saving {done} steps ({done / total:.0%})"
+    print(job.resumed)
+
+
+def create_config_args_file(args: dict, path: Union[str, Path]) -> None:
+    if isinstance(path, str):
+        path = Path(path)
+    with path.open(mode="w", encoding="utf-8") as f:
+        for key, value in args.items():
+            if isinstance(value, str):
+                value = f'"{value}"'
+            if isinstance(value, bool):
+                value = f"{value}".lower()
+            f.write(f"{key} = {value}\n")
+
+
+def create_dataset_args_file(args: dict, path: Union[str, Path]) -> None:
+    if isinstance(path, str):
+        path = Path(path)
+    with path.open(mode="w", encoding="utf-8") as f:
+        f.write("[general]\n")
+        for key, value in args["general"].items():
+            if isinstance(value, str):
+                value = f"'{value}'"
+            if isinstance(value, bool):
+                value = f"{value}".lower()
+            f.write(f"{key} = {value}\n")
+        f.write("\n[[datasets]]\n")
+        for subset in args["subsets"]:
+            f.write("\n\t[[datasets.subsets]]\n")
+            for key, value in subset.items():
+                if isinstance(value, str):
+                    value = f"'{value}'"
+                if isinstance(value, bool):
+                    value = f"{value}".lower()
+                f.write(f"\t{key} = {value}\n")
+
+
+def render(job: Job, runtime_root: Union[str, Path] = run_dirs.ROOT) -> run_dirs.RunDir:
+    """
+    Leases the job a runtime folder of its own and writes its config files into it.
+    """
+    run_dir = run_dirs.acquire(job.name, {"script": job.script, "args": job.args, "dataset": job.dataset_args},
+                               runtime_root)
+    create_config_args_file(job.args, run_dir.config_file)
+    create_dataset_args_file(job.dataset_args, run_dir.dataset_file)
+    run_dir.write_meta(script=job.script, fingerprint=job.fingerprint)
+    return run_dir
+
+
+def save_runtime_files(job: Job) -> Path:
+    run_dir = render(job)
+    run_dir.release("rendered")
+    print(f"Validated, outputting toml files to folder {run_dir.path}")
+    return run_dir.path
+
+
+def build_command(script: str, config_file: Path, dataset_file: Path, python: str = None,
+                  scripts_dir: Union[str, Path] = SCRIPTS_DIR) -> list[str]:
+    return [
+        python or sys.executable,
+        os.path.join(scripts_dir, script),
+        f"--config_file={config_file}",
+        f"--dataset_config={dataset_file}",
+    ]
+
+
+def set_cpu_affinity(pid: int, cpus: set[int]) -> None:
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(pid, cpus)
+        return
+    try:
+        import psutil
+        psutil.Process(pid).cpu_affinity(sorted(cpus))
+    except ImportError:
+        print("psutil is not installed, cpu affinity will not be set")
+
+
+class TrainerFailed(subprocess.CalledProcessError):
+    """
+    The trainer exited with an error, cause is what supervisor.classify made of its output.
+    """
+
+    def __init__(self, code: int, command: list[str], tail: Iterable[str], cause: str,
+                 retries: list[str] = None) -> None:
+        super(TrainerFailed, self).__init__(code, command, "\n".join(tail))
+        self.cause = cause
+        self.retries = retries or []
+
+    def __str__(self) -> str:
+        lines = [f"trainer failed with {self.cause}, exit code {self.returncode}"] + self.retries
+        lines.extend(self.output.splitlines()[-10:])
+        return "\n".join(lines)
+
+
+def chain_events(*handlers: Callable[[supervisor.ProgressEvent], None]) -> Callable[[supervisor.ProgressEvent], None]:
+    def on_event(event: supervisor.ProgressEvent) -> None:
+        for handler in handlers:
+            if handler:
+                handler(event)
+    return on_event
+
+
+def launch(job: Job, stager: DatasetStager = None, python: str = None,
+           scripts_dir: Union[str, Path] = SCRIPTS_DIR, runtime_root: Union[str, Path] = run_dirs.ROOT,
+           env: dict = None, cpus: set[int] = None,
+           on_event: Callable[[supervisor.ProgressEvent], None] = None,
+           warm: WarmWorker = None) -> supervisor.Supervision:
+    if stager:
+        job.dataset_args = stager.rewrite(job.dataset_args)
+    run_dir = render(job, runtime_root)
+    config_file = run_dir.config_file
+    dataset_file = run_dir.dataset_file
+    cache_plan = latent_cache.prepare(job.args, job.dataset_args, job.script)
+    print(f"validated, starting training in {run_dir.path}...")
+    started = time.time_ns()
+    command = build_command(job.script, config_file, dataset_file, python, scripts_dir)
+    run_dir.write_meta(command=command)
+    limits = watchdog.settings(job.base_args)
+    fallback = oom_fallback.enabled()
+    attempt = 0
+    stalls = 0
+    state = "failed"
+    error = None
+    try:
+        while True:
+            attempt += 1
+            stopper = early_stop.from_args(job.base_args, job.args)
+            guard = watchdog.Watchdog(**limits)
+            run_dir.write_meta(attempts=attempt)
+            with run_dir.log(f"attempt {attempt}") as echo:
+                result = run_trainer(job, command, env, cpus, on_event, warm, stopper, guard, echo)
+            if result.last_step:
+                job.loss = result.last_step.loss
+            if stopper and stopper.stopped:
+                job.stop_reason = stopper.summary()
+                job.output = stopper.saved
+                print(job.stop_reason)
+                state = "stopped"
+                return result
+            if result.stopped:
+                job.retries.append(f"attempt {attempt}: {result.stopped}")
+                stalls += 1
+                if stalls <= limits["retries"]:
+                    print(f"watchdog: starting {job.name} again")
+                    continue
+                raise watchdog.WatchdogTimeout("; ".join(job.retries), "\n".join(result.tail))
+            if result.code:
+                change = None
+                if result.cause == supervisor.OUT_OF_MEMORY and fallback:
+                    change = oom_fallback.next_step(job.args, job.dataset_args)
+                if change:
+                    job.retries.append(f"attempt {attempt}: out of memory, retrying with {change}")
+                    print(f"{job.name} ran out of memory, starting it again with {change}")
+                    create_config_args_file(job.args, config_file)
+                    create_dataset_args_file(job.dataset_args, dataset_file)
+                    continue
+                raise TrainerFailed(result.code, command, result.tail, result.cause, job.retries)
+            if job.fingerprint:
+                run_history.get_history().record(job.fingerprint, job.name, job.args, job.loss)
+            job.output = run_history.output_file(job.args)
+            state = "done"
+            return result
+    except BaseException as e:
+        error = str(e)
+        raise
+    finally:
+        run_dir.release(state, error or job.note())
+        latent_cache.collect(cache_plan, started)
+        if stager:
+            stager.release(job.dataset_args)
+
+
+def run_trainer(job: Job, command: list[str], env: dict, cpus: Union[set[int], None],
+                on_event: Union[Callable[[supervisor.ProgressEvent], None], None], warm: Union[WarmWorker, None],
+                stopper: Union[early_stop.EarlyStop, None], guard: watchdog.Watchdog,
+                echo=sys.stdout) -> supervisor.Supervision:
+    def on_start(pid: int) -> None:
+        if cpus:
+            set_cpu_affinity(pid, cpus)
+        if stopper:
+            stopper.pid = pid
+
+    if stopper:
+        on_event = chain_events(stopper.on_event, on_event)
+    if warm and warm.ensure_started():
+        try:
+            return warm.run(job.script, command[2:], env, on_event, on_start, echo, guard)
+        except StaleWorker as e:
+            print(e)
+    return supervisor.run(command, env, on_event, on_start, echo, guard)
+
+
+def cleanup_runtime_store() -> None:
+    """
+    Removes the runtime folders of finished jobs that are past keeping, never one another launch still holds.
+    """
+    removed = run_dirs.cleanup()
+    if removed:
+        print(f"removed {removed} old runtime folders")
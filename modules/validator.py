@@ -2,6 +2,11 @@ import os
 from pathlib import Path
 from typing import Union
 
+from modules import bucket_simulator, dataset_index, tag_counter
+
+# saved with the args the UI edits, but read by the launcher, sd-scripts doesn't know them
+UI_ONLY_ARGS = {"early_stop", "watchdog"}
+
 
 def separate_and_validate(args: dict, skip_file_paths: bool = False) -> tuple[Union[dict, None], Union[dict, None]]:
     new_args = {}
@@ -38,6 +43,8 @@ def validate_args(args: dict, skip_file_paths: bool = False) -> Union[dict, None
             new_args['network_module'] = "networks.lora_fa"
             del value["fa"]
         for arg, val in value.items():
+            if arg in UI_ONLY_ARGS:
+                continue
             if arg == "network_args":
                 vals = []
                 for k, v in val.items():
@@ -136,7 +143,8 @@ def validate_restarts(args: dict, dataset: dict) -> None:
     if 'max_train_steps' in args:
         steps = args['max_train_steps']
     else:
-        steps = calculate_steps(dataset['subsets'], args['max_train_epochs'], dataset['general']['batch_size'])
+        steps = calculate_steps(dataset['subsets'], args['max_train_epochs'], dataset['general']['batch_size'],
+                                dataset['general'], args.get('gradient_accumulation_steps', 1))
     steps = steps // args['lr_scheduler_num_cycles']
     args['lr_scheduler_args'].append(f"first_cycle_steps={steps}")
 
@@ -147,7 +155,8 @@ def validate_warmup_ratio(args: dict, dataset: dict) -> None:
     if 'max_train_steps' in args:
         steps = args['max_train_steps']
     else:
-        steps = calculate_steps(dataset['subsets'], args['max_train_epochs'], dataset['general']['batch_size'])
+        steps = calculate_steps(dataset['subsets'], args['max_train_epochs'], dataset['general']['batch_size'],
+                                dataset['general'], args.get('gradient_accumulation_steps', 1))
     steps = round(steps * args['warmup_ratio'])
     if "lr_scheduler_type" in args:
         args['lr_scheduler_args'].append(f"warmup_steps={steps // args.get('lr_scheduler_num_cycles', 1)}")
@@ -157,52 +166,28 @@ def validate_warmup_ratio(args: dict, dataset: dict) -> None:
     del args['warmup_ratio']
 
 
-def validate_save_tags(args: dict, dataset: dict) -> None:
+def validate_save_tags(args: dict, dataset: dict, workers: int = None) -> None:
     if "tag_occurrence" not in args:
         return
-    tags = {}
-    for subset in dataset['subsets']:
-        if not os.path.isdir(subset['image_dir']):
-            continue
-        for file in os.listdir(subset['image_dir']):
-            if not os.path.isfile(os.path.join(subset['image_dir'], file)):
-                continue
-            if os.path.splitext(file)[1] != subset['caption_extension']:
-                continue
-            get_tags_from_file(os.path.join(subset['image_dir'], file), tags)
-    output_list = {k: v for k, v in sorted(tags.items(), key=lambda item: item[1], reverse=True)}
+    tags = dataset_index.subset_tag_counts(dataset['subsets'], workers)
     file_path = args.get("tag_file_location", "")
     if not os.path.exists(file_path):
         file_path = args['output_dir']
-    with open(os.path.join(file_path, f"{args['output_name']}_tags.txt"), "w", encoding='utf-8') as f:
-        f.write("Below is a list of keywords used during the training of this model:\n")
-        for k, v in output_list.items():
-            f.write(f"[{v}] {k}\n")
+    tag_counter.write_tag_report(tags, os.path.join(file_path, f"{args['output_name']}_tags.txt"))
     del args['tag_occurrence']
     if "tag_file_location" in args:
         del args['tag_file_location']
 
 
-def get_tags_from_file(file: str, tags: dict) -> None:
-    with open(file, 'r') as f:
-        temp = f.read().replace(", ", ",").split(",")
-        for tag in temp:
-            if tag in tags:
-                tags[tag] += 1
-            else:
-                tags[tag] = 1
-
-
-def calculate_steps(subsets: list, epochs: int, batch_size: int) -> int:
+def calculate_steps(subsets: list, epochs: int, batch_size: int, general: dict = None,
+                    gradient_accumulation_steps: int = 1) -> int:
+    if general is not None:
+        general = {**general, "batch_size": batch_size}
+        return bucket_simulator.simulate(subsets, general, epochs, gradient_accumulation_steps).total_steps
     steps = 0
+    index = dataset_index.get_index()
     for subset in subsets:
-        image_count = 0
-        files = os.listdir(subset['image_dir'])
-        for file in files:
-            if file.split(".")[-1].lower() not in {"png", "bmp", "gif", "jpeg", "jpg", "webp"}:
-                continue
-            image_count += 1
-        steps += (image_count * subset['num_repeats'])
+        steps += (index.image_count(subset['image_dir']) * subset['num_repeats'])
     steps = (steps * epochs) // batch_size
     return steps
 
@@ -0,0 +1,280 @@
+"""
+Keeps a python process with torch, diffusers, transformers, accelerate and sd-scripts' library already imported,
+and forks a fresh child from it for every training job, so a queue only pays the import time once.
+
+The server is started by WarmWorker and is not meant to be run by hand:
+
+    python -m modules.warm_worker --scripts_dir sd_scripts --socket runtime_store/warm/worker.sock
+
+Every job still runs in its own process, forked from a server that has never touched CUDA, so jobs cannot leak
+state into each other. Before forking, the server checks that none of the modules it imported changed on disk
+since it started, if any did it refuses the job and exits, and the job is started cold instead.
+
+Forking is not available on Windows, where jobs are always started cold.
+"""
+import argparse
+import asyncio
+import json
+import os
+import runpy
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import traceback
+from pathlib import Path
+from typing import Callable, Union
+
+from modules import supervisor
+from modules.watchdog import Watchdog
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+SOCKET_PATH = Path("runtime_store/warm/worker.sock")
+PRELOAD = ["torch", "torchvision", "safetensors", "transformers", "diffusers", "accelerate",
+           "library.train_util", "library.config_util", "library.custom_train_functions", "networks.lora"]
+OUTPUT = b"O"
+EXIT = b"X"
+
+
+def supported() -> bool:
+    return hasattr(os, "fork") and hasattr(socket, "AF_UNIX")
+
+
+def module_fingerprint() -> dict[str, int]:
+    fingerprint = {}
+    for module in list(sys.modules.values()):
+        file = getattr(module, "__file__", None)
+        if not file:
+            continue
+        try:
+            fingerprint[file] = os.stat(file).st_mtime_ns
+        except OSError:
+            continue
+    return fingerprint
+
+
+def changed_modules(fingerprint: dict[str, int]) -> list[str]:
+    changed = []
+    for file, mtime in fingerprint.items():
+        try:
+            if os.stat(file).st_mtime_ns != mtime:
+                changed.append(file)
+        except OSError:
+            changed.append(file)
+    return changed
+
+
+def _send(conn: socket.socket, kind: bytes, payload: bytes) -> None:
+    conn.sendall(kind + struct.pack(">I", len(payload)) + payload)
+
+
+def _run_child(request: dict, write_fd: int, scripts_dir: str) -> None:
+    """
+    Runs in the forked child, it never returns.
+    """
+    code = 0
+    try:
+        os.setsid()
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        sys.stdout.reconfigure(line_buffering=True)
+        os.environ.update(request.get("env", {}))
+        os.chdir(request["cwd"])
+        script = os.path.join(scripts_dir, request["script"])
+        sys.argv = [script] + request["argv"]
+        sys.path[0] = os.path.dirname(script)
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def _relay(conn: socket.socket, pid: int, read_fd: int, open_fds: set[int]) -> None:
+    try:
+        while chunk := os.read(read_fd, 1 << 16):
+            _send(conn, OUTPUT, chunk)
+    except OSError:
+        pass
+    finally:
+        open_fds.discard(read_fd)
+        os.close(read_fd)
+    _, status = os.waitpid(pid, 0)
+    try:
+        conn.sendall(EXIT + struct.pack(">i", os.waitstatus_to_exitcode(status)))
+    except OSError:
+        pass
+    open_fds.discard(conn.fileno())
+    conn.close()
+
+
+def serve(scripts_dir: str, socket_path: str) -> None:
+    sys.path.insert(0, scripts_dir)
+    for module in PRELOAD:
+        try:
+            __import__(module)
+        except Exception as e:
+            print(f"warm worker could not preload {module}: {e}", flush=True)
+    fingerprint = module_fingerprint()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    print("ready", flush=True)
+    # fds of jobs still running, a new child must not keep them open
+    open_fds = set()
+    while True:
+        conn, _ = server.accept()
+        request = json.loads(conn.makefile("rb").readline())
+        changed = changed_modules(fingerprint)
+        if changed:
+            conn.sendall(json.dumps({"stale": changed[:5]}).encode("utf-8") + b"\n")
+            conn.close()
+            break
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            conn.close()
+            os.close(read_fd)
+            for fd in list(open_fds):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            _run_child(request, write_fd, scripts_dir)
+        os.close(write_fd)
+        conn.sendall(json.dumps({"pid": pid}).encode("utf-8") + b"\n")
+        open_fds.update((conn.fileno(), read_fd))
+        threading.Thread(target=_relay, args=(conn, pid, read_fd, open_fds), daemon=True).start()
+    server.close()
+    os.remove(socket_path)
+
+
+class StaleWorker(Exception):
+    pass
+
+
+class WarmWorker:
+    """
+    Starts and talks to the warm server. One server is shared by every job launched through it, and it is
+    started again after it retired itself because modules changed.
+    """
+
+    def __init__(self, python: str = None, scripts_dir: Union[str, Path] = "sd_scripts",
+                 socket_path: Union[str, Path] = SOCKET_PATH) -> None:
+        self.python = python or sys.executable
+        self.scripts_dir = os.path.abspath(scripts_dir)
+        self.socket_path = os.path.abspath(socket_path)
+        self.process: Union[subprocess.Popen, None] = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self) -> bool:
+        if not supported():
+            return False
+        with self.lock:
+            if self.process and self.process.poll() is None:
+                return True
+            print("starting warm worker, preloading training modules...")
+            os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+            self.process = subprocess.Popen(
+                [self.python, "-m", "modules.warm_worker", "--scripts_dir", self.scripts_dir,
+                 "--socket", self.socket_path], cwd=ROOT_DIR, stdout=subprocess.PIPE, text=True
+            )
+            for line in self.process.stdout:
+                if line.strip() == "ready":
+                    threading.Thread(target=self._echo, args=(self.process.stdout,), daemon=True).start()
+                    return True
+                print(line, end="")
+            print("warm worker failed to start, jobs will be started cold")
+            self.process = None
+            return False
+
+    @staticmethod
+    def _echo(stream) -> None:
+        for line in stream:
+            print(line, end="")
+
+    def stop(self) -> None:
+        with self.lock:
+            if self.process and self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+            self.process = None
+
+    async def supervise(self, script: str, argv: list[str], env: dict = None,
+                        on_event: Callable[[supervisor.ProgressEvent], None] = None,
+                        on_start: Callable[[int], None] = None, echo=sys.stdout,
+                        guard: Watchdog = None) -> supervisor.Supervision:
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        request = {"script": script, "argv": argv, "env": env or {}, "cwd": os.getcwd()}
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        reply = json.loads(await reader.readline() or b"{}")
+        if "pid" not in reply:
+            writer.close()
+            raise StaleWorker(f"warm worker modules changed ({', '.join(reply.get('stale', []))}), starting cold")
+        code = []
+
+        async def read() -> bytes:
+            try:
+                kind = await reader.readexactly(1)
+                if kind == OUTPUT:
+                    length = struct.unpack(">I", await reader.readexactly(4))[0]
+                    return await reader.readexactly(length)
+                code.append(struct.unpack(">i", await reader.readexactly(4))[0])
+            except asyncio.IncompleteReadError:
+                print("lost the connection to the warm worker")
+            return b""
+
+        async def wait() -> int:
+            writer.close()
+            return code[0] if code else 1
+
+        return await supervisor.watch(reply["pid"], read, wait, on_event, on_start, echo, guard)
+
+    def run(self, script: str, argv: list[str], env: dict = None,
+            on_event: Callable[[supervisor.ProgressEvent], None] = None,
+            on_start: Callable[[int], None] = None, echo=sys.stdout,
+            guard: Watchdog = None) -> supervisor.Supervision:
+        """
+        Runs a job forked from the warm server. Raises StaleWorker when the server refused it, the caller should
+        then start the job cold.
+        """
+        try:
+            return asyncio.run(self.supervise(script, argv, env, on_event, on_start, echo, guard))
+        except OSError as e:
+            raise StaleWorker(f"warm worker is not reachable ({e}), starting cold")
+
+
+def from_config(config_file: str = "config.json", python: str = None,
+                scripts_dir: Union[str, Path] = "sd_scripts") -> Union[WarmWorker, None]:
+    if not supported() or not os.path.exists(config_file):
+        return None
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    if not config.get("warm_worker", False):
+        return None
+    return WarmWorker(python, scripts_dir)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Warm sd-scripts worker, started by the training queue")
+    parser.add_argument("--scripts_dir", required=True)
+    parser.add_argument("--socket", default=str(SOCKET_PATH))
+    args = parser.parse_args()
+    serve(args.scripts_dir, args.socket)
+
+
+if __name__ == "__main__":
+    main()
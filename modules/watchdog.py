@@ -0,0 +1,206 @@
+"""
+Ends trainers that run too long, past their step budget, or stop making progress, so one hung job cannot block
+the queue forever. Set defaults for every job in config.json, and override them per job in its general args:
+
+    "watchdog": {"max_minutes": 600, "stall_minutes": 20, "retries": 1}
+
+    [general_args.args.watchdog]
+    max_minutes = 120       # wall clock budget of one attempt, 0 is off
+    max_steps = 0           # stop once the trainer reports this step, 0 is off
+    stall_minutes = 15      # no output and almost no cpu use in the whole process tree for this long, 0 is off
+    grace_seconds = 30      # how long each of SIGINT, SIGTERM and SIGKILL gets before the next one is sent
+    retries = 0             # how many times a stopped job is started again before it is skipped as failed
+
+Stalls need both signals, a trainer caching latents or loading a model is quiet but busy, a deadlocked dataloader
+is quiet and idle. Cpu use is read from /proc, or psutil where there is no /proc, without either only the output
+is watched.
+"""
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import time
+from typing import Union
+
+DEFAULTS = {"max_minutes": 0, "max_steps": 0, "stall_minutes": 0, "grace_seconds": 30, "retries": 0}
+# a stalled tree uses less than this share of one cpu
+IDLE_CPU = 0.02
+
+
+class WatchdogTimeout(subprocess.SubprocessError):
+    def __init__(self, reason: str, tail: str = "") -> None:
+        super(WatchdogTimeout, self).__init__(reason)
+        self.reason = reason
+        self.tail = tail
+
+    def __str__(self) -> str:
+        return f"stopped by the watchdog: {self.reason}\n{self.tail}".rstrip()
+
+
+def _children() -> dict[int, list[int]]:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        parent = int(stat[stat.rfind(")") + 2:].split()[1])
+        children.setdefault(parent, []).append(int(entry))
+    return children
+
+
+def process_tree(pid: int) -> list[int]:
+    """
+    The pid and every process below it.
+    """
+    if os.path.isdir("/proc"):
+        children = _children()
+        tree = [pid]
+        for parent in tree:
+            tree.extend(children.get(parent, []))
+        return tree
+    try:
+        import psutil
+        return [pid] + [child.pid for child in psutil.Process(pid).children(recursive=True)]
+    except ImportError:
+        return [pid]
+    except Exception:
+        return [pid]
+
+
+def cpu_seconds(pids: list[int]) -> Union[float, None]:
+    if os.path.isdir("/proc"):
+        total = 0.0
+        ticks = os.sysconf("SC_CLK_TCK")
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/stat", "r") as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            fields = stat[stat.rfind(")") + 2:].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        return total
+    try:
+        import psutil
+    except ImportError:
+        return None
+    total = 0.0
+    for pid in pids:
+        try:
+            times = psutil.Process(pid).cpu_times()
+            total += times.user + times.system
+        except Exception:
+            continue
+    return total
+
+
+def signal_tree(pids: list[int], sig: int) -> None:
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except (OSError, ValueError):
+            pass
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    if os.path.exists(f"/proc/{pid}/stat"):
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        # a zombie is dead, it is only waiting for its parent to collect its exit code
+        return stat[stat.rfind(")") + 2] != "Z"
+    return True
+
+
+class Watchdog:
+    """
+    Guards one attempt of one job. The supervisor reports output and steps to it, and runs guard() next to the
+    trainer, which ends the whole process tree once a budget runs out and leaves the reason in reason.
+    """
+
+    def __init__(self, max_minutes: float = 0, max_steps: int = 0, stall_minutes: float = 0,
+                 grace_seconds: float = 30, retries: int = 0) -> None:
+        self.max_seconds = max_minutes * 60
+        self.max_steps = max_steps
+        self.stall_seconds = stall_minutes * 60
+        self.grace_seconds = grace_seconds
+        self.retries = retries
+        self.started = time.monotonic()
+        self.last_output = self.started
+        self.step = 0
+        self.reason: Union[str, None] = None
+
+    def active(self) -> bool:
+        return bool(self.max_seconds or self.max_steps or self.stall_seconds)
+
+    def activity(self) -> None:
+        self.last_output = time.monotonic()
+
+    def observe_step(self, step: int) -> None:
+        self.step = step
+
+    def check(self, now: float, idle: bool) -> Union[str, None]:
+        if self.max_seconds and now - self.started > self.max_seconds:
+            return f"ran longer than {self.max_seconds / 60:g} minutes"
+        if self.max_steps and self.step >= self.max_steps:
+            return f"reached its budget of {self.max_steps} steps"
+        if self.stall_seconds and idle and now - self.last_output > self.stall_seconds:
+            return f"no output and no cpu use for {self.stall_seconds / 60:g} minutes"
+        return None
+
+    async def guard(self, pid: int) -> None:
+        interval = min(5.0, max(0.2, (self.stall_seconds or self.max_seconds or 20) / 10))
+        window = []
+        while alive(pid):
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            idle = True
+            if self.stall_seconds:
+                used = cpu_seconds(process_tree(pid))
+                if used is not None:
+                    window.append((now, used))
+                    # compare against the sample taken about a stall ago
+                    while len(window) > 1 and now - window[1][0] >= self.stall_seconds:
+                        window.pop(0)
+                    idle = now - window[0][0] > 0 and \
+                        (used - window[0][1]) / (now - window[0][0]) < IDLE_CPU
+            self.reason = self.check(now, idle)
+            if self.reason:
+                print(f"\nwatchdog: {self.reason}, stopping the trainer")
+                await self.terminate(pid)
+                return
+
+    async def terminate(self, pid: int) -> None:
+        """
+        Sends SIGINT, SIGTERM and SIGKILL to the process tree in turn, each one getting grace_seconds to work.
+        """
+        tree = process_tree(pid)
+        signals = [signal.SIGINT, signal.SIGTERM] if os.name != "nt" else [signal.SIGTERM]
+        signals.append(getattr(signal, "SIGKILL", signal.SIGTERM))
+        for sig in signals:
+            # children that outlive their parent are reparented, so keep every pid seen so far
+            tree = list(dict.fromkeys(tree + (process_tree(pid) if alive(pid) else [])))
+            signal_tree(tree, sig)
+            deadline = time.monotonic() + self.grace_seconds
+            while time.monotonic() < deadline:
+                if not any(alive(member) for member in tree):
+                    return
+                await asyncio.sleep(0.2)
+            print(f"watchdog: trainer is still running after {signal.Signals(sig).name}")
+
+
+def settings(base_args: dict, config_file: str = "config.json") -> dict:
+    values = dict(DEFAULTS)
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            values.update(json.load(f).get("watchdog", {}))
+    values.update((base_args or {}).get("general_args", {}).get("args", {}).get("watchdog", {}))
+    return {key: values[key] for key in DEFAULTS}
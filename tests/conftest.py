@@ -0,0 +1,85 @@
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import zlib
+from pathlib import Path
+
+import pytest
+import toml
+
+REPO = Path(__file__).resolve().parent.parent
+STUB_SCRIPTS = REPO.joinpath("benchmarks", "stub_sd_scripts")
+
+
+def png_header(width: int, height: int) -> bytes:
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr
+            + struct.pack(">I", zlib.crc32(b"IHDR" + ihdr)))
+
+
+class Workspace:
+    """
+    A copy of the modules the headless runner runs from with the stub trainer, so its runtime_store is its own,
+    along with a small dataset and a stand-in model. Nothing is shared with the repo or other tests.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        # the runner works from the folder its modules are in
+        shutil.copytree(REPO.joinpath("modules"), root.joinpath("modules"),
+                        ignore=shutil.ignore_patterns("__pycache__"))
+        self.images = root.joinpath("images")
+        self.images.mkdir()
+        for i in range(8):
+            self.images.joinpath(f"{i}.png").write_bytes(png_header(512, 512))
+            self.images.joinpath(f"{i}.txt").write_text(f"tag_{i}, shared", encoding="utf-8")
+        self.model = root.joinpath("model.safetensors")
+        self.model.write_bytes(b"model")
+        self.output = root.joinpath("output")
+        self.output.mkdir()
+
+    def job(self, name: str, steps: int = 4, batch_size: int = 1, **general) -> Path:
+        """
+        Writes a queue toml training the dataset for steps, general is added to its general_args.args.
+        """
+        args = {
+            "subsets": [{"image_dir": str(self.images), "caption_extension": ".txt", "num_repeats": 1,
+                         "keep_tokens": 0}],
+            "general_args": {"args": {"pretrained_model_name_or_path": str(self.model), "max_train_steps": steps,
+                                      **general},
+                             "dataset_args": {"resolution": 512, "batch_size": batch_size}},
+            "network_args": {"args": {"network_dim": 8}},
+            "optimizer_args": {"args": {"optimizer_type": "AdamW8bit", "lr_scheduler": "constant",
+                                        "learning_rate": 1e-4}},
+            "saving_args": {"args": {"output_dir": str(self.output), "output_name": name}},
+        }
+        file = self.root.joinpath(f"{name}.toml")
+        file.write_text(toml.dumps(args), encoding="utf-8")
+        return file
+
+    def run(self, *argv: str, **env: str) -> subprocess.CompletedProcess:
+        """
+        Runs the headless runner on the stub trainer, env is added to the trainer's environment.
+        """
+        environment = {**os.environ, "STUB_STEP_TIME": "0", **env}
+        return subprocess.run([sys.executable, "-m", "modules.queue_runner", "--scripts_dir", str(STUB_SCRIPTS),
+                               *argv], cwd=self.root, env=environment, capture_output=True, text=True, timeout=300)
+
+    @staticmethod
+    def summary(result: subprocess.CompletedProcess) -> str:
+        return [line for line in result.stdout.splitlines() if line.startswith("Queue finished")][-1]
+
+    def logs(self) -> dict[str, str]:
+        """
+        The output.log of every launch, by its run folder's name.
+        """
+        return {path.parent.name: path.read_text(encoding="utf-8")
+                for path in self.root.joinpath("runtime_store", "jobs").glob("*/output.log")}
+
+
+@pytest.fixture
+def workspace(tmp_path: Path) -> Workspace:
+    return Workspace(tmp_path)
+
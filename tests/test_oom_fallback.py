@@ -0,0 +1,24 @@
+import toml
+
+from conftest import Workspace
+
+
+def test_out_of_memory_retries_with_half_the_batch(workspace: Workspace) -> None:
+    job = workspace.job("oom", steps=6, batch_size=4)
+    # fails at step 2 while the batch is larger than 2, so the first step of the ladder fixes it
+    result = workspace.run(str(job), STUB_MAX_BATCH="2")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert workspace.summary(result) == "Queue finished: 1 trained, 0 skipped, 0 failed"
+    assert result.stdout.count("ran out of memory") == 1
+    assert "starting it again with batch_size 2 and gradient_accumulation_steps 2" in result.stdout
+    dataset = toml.load(next(workspace.root.joinpath("runtime_store", "jobs").glob("oom-*/dataset.toml")))
+    assert dataset["general"]["batch_size"] == 2
+    assert workspace.output.joinpath("oom.safetensors").exists()
+
+
+def test_host_memory_is_not_retried(workspace: Workspace) -> None:
+    job = workspace.job("ram", steps=6)
+    result = workspace.run(str(job), STUB_FAIL="ram")
+    assert result.returncode == 1
+    assert "trainer failed with out of system memory" in result.stdout
+    assert "retrying" not in result.stdout
@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+
+from conftest import Workspace
+from modules import dataset_index, run_history
+
+
+@pytest.fixture
+def index(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> dataset_index.DatasetIndex:
+    index = dataset_index.DatasetIndex(tmp_path.joinpath("index.sqlite"))
+    monkeypatch.setattr(dataset_index, "_index", index)
+    return index
+
+
+def job_fingerprint(image_dir: Path) -> str:
+    return run_history.fingerprint({"cache_latents_to_disk": True},
+                                   {"general": {}, "subsets": [{"image_dir": str(image_dir),
+                                                                "caption_extension": ".txt"}]},
+                                   "train_network.py")
+
+
+def test_cached_latents_do_not_change_the_fingerprint(tmp_path: Path, index: dataset_index.DatasetIndex) -> None:
+    image_dir = tmp_path.joinpath("images")
+    image_dir.mkdir()
+    image_dir.joinpath("0.png").write_bytes(b"png")
+    image_dir.joinpath("0.txt").write_text("tag", encoding="utf-8")
+    before = job_fingerprint(image_dir)
+
+    image_dir.joinpath("0.npz").write_bytes(b"latents")
+    image_dir.joinpath("0.json").write_text("{}", encoding="utf-8")
+    image_dir.joinpath("0_te_outputs.npz").write_bytes(b"outputs")
+    assert job_fingerprint(image_dir) == before
+
+    image_dir.joinpath("0.txt").write_text("tag, other", encoding="utf-8")
+    assert job_fingerprint(image_dir) != before
+
+
+def test_trained_job_is_skipped_as_a_duplicate(workspace: Workspace) -> None:
+    first = workspace.job("first", cache_latents_to_disk=True)
+    result = workspace.run(str(first))
+    assert workspace.summary(result) == "Queue finished: 1 trained, 0 skipped, 0 failed"
+    # what sd-scripts leaves next to the images when it caches latents
+    workspace.images.joinpath("0.npz").write_bytes(b"latents")
+
+    # the same training under another name, and a copy of it in the same queue
+    again, copy = workspace.job("again", cache_latents_to_disk=True), workspace.job("copy", cache_latents_to_disk=True)
+    result = workspace.run(str(again), str(copy))
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert workspace.summary(result) == "Queue finished: 0 trained, 2 skipped, 0 failed"
+    assert "already trained on the same data as first" in result.stdout
+    assert not workspace.output.joinpath("again.safetensors").exists()
@@ -0,0 +1,20 @@
+import re
+
+from conftest import Workspace
+
+
+def test_each_slot_trains_on_its_own_devices(workspace: Workspace) -> None:
+    jobs = [workspace.job(name, steps=20, seed=seed) for seed, name in enumerate(("a", "b", "c", "d"))]
+    result = workspace.run(*map(str, jobs), "--devices", "0", "1,2", STUB_STEP_TIME="0.02")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert workspace.summary(result) == "Queue finished: 4 trained, 0 skipped, 0 failed"
+
+    started = re.findall(r"slot (\d+): starting (\w+)", result.stdout)
+    assert sorted(name for _, name in started) == ["a", "b", "c", "d"]
+    # the first two jobs start at once, one on each slot
+    assert {slot for slot, _ in started[:2]} == {"0", "1"}
+    devices = {"0": "0", "1": "1,2"}
+    logs = workspace.logs()
+    for slot, name in started:
+        log = next(text for folder, text in logs.items() if folder.startswith(f"{name}-"))
+        assert f"CUDA_VISIBLE_DEVICES={devices[slot]} " in log
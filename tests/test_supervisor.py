@@ -0,0 +1,15 @@
+from modules import supervisor
+
+
+def test_host_memory_is_not_gpu_out_of_memory() -> None:
+    host = ["RuntimeError: [enforce fail at alloc_cpu.cpp:83] data. DefaultCPUAllocator: can't allocate memory: "
+            "you tried to allocate 2147483648 bytes. Error code 12 (Cannot allocate memory)"]
+    gpu = ["torch.cuda.OutOfMemoryError: CUDA out of memory. Tried to allocate 2.00 GiB"]
+    assert supervisor.classify(host) == supervisor.OUT_OF_HOST_MEMORY
+    assert supervisor.classify(gpu) == supervisor.OUT_OF_MEMORY
+
+
+def test_step_loss_in_exponent_notation() -> None:
+    event = supervisor.parse_line("steps:  50%|█████     | 50/100 [00:10<00:10, 4.87it/s, avr_loss=1.2e-05]")
+    assert (event.step, event.total, event.loss) == (50, 100, 1.2e-05)
+    assert supervisor.parse_line("steps: 1%| 1/100 [00:01<01:39, 1.00s/it, avr_loss=0.0931]").loss == 0.0931
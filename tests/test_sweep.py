@@ -0,0 +1,48 @@
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+from modules import sweep, training
+
+STUB_SCRIPTS = Path(__file__).resolve().parent.parent.joinpath("benchmarks", "stub_sd_scripts")
+
+
+def halving_args(output_dir: Path) -> dict:
+    return {
+        "general_args": {"args": {"max_train_steps": 90}},
+        "optimizer_args": {"args": {"learning_rate": 1e-4}},
+        "saving_args": {"args": {"output_dir": str(output_dir), "output_name": "point"}},
+        "sweep": {
+            "parameters": {"learning_rate": [1e-4, 2e-4, 3e-4]},
+            "halving": {"min_steps": 10, "eta": 3},
+        },
+    }
+
+
+def test_resumed_round_trains_up_to_its_budget(tmp_path: Path) -> None:
+    halving = sweep.Halving(sweep.Sweep(halving_args(tmp_path)))
+    assert halving.budgets == [10, 30, 90]
+    first_round = list(halving.jobs())
+    assert halving.advance({name: float(i) for i, (name, _) in enumerate(first_round)})
+    name, base_args = next(halving.jobs())
+    assert base_args["general_args"]["args"]["max_train_steps"] == halving.budgets[1]
+
+    # the state the first round of this point left behind
+    resume = Path(base_args["saving_args"]["args"]["resume"])
+    resume.mkdir(parents=True)
+    resume.joinpath("train_state.json").write_text(json.dumps({"current_step": halving.budgets[0]}))
+
+    args = {key: value for section in base_args.values() if isinstance(section, dict)
+            for key, value in section.get("args", {}).items()}
+    config_file = tmp_path.joinpath("config.toml")
+    training.create_config_args_file(args, config_file)
+    result = subprocess.run([sys.executable, str(STUB_SCRIPTS.joinpath("train_network.py")),
+                             f"--config_file={config_file}"],
+                            capture_output=True, text=True, env={"STUB_STEP_TIME": "0"})
+    assert result.returncode == 0, result.stderr
+    steps = [(int(done), int(total)) for done, total in re.findall(r"\| (\d+)/(\d+) \[", result.stderr)]
+    assert steps[0] == (halving.budgets[0] + 1, halving.budgets[1])
+    assert steps[-1] == (halving.budgets[1], halving.budgets[1])
+    assert tmp_path.joinpath(f"{name}.safetensors").exists()
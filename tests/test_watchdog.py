@@ -0,0 +1,20 @@
+from conftest import Workspace
+
+
+def test_hung_trainer_is_stopped_and_retried(workspace: Workspace) -> None:
+    job = workspace.job("hang", steps=10,
+                        watchdog={"stall_minutes": 0.02, "grace_seconds": 1, "retries": 1})
+    result = workspace.run(str(job), STUB_FAIL="hang", STUB_STEP_TIME="0.01")
+    assert result.returncode == 1
+    assert workspace.summary(result) == "Queue finished: 0 trained, 0 skipped, 1 failed"
+    assert result.stdout.count("stopping the trainer") == 2
+    assert "attempt 1: no output" in result.stdout
+    assert "attempt 2: no output" in result.stdout
+
+
+def test_step_budget_stops_a_runaway_trainer(workspace: Workspace) -> None:
+    job = workspace.job("runaway", steps=1000, watchdog={"max_steps": 5, "grace_seconds": 1, "retries": 0})
+    result = workspace.run(str(job), STUB_STEP_TIME="0.01")
+    assert result.returncode == 1
+    assert "reached its budget of 5 steps" in result.stdout
+    assert not workspace.output.joinpath("runaway.safetensors").exists()